@@ -1,22 +1,27 @@
 # fund_models.py
 
-import calendar
 from datetime import datetime, date, time, timedelta
-from io import StringIO
-import csv
-from operator import attrgetter, itemgetter
-from itertools import groupby
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
+import math
+import queue
 
+from django.conf import settings
 from django.db import models, transaction, IntegrityError
-from django.http import HttpResponse
+
+from .providers import (
+    Provider_exception, get_provider, yahoo_session, yahoo_workers,
+)
+from . import price_cache, price_matrix
 
 
 __all__ = (
     "Fund",
     "FundDividendHistory",
     "FundPriceHistory",
+    "FundPriceCalendar",
+    "Provider_exception",
+    "load_all_history",
 )
 
 
@@ -25,76 +30,226 @@ __all__ = (
 # These are not tied to users.
 
 
-class Yahoo_exception(Exception):
-    def response(self):
-        r = HttpResponse(self.args[0])
-        r.status_code = 503
-        return r
-
-
 One_day = timedelta(days=1)
 One_week = timedelta(weeks=1)
 
-def yahoo_period(d, as_end_date=False):
-    r'''Yahoo uses standard Unix seconds since the epoch for its periods.
 
-    If `as_end_date` is False, returns midnight UTC on the morning of day `d`.
-    Otherwise, returns midnight UTC at the end of day `d`.
+def history_batch_size():
+    r'''Returns the number of rows inserted at a time by the history loaders.
 
-    `d` must be a Python date object.
+    This is set by HISTORY_BATCH_SIZE in settings.py.
     '''
-    if as_end_date:
-        d += One_day
-    return calendar.timegm(d.timetuple())
-
-def yahoo_url(ticker, events, start_date=None, end_date=None):
-    r'''Returns the URL to query Yahoo for fund history.
+    return getattr(settings, 'HISTORY_BATCH_SIZE', 1000)
 
-    `start_date` is the first day to include in the data (defaults to
-    the beginning of time).
 
-    `end_date` is the last day to include in the data (defaults to yesterday).
+def bulk_insert(model, rows, batch_size=None):
+    r'''Inserts `rows` (unsaved `model` objects) in batches of `batch_size`.
 
-    This asserts that start_date <= end_date, and end_date < today.
+    Rows that conflict with rows already in the table (or earlier in
+    `rows`) are ignored.  The `model` must be unique by `fund` and `date`.
 
-    We don't need adjusted close data from Yahoo.
+    Returns the number of rows actually inserted.
     '''
-    if start_date is None:
-        start_date = date(1970, 1, 1)
-        print("Defaulting start_date to", start_date)
-    period1 = yahoo_period(start_date, as_end_date=False)
-    print("start_date is", start_date, "period1 is", period1)
-    if end_date is None:
-        # default to yesterday
-        end_date = date.today() - One_day
-    period2 = yahoo_period(end_date, as_end_date=True)
-    print("end_date is", end_date, "period2 is", period2)
-
-    assert period1 <= period2, \
-           f"yahoo_url: start_date, {start_date}, must be <= end_date, " \
-             f"{end_date}"
-
-    assert end_date < date.today(), \
-           f"yahoo_url: end_date, {end_date}, must be < today"
-
-    url = f"https://query1.finance.yahoo.com/v7/finance/download/{ticker}" \
-          f"?period1={period1}&period2={period2}&interval=1d&events={events}"
-    #print("yahoo_url:", url)
-    return url
-
-def get_yahoo(ticker, events, start_date=None, end_date=None):
-    url = yahoo_url(ticker, events, start_date=start_date, end_date=end_date)
-    return requests.get(url, headers={'user-agent': 'Mozilla'})
-
-
-def todate(s):
-    r'''This converts a date downloaded from Yahoo into a Python date object.
-
-    The Yahoo format is: YYYY-MM-DD
-
-    Note that this is different than Vanguard's format (see models.py)!
+    if batch_size is None:
+        batch_size = history_batch_size()
+
+    def insert(batch):
+        # bulk_create doesn't say which rows were ignored, so look up which
+        # of the batch's (fund_id, date) keys are already there.
+        keys = {(row.fund_id, row.date) for row in batch}
+        dates = [key[1] for key in keys]
+        loaded = set(model.objects
+                          .filter(fund_id__in={key[0] for key in keys},
+                                  date__range=(min(dates), max(dates)))
+                          .values_list('fund_id', 'date'))
+        model.objects.bulk_create(batch, ignore_conflicts=True)
+        return len(keys - loaded)
+
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += insert(batch)
+            batch = []
+    if batch:
+        count += insert(batch)
+    return count
+
+
+# The FundPriceHistory/FundPriceCalendar fields carried into the calendar.
+Calendar_fields = ('date', 'close', 'peak_close', 'peak_date', 'trough_close',
+                   'trough_date')
+
+def refresh_calendar(price_model, calendar_model, fund_id, through=None,
+                     since=None):
+    r'''Brings the FundPriceCalendar up to date for `fund_id`.
+
+    The calendar is filled in through `through` (default yesterday), or the
+    last price, if later.  Only the days after the last price already in the
+    calendar (which may have been carried forward before) are redone.  If
+    prices before that have been changed, pass the first date changed as
+    `since` to redo the calendar from there.
+
+    Returns the first date redone, or None if nothing changed.
     '''
-    return datetime.strptime(s, "%Y-%m-%d").date()
+    if through is None:
+        through = date.today() - One_day
+    calendar = calendar_model.objects.filter(fund_id=fund_id)
+    real_rows = calendar.filter(carried_forward=False)
+    if since is not None:
+        real_rows = real_rows.filter(date__lt=since)
+    last = real_rows.order_by('-date').values_list(*Calendar_fields).first()
+    prices = price_model.objects.filter(fund_id=fund_id)
+    if last is not None:
+        prices = prices.filter(date__gt=last[0])
+    prices = list(prices.order_by('date').values_list(*Calendar_fields))
+    if not prices:
+        if last is None:
+            if since is not None:
+                calendar.delete()
+            return None
+        end = calendar.order_by('-date').values_list('date', flat=True) \
+                      .first()
+        if since is None and end >= through:
+            return None
+    through = max(through, prices[-1][0] if prices else last[0])
+
+    def rows():
+        prev = last
+        day = None if last is None else last[0] + One_day
+        for price in prices:
+            if day is not None:
+                while day < price[0]:
+                    yield calendar_model(fund_id=fund_id, carried_forward=True,
+                                         **dict(zip(Calendar_fields,
+                                                    (day,) + prev[1:])))
+                    day += One_day
+            yield calendar_model(fund_id=fund_id, carried_forward=False,
+                                 **dict(zip(Calendar_fields, price)))
+            prev = price
+            day = price[0] + One_day
+        while day <= through:
+            yield calendar_model(fund_id=fund_id, carried_forward=True,
+                                 **dict(zip(Calendar_fields,
+                                            (day,) + prev[1:])))
+            day += One_day
+
+    if last is None:
+        first_date = prices[0][0]
+        calendar.delete()
+    else:
+        first_date = last[0] + One_day
+        calendar.filter(date__gte=first_date).delete()
+    count = bulk_insert(calendar_model, rows())
+    print(f"{fund_id}: price calendar redone from {first_date}, "
+            f"{count} days")
+    return first_date
+
+
+# The number of batches fetched ahead of loading them, per worker.
+Queued_batches = 2
+
+def load_all_history(funds, workers=None):
+    r'''Brings the history up to date for all `funds` concurrently.
+
+    This is Fund.load_history for each fund, but the provider requests are
+    run `workers` at a time (see `yahoo_workers`) over the shared
+    yahoo_session.
+    Only this thread uses the database: it reads where each fund's history
+    leaves off, then writes the rows as they arrive, from whichever fund
+    they come.  The rows are handed over in batches (see
+    `history_batch_size`) through one queue, with only `Queued_batches` per
+    worker waiting, so the responses are still streamed.
+
+    Each batch is written in its own transaction.  A fund that fails,
+    whether getting, reading or loading its rows, has the rows already
+    written for it deleted again (they are all after where its history
+    left off), and the rest carry on.
+
+    Returns total_dividend_rows, total_price_rows, error_funds where
+    `error_funds` is a list of the tickers that failed.
+    '''
+    if workers is None:
+        workers = yahoo_workers()
+    batch_size = history_batch_size()
+    yahoo_session()   # create it before the threads need it
+    rows_queue = queue.Queue(Queued_batches * workers)
+
+    def fetch(fund, dividend_rows, price_rows):
+        # Puts fund, model, batch on the rows_queue for each batch, then
+        # fund, None, None, or fund, None, the exception.
+        try:
+            for model, rows in ((FundDividendHistory, dividend_rows),
+                                (FundPriceHistory, price_rows)):
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        rows_queue.put((fund, model, batch))
+                        batch = []
+                if batch:
+                    rows_queue.put((fund, model, batch))
+            rows_queue.put((fund, None, None))
+        except Exception as e:
+            rows_queue.put((fund, None, e))
+
+    last_dates = {}   # {ticker: {model: last date loaded before}}
+    counts = {}       # {ticker: {model: rows loaded}}
+    errors = set()
+
+    def failed(fund, e):
+        print(f"{fund}: {e!r}")
+        errors.add(fund.ticker)
+        with transaction.atomic():
+            for model, last_date in last_dates[fund.ticker].items():
+                new_rows = model.objects.filter(fund=fund)
+                if last_date is not None:
+                    new_rows = new_rows.filter(date__gt=last_date)
+                new_rows.delete()
+
+    loaded = []
+    with ThreadPoolExecutor(workers) as pool:
+        for fund in funds:
+            last_dates[fund.ticker] = {
+              model: model.objects.filter(fund=fund)
+                                  .aggregate(last=models.Max('date'))['last']
+              for model in (FundDividendHistory, FundPriceHistory)}
+            counts[fund.ticker] = {FundDividendHistory: 0,
+                                   FundPriceHistory: 0}
+            pool.submit(fetch, fund, *fund.history_rows())
+        fetching = len(last_dates)
+        while fetching:
+            fund, model, item = rows_queue.get()
+            if model is None:
+                fetching -= 1
+            if fund.ticker in errors:
+                continue       # let its fetch finish
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                with transaction.atomic():
+                    if model is not None:
+                        counts[fund.ticker][model] += \
+                          bulk_insert(model, item, batch_size)
+                    else:
+                        FundPriceCalendar.refresh(fund.ticker)
+            except Exception as e:
+                failed(fund, e)
+                continue
+            if model is None:
+                price_cache.prices_added(fund.ticker)
+                loaded.append(fund.ticker)
+                print(f"{fund}: "
+                        f"{counts[fund.ticker][FundDividendHistory]} "
+                        f"dividends loaded, "
+                        f"{counts[fund.ticker][FundPriceHistory]} "
+                        f"prices loaded.")
+    if loaded:
+        transaction.on_commit(lambda: price_matrix.update(loaded))
+    return (sum(counts[ticker][FundDividendHistory] for ticker in loaded),
+            sum(counts[ticker][FundPriceHistory] for ticker in loaded),
+            [fund.ticker for fund in funds if fund.ticker in errors])
 
 
 class Fund(models.Model):
@@ -105,22 +260,19 @@ class Fund(models.Model):
     def __str__(self):
         return self.ticker
 
-    def get_price(self, date, first_date=None):
+    def get_price(self, date):
         r'''Returns the Fund's closing price on `date`.
+
+        If there is no price on `date`, the last price before it is used.
         '''
         if self.money_market:
             return 1.0
-        try:
-            return FundPriceHistory.objects.get(fund=self, date=date).close
-        except FundPriceHistory.DoesNotExist:
-            #print(f"get_price({self.ticker}, {date}) does not exist")
-            if first_date is None:
-                first_date = FundPriceHistory.objects.filter(fund=self) \
-                                                     .earliest().date
-            if date < first_date:
-                print("No price history for", date, "first_date", first_date)
-                raise
-            return self.get_price(date - One_day, first_date)
+        fph = price_cache.get(self.ticker).as_of(date)
+        if fph is None:
+            print("No price history for", self.ticker, "on", date)
+            raise FundPriceHistory.DoesNotExist(
+                    f"No price history for {self.ticker} on {date}")
+        return fph.close
 
     @transaction.atomic
     def load_history(self):
@@ -133,7 +285,7 @@ class Fund(models.Model):
         return dividend_rows, price_rows
 
     def load_dividends(self):
-        r'''Brings FundDividendHistory up to date from yahoo.
+        r'''Brings FundDividendHistory up to date from the provider.
 
         Returns the number of rows added.
         '''
@@ -143,7 +295,7 @@ class Fund(models.Model):
         return FundDividendHistory.load_dividends(self.ticker)
 
     def load_prices(self):
-        r'''Brings FundPriceHistory up to date from yahoo.
+        r'''Brings FundPriceHistory up to date from the provider.
 
         Returns the number of rows added.
         '''
@@ -151,6 +303,57 @@ class Fund(models.Model):
             return 0
         return FundPriceHistory.load_prices(self)
 
+    @transaction.atomic
+    def reload_prices(self, from_date):
+        r'''Reloads FundPriceHistory from `from_date` on from the provider.
+
+        Use this when the provider has corrected its prices.  See
+        FundPriceHistory.reload_prices.
+
+        Returns the number of rows loaded.
+        '''
+        if self.money_market:
+            return 0
+        return FundPriceHistory.reload_prices(self, from_date)
+
+    @transaction.atomic
+    def backfill_prices(self, start_date, end_date=None):
+        r'''Loads FundPriceHistory from `start_date` through `end_date`.
+
+        These may be before the prices already loaded, or replace some of
+        them.  `end_date` defaults to the day before the first price already
+        loaded (or yesterday, if there are none).  See
+        FundPriceHistory.upsert_prices.
+
+        Returns the number of rows added or replaced.
+        '''
+        if self.money_market:
+            return 0
+        if end_date is None:
+            first_date = FundPriceHistory.objects.filter(fund=self) \
+                                                 .order_by('date') \
+                                                 .values_list('date',
+                                                              flat=True) \
+                                                 .first()
+            if first_date is None:
+                end_date = date.today() - One_day
+            else:
+                end_date = first_date - One_day
+        return FundPriceHistory.upsert_prices(
+                 self,
+                 takewhile(lambda row: row[0] <= end_date,
+                           get_provider().prices(self.ticker, start_date)))
+
+    def history_rows(self):
+        r'''Returns iterables of the new dividend_rows, price_rows.
+
+        See FundDividendHistory.dividend_rows and FundPriceHistory.price_rows.
+        '''
+        if self.money_market:
+            return (), ()
+        return (FundDividendHistory.dividend_rows(self.ticker),
+                FundPriceHistory.price_rows(self))
+
 
 class FundDividendHistory(models.Model):
     r''' Provided by Yahoo, but not yet needed...
@@ -161,42 +364,50 @@ class FundDividendHistory(models.Model):
     adj_shares = models.FloatField(null=True)  # after reinvesting dividends
 
     @classmethod
-    def load_dividends(cls, ticker):
-        r'''Brings FundDividendHistory up to date from yahoo.
+    def load_dividends(cls, ticker, batch_size=None):
+        r'''Brings FundDividendHistory up to date from the provider.
+
+        The response is parsed as it arrives and inserted in batches of
+        `batch_size` (see `history_batch_size`).
 
         Returns the number of rows added.
         '''
+        return bulk_insert(cls, cls.dividend_rows(ticker), batch_size)
+
+    @classmethod
+    def dividend_rows(cls, ticker):
+        r'''Returns an iterable of the new FundDividendHistory rows (unsaved).
+
+        The database is read here, but the rows are only fetched from the
+        provider as they are iterated, so that may be done in another thread.
+        '''
         try:
             last_date = cls.objects.filter(fund_id=ticker).latest().date
             print(f"{ticker} last dividend recorded is on", last_date)
-            r = get_yahoo(ticker, 'div', last_date + One_day)
+            start_date = last_date + One_day
         except FundDividendHistory.DoesNotExist:
             last_date = date(1,1,1)
             print(f"{ticker} got DoesNotExist looking for last dividend "
                     "recorded")
-            r = get_yahoo(ticker, 'div')
-        if r.status_code != 200:
-            raise Yahoo_exception(
-                    f"Bad status code from yahoo for {ticker} dividends: "
-                      f"{r.status_code}")
-        if r.headers['content-type'].split(';')[0] != 'text/csv':
-            raise Yahoo_exception(
-                    f"Expected text/csv from yahoo for {ticker} dividends, "
-                      f"got {r.headers['content-type']}")
-        rows = 0
-        for row in csv.DictReader(StringIO(r.text)):
-            #print(row)
-            row_date = todate(row['Date'])
+            start_date = None
+        return cls.fetch_dividends(ticker, start_date, last_date)
+
+    @classmethod
+    def fetch_dividends(cls, ticker, start_date, last_date):
+        r'''Generates the FundDividendHistory rows after `last_date`.
+
+        These come from the market-data provider (see providers.py).
+        '''
+        for row_date, dividends in get_provider().dividends(ticker,
+                                                            start_date):
             if row_date > last_date:
-                cls(fund_id=ticker,
-                    date=row_date,
-                    dividends=float(row['Dividends']),
-                ).save()
-                rows += 1
+                yield cls(fund_id=ticker,
+                          date=row_date,
+                          dividends=dividends,
+                )
             else:
-                print(f"Got {row_date} from Yahoo for {ticker} dividends, "
-                        f"expected > {last_date} -- IGNORED")
-        return rows
+                print(f"Got {row_date} from the provider for {ticker} "
+                        f"dividends, expected > {last_date} -- IGNORED")
 
     class Meta:
         constraints = [
@@ -235,32 +446,188 @@ class FundPriceHistory(models.Model):
     @classmethod
     def share_prices(cls, tickers, date):
         r'''Returns {ticker: FundPriceHistory} for all `tickers` on `date`.
-        '''
-        tickers = list(tickers)
-        def get_dict(add_cash=False):
-            rows = cls.objects.filter(fund_id__in=tickers,
-                                      date__range=(date - One_week, date)) \
-                              .order_by('fund_id', '-date').all()
-            ans = {fund_id: next(fph)
-                   for fund_id, fph
-                    in groupby(rows, key=attrgetter('fund_id'))}
-            if add_cash:
-                ans['VMFXX'] = FundPriceHistory(fund_id='VMFXX', date=date,
-                                                close=1.0, peak_close=1.0,
-                                                peak_date=date)
-            return ans
 
+        These are the latest closes within a week before `date`, from the
+        price_cache.  Tickers without one are left out.  The week is counted
+        from the close itself, not from the calendar day that carries it
+        forward, so a fund that stopped trading has no price.
+        '''
+        ans = {}
+        for ticker in sorted(tickers):
+            if ticker != 'VMFXX':
+                fph = price_cache.get(ticker).as_of(date)
+                if fph is not None and fph.date >= date - One_week:
+                    ans[ticker] = fph
         if 'VMFXX' in tickers:
-            tickers.remove('VMFXX')
-            return get_dict(add_cash=True)
-        return get_dict(add_cash=False)
+            ans['VMFXX'] = FundPriceHistory(fund_id='VMFXX', date=date,
+                                            close=1.0, peak_close=1.0,
+                                            peak_date=date)
+        return ans
 
     @classmethod
-    def load_prices(cls, fund):
-        r'''Brings FundPriceHistory up to date from yahoo.
+    def load_prices(cls, fund, batch_size=None):
+        r'''Brings FundPriceHistory up to date from the provider.
+
+        The response is parsed as it arrives, calculating the running
+        peak/trough as it goes, and inserted in batches of `batch_size` (see
+        `history_batch_size`).  The FundPriceCalendar is then refreshed, and
+        the price_matrix once this commits.
 
         Returns the number of rows added.
         '''
+        count = bulk_insert(cls, cls.price_rows(fund), batch_size)
+        FundPriceCalendar.refresh(fund.ticker)
+        price_cache.prices_added(fund.ticker)
+        transaction.on_commit(lambda: price_matrix.update([fund.ticker]))
+        return count
+
+    @classmethod
+    def reload_prices(cls, fund, from_date, batch_size=None):
+        r'''Replaces the FundPriceHistory from `from_date` on.
+
+        The prices from `from_date` on are deleted and loaded again from the
+        provider.  Then everything that depends on them is brought up to date
+        from `from_date` (see `corrected`).
+
+        Returns the number of rows loaded.
+        '''
+        cls.objects.filter(fund=fund, date__gte=from_date).delete()
+        count = bulk_insert(cls, cls.price_rows(fund), batch_size)
+        cls.corrected(fund, from_date)
+        return count
+
+    @classmethod
+    def upsert_prices(cls, fund, rows, batch_size=None):
+        r'''Adds or replaces the closes in `rows`, at any dates.
+
+        `rows` are date, close, in any order.  The last close given for a
+        date is used.  Rows with a close of None are ignored.  The
+        peaks/troughs are then recalculated from the first date given (see
+        `recompute_peaks`), and everything that depends on the prices is
+        brought up to date (see `corrected`).
+
+        Returns the number of rows added or replaced.
+        '''
+        closes = {row_date: close
+                  for row_date, close in rows
+                   if close is not None}
+        if not closes:
+            return 0
+        from_date = min(closes)
+
+        updates = []
+        for row in cls.objects.filter(fund=fund,
+                                      date__range=(from_date, max(closes))) \
+                              .only('id', 'date', 'close'):
+            close = closes.pop(row.date, None)
+            if close is not None and close != row.close:
+                row.close = close
+                updates.append(row)
+        cls.objects.bulk_update(updates, ['close'],
+                                batch_size=batch_size or history_batch_size())
+
+        # The peaks/troughs are filled in by recompute_peaks.
+        count = bulk_insert(cls,
+                            (cls(fund=fund, date=row_date, close=close,
+                                 peak_close=close, peak_date=row_date)
+                             for row_date, close in sorted(closes.items())),
+                            batch_size)
+        print(f"{fund}: {len(updates)} closes replaced, {count} added, "
+                f"from {from_date}")
+
+        cls.recompute_peaks(fund, from_date, batch_size)
+        cls.corrected(fund, from_date)
+        return len(updates) + count
+
+    @classmethod
+    def recompute_peaks(cls, fund, from_date=None, batch_size=None):
+        r'''Recalculates the peaks/troughs from `from_date` on.
+
+        `from_date` defaults to the first close.  The peak/trough carries on
+        from the close before `from_date`.  This is done for all of the
+        closes at once (see vector_prices.py), and only the rows that change
+        are written.
+
+        This doesn't update anything that depends on the prices (see
+        `corrected`).
+
+        Returns the first date changed, or None.
+        '''
+        # NumPy is only needed for this.
+        from . import vector_prices
+
+        prices = cls.objects.filter(fund=fund)
+        peak_close, peak_date, trough_close, trough_date = 0.0, None, None, None
+        if from_date is not None:
+            prev = prices.filter(date__lt=from_date) \
+                         .order_by('-date') \
+                         .values_list('peak_close', 'peak_date',
+                                      'trough_close', 'trough_date') \
+                         .first()
+            if prev is not None:
+                peak_close, peak_date, trough_close, trough_date = prev
+            prices = prices.filter(date__gte=from_date)
+        rows = list(prices.order_by('date')
+                          .values_list('id', 'date', 'close', 'peak_close',
+                                       'peak_date', 'trough_close',
+                                       'trough_date'))
+        if not rows:
+            return None
+
+        peak_closes, peak_days, trough_closes, trough_days = \
+          vector_prices.running_peaks(
+            [row[1].toordinal() for row in rows],
+            [row[2] for row in rows],
+            peak_close,
+            0 if peak_date is None else peak_date.toordinal(),
+            math.nan if trough_close is None else trough_close,
+            0 if trough_date is None else trough_date.toordinal())
+
+        changed = []
+        for row, new_peak_close, peak_day, new_trough_close, trough_day \
+         in zip(rows, peak_closes.tolist(), peak_days.tolist(),
+                trough_closes.tolist(), trough_days.tolist()):
+            peaks = (new_peak_close, date.fromordinal(peak_day),
+                     None if math.isnan(new_trough_close)
+                          else new_trough_close,
+                     date.fromordinal(trough_day) if trough_day else None)
+            if peaks != row[3:]:
+                changed.append(cls(id=row[0], fund=fund, date=row[1],
+                                   close=row[2],
+                                   **dict(zip(Calendar_fields[2:], peaks))))
+        cls.objects.bulk_update(changed, Calendar_fields[2:],
+                                batch_size=batch_size or history_batch_size())
+        if not changed:
+            return None
+        print(f"{fund}: {len(changed)} peaks/troughs recalculated from "
+                f"{changed[0].date}")
+        return changed[0].date
+
+    @classmethod
+    def corrected(cls, fund, from_date):
+        r'''Brings the things that depend on `fund`'s prices up to date.
+
+        This is called after the prices from `from_date` on have been
+        changed.  The FundPriceCalendar is redone from `from_date`, the
+        price_cache and price_matrix are updated, and the shares holding
+        `fund` are marked as out of date from `from_date` (see DirtyShares),
+        so that the next AccountShares.update reprices just those.
+        '''
+        # Avoid a circular import.
+        from .models import DirtyShares
+
+        FundPriceCalendar.refresh(fund.ticker, since=from_date)
+        price_cache.invalidate(fund.ticker)
+        transaction.on_commit(lambda: price_matrix.update([fund.ticker]))
+        DirtyShares.mark_fund(fund, from_date)
+
+    @classmethod
+    def price_rows(cls, fund):
+        r'''Returns an iterable of the new FundPriceHistory rows (unsaved).
+
+        The database is read here, but the rows are only fetched from the
+        provider as they are iterated, so that may be done in another thread.
+        '''
         try:
             latest = cls.objects.filter(fund=fund).latest()
             last_date = latest.date
@@ -269,45 +636,41 @@ class FundPriceHistory(models.Model):
             if start_date >= date.today():
                 print(f"Skipping {fund}, last date is {last_date} -- "
                         "up to date!")
-                return 0
-            peak_close = latest.peak_close
-            peak_date = latest.peak_date
-            trough_close = latest.trough_close
-            trough_date = latest.trough_date
-            r = get_yahoo(fund.ticker, 'history', start_date)
+                return ()
+            return cls.fetch_prices(fund, start_date, last_date,
+                                    latest.peak_close, latest.peak_date,
+                                    latest.trough_close, latest.trough_date)
         except cls.DoesNotExist:
-            last_date = date(1,1,1)
             print(f"{fund.ticker} got DoesNotExist looking for last close "
                     "recorded")
-            peak_close = 0
-            peak_date = None
-            trough_close = None
-            trough_date = None
-            r = get_yahoo(fund.ticker, 'history')
-        if r.status_code != 200:
-            print(f"Bad status code from Yahoo {r.status_code} "
-                    f"for {fund.ticker} prices, "
-                    f"content-type {r.headers['content-type']}")
-            print(r.text)
-            raise Yahoo_exception(
-                    f"Bad status code from yahoo for {fund.ticker} prices: "
-                      f"{r.status_code}")
-        if r.headers['content-type'].split(';')[0] != 'text/csv':
-            raise Yahoo_exception(
-                    f"Expected text/csv from yahoo for {fund.ticker} prices, "
-                      f"got {r.headers['content-type']}")
-        rows = 0
-        for row in sorted(csv.DictReader(StringIO(r.text)),
-                          key=itemgetter('Date')):
-            #print(row)
-            row_date = todate(row['Date'])
-            assert row_date > last_date, \
-                   f"Got {row_date} from Yahoo for {fund.ticker} prices, " \
-                     f"expected > {last_date}"
-            if row['Close'] == 'null':
-                print(f"{fund.ticker} has null Close on {row_date} -- ignored")
+            return cls.fetch_prices(fund, None, date(1,1,1),
+                                    0, None, None, None)
+
+    @classmethod
+    def fetch_prices(cls, fund, start_date, last_date,
+                     peak_close, peak_date, trough_close, trough_date):
+        r'''Generates the FundPriceHistory rows after `last_date`.
+
+        These come from the market-data provider (see providers.py).  The
+        peak/trough continue on from those passed in.  The rows must come in
+        date order.  Rows that aren't later than `last_date` are already
+        loaded, and repeats of the previous row's date (which Yahoo sometimes
+        sends) are ignored.  Any other row out of order raises
+        Provider_exception, rather than leaving a gap in the prices.
+        '''
+        prev_date = last_date
+        for row_date, close in get_provider().prices(fund.ticker, start_date):
+            if row_date <= last_date or row_date == prev_date:
+                print(f"Got {row_date} from the provider for {fund.ticker} "
+                        f"prices, expected > {prev_date} -- IGNORED")
+            elif row_date < prev_date:
+                raise Provider_exception(
+                        f"Got {row_date} from the provider for {fund.ticker} "
+                          f"prices after {prev_date}, out of order")
+            elif close is None:
+                print(f"{fund.ticker} has null Close on {row_date} "
+                        "-- ignored")
             else:
-                close = float(row['Close'])
                 if close > peak_close:
                     peak_close = close
                     peak_date = row_date
@@ -316,14 +679,11 @@ class FundPriceHistory(models.Model):
                 elif trough_close is None or close < trough_close:
                     trough_close = close
                     trough_date = row_date
-                fph = cls(fund=fund, date=row_date, close=close,
+                yield cls(fund=fund, date=row_date, close=close,
                           peak_close=peak_close, peak_date=peak_date,
-                          trough_close=trough_close, trough_date=trough_date)
-                #print("inserting", fund, row_date)
-                fph.save()
-                rows += 1
-                last_date = row_date  # we're seeing duplicate dates from yahoo!
-        return rows
+                          trough_close=trough_close,
+                          trough_date=trough_date)
+                prev_date = row_date
 
     class Meta:
         constraints = [
@@ -333,3 +693,40 @@ class FundPriceHistory(models.Model):
         get_latest_by = 'date'
         ordering = ['-date']
 
+
+class FundPriceCalendar(models.Model):
+    r'''FundPriceHistory filled in for every calendar day.
+
+    FundPriceHistory only has the trading days.  This has a row for every day
+    from the fund's first price through the day before it was last refreshed,
+    carrying the last close (and its peak/trough) forward over the days
+    without one.  These filled-in rows are marked `carried_forward`.  So the
+    price as of any date is an equality lookup on (fund, date), no matter how
+    long the market was closed.
+
+    The price loaders keep this up to date (see `refresh`).  The
+    price_cache is loaded from here.
+    '''
+    fund = models.ForeignKey(Fund, on_delete=models.CASCADE)
+    date = models.DateField()
+    close = models.FloatField()
+    peak_close = models.FloatField()
+    peak_date = models.DateField()
+    trough_close = models.FloatField(null=True)
+    trough_date = models.DateField(null=True)
+    carried_forward = models.BooleanField()
+
+    @classmethod
+    def refresh(cls, ticker, through=None, since=None):
+        r'''Brings the calendar up to date for `ticker`.
+
+        See `refresh_calendar`.
+        '''
+        return refresh_calendar(FundPriceHistory, cls, ticker, through, since)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['fund', 'date'],
+                                    name='unique_fundcalendar_by_date'),
+        ]
+        get_latest_by = 'date'
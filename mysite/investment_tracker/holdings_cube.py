@@ -0,0 +1,475 @@
+# holdings_cube.py
+
+r'''In-memory cube of the shares in each account's funds on each day.
+
+The cube has an account axis, a fund axis and a date axis, with a day for
+every date from the first shares loaded through the last.  `shares` and
+`balances` are NumPy arrays indexed [account, fund, day].  So questions like
+"all accounts on one date" or "one fund over ten years" are slices of the
+arrays, and their totals are NumPy reductions, rather than walks over the
+AccountShares rows.
+
+The cube is loaded from AccountShares, or, with the 'intervals'
+shares_storage, from AccountHoldings with the closes from the price_cache.
+
+Use `get` to get the cube.  The first `get` loads it all.  After that, each
+`get` checks the accounts' shares dates (one query) and loads:
+
+  * the new days of the accounts whose shares have been extended (as
+    update_shares does after an import), and
+
+  * all of the days of the accounts whose shares have been dropped or
+    restarted.
+
+Shares changed in place (see DirtyShares.rebuild) are reported by the
+models.shares_changed signal, and reloaded on the next `get`.  Only the
+changes made in this process are seen this way.  Use `invalidate` to drop the
+whole cube.
+
+Dates are carried in the arrays as ordinals (see date.toordinal).
+
+This requires numpy.
+'''
+
+import threading
+from datetime import date
+
+import numpy as np
+
+from django.dispatch import receiver
+
+from . import models, price_cache
+from .vector_shares import price_series
+
+
+def fund_order(ticker):
+    r'''Sort key for the fund axis: by ticker, with VMFXX last.
+
+    This is the order that AccountShares.priced puts each account's funds in.
+    '''
+    return ticker == 'VMFXX', ticker
+
+
+class holdings_cube:
+    r'''The shares and balances of each account's funds on each day.
+
+    `account_ids` (sorted) and `tickers` (see `fund_order`) are the account
+    and fund axes.  `start` is the ordinal of the first day on the date axis.
+    `ranges` is {account_id: (shares_start_date, shares_end_date)} for the
+    shares loaded.  The days outside of an account's range are all 0.
+    '''
+    def __init__(self):
+        self.account_ids = []
+        self.tickers = []
+        self.start = None
+        self.shares = np.zeros((0, 0, 0))
+        self.balances = np.zeros((0, 0, 0))
+        self.money_markets = np.zeros(0, dtype=bool)   # by fund
+        self.ranges = {}
+        self.account_index = {}
+        self.fund_index = {}
+
+    @property
+    def num_days(self):
+        return self.shares.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.shares.nbytes + self.balances.nbytes
+
+    def days(self, lo=0, hi=None):
+        r'''Returns the ordinals of the days from index `lo` up to `hi`.
+        '''
+        if self.start is None:
+            return np.zeros(0, dtype=np.int64)
+        if hi is None:
+            hi = self.num_days
+        return np.arange(self.start + lo, self.start + hi)
+
+    def dates(self, lo=0, hi=None):
+        r'''Returns the dates from index `lo` up to `hi`.
+        '''
+        return [date.fromordinal(day) for day in self.days(lo, hi).tolist()]
+
+    def day_index(self, d):
+        r'''Returns the index of date `d` on the date axis, or None.
+        '''
+        if self.start is None:
+            return None
+        i = d.toordinal() - self.start
+        if not (0 <= i < self.num_days):
+            return None
+        return i
+
+    def day_range(self, start_date=None, end_date=None):
+        r'''Returns lo, hi: the index range on the date axis for the dates.
+
+        `start_date` and `end_date` (both included) default to the ends of
+        the date axis, and are clipped to it.  With no shares loaded, this
+        is 0, 0.
+        '''
+        if self.start is None:
+            return 0, 0
+        lo = 0 if start_date is None \
+               else max(start_date.toordinal() - self.start, 0)
+        hi = self.num_days if end_date is None \
+                           else min(end_date.toordinal() - self.start + 1,
+                                    self.num_days)
+        return lo, max(lo, hi)
+
+    def resize(self, account_ids=None, tickers=(), start=None, end=None):
+        r'''Changes the axes, keeping the shares already loaded.
+
+        `account_ids` (default unchanged) replaces the account axis, the
+        `tickers` are added to the fund axis, and the date axis becomes the
+        days from ordinals `start` through `end` (default unchanged).
+        '''
+        if account_ids is None:
+            account_ids = self.account_ids
+        account_ids = sorted(account_ids)
+        tickers = sorted(frozenset(self.tickers).union(tickers),
+                         key=fund_order)
+        if start is None:
+            start, end = self.start, self.start + self.num_days - 1
+        if account_ids == self.account_ids and tickers == self.tickers and \
+           start == self.start and end - start + 1 == self.num_days:
+            return
+
+        shape = len(account_ids), len(tickers), end - start + 1
+        shares = np.zeros(shape)
+        balances = np.zeros(shape)
+        account_index = {account_id: i
+                         for i, account_id in enumerate(account_ids)}
+        fund_index = {ticker: i for i, ticker in enumerate(tickers)}
+
+        # Copy the accounts and days in both the old and new axes.
+        old_accounts = [i for i, account_id in enumerate(self.account_ids)
+                          if account_id in account_index]
+        if old_accounts and self.num_days:
+            lo = max(start, self.start)
+            hi = min(end + 1, self.start + self.num_days)
+            if lo < hi:
+                new_a = np.array([account_index[self.account_ids[i]]
+                                  for i in old_accounts])[:, None]
+                new_f = np.array([fund_index[ticker]
+                                  for ticker in self.tickers],
+                                 dtype=np.int64)[None, :]
+                new_days = slice(lo - start, hi - start)
+                old_days = slice(lo - self.start, hi - self.start)
+                shares[new_a, new_f, new_days] = \
+                  self.shares[old_accounts][:, :, old_days]
+                balances[new_a, new_f, new_days] = \
+                  self.balances[old_accounts][:, :, old_days]
+
+        money_markets = frozenset(
+                          models.Fund.objects.filter(pk__in=tickers,
+                                                     money_market=True)
+                                             .values_list('ticker', flat=True))
+        self.account_ids = account_ids
+        self.tickers = tickers
+        self.start = start
+        self.shares = shares
+        self.balances = balances
+        self.money_markets = np.array([ticker == 'VMFXX' or
+                                         ticker in money_markets
+                                       for ticker in tickers],
+                                      dtype=bool)
+        self.account_index = account_index
+        self.fund_index = fund_index
+
+    def load(self, account_ids, fund_id=None, from_date=None, to_date=None):
+        r'''Reloads the shares of `account_ids` between the dates.
+
+        Only `fund_id`'s shares are reloaded, if given.  The dates (both
+        included) default to the ends of the date axis.  The accounts must
+        already be on the account axis.
+        '''
+        if not account_ids or not self.num_days:
+            return
+        lo, hi = self.day_range(from_date, to_date)
+        if lo >= hi:
+            return
+        a = np.array([self.account_index[account_id]
+                      for account_id in account_ids])
+        if fund_id is None:
+            self.shares[a, :, lo:hi] = 0.0
+            self.balances[a, :, lo:hi] = 0.0
+        elif fund_id in self.fund_index:
+            f = self.fund_index[fund_id]
+            self.shares[a, f, lo:hi] = 0.0
+            self.balances[a, f, lo:hi] = 0.0
+        from_date = date.fromordinal(self.start + lo)
+        to_date = date.fromordinal(self.start + hi - 1)
+
+        if models.shares_storage() == 'intervals':
+            self.load_holdings(account_ids, fund_id, from_date, to_date)
+        else:
+            self.load_shares(account_ids, fund_id, from_date, to_date)
+
+    def load_shares(self, account_ids, fund_id, from_date, to_date):
+        r'''Loads the AccountShares rows between the dates.
+        '''
+        query = models.AccountShares.objects \
+                                    .filter(account_id__in=account_ids,
+                                            date__range=(from_date, to_date))
+        if fund_id is not None:
+            query = query.filter(fund_id=fund_id)
+        rows = list(query.values_list('account_id', 'fund_id', 'date',
+                                      'shares', 'balance'))
+        if not rows:
+            return
+        account_col, fund_col, date_col, shares_col, balance_col = zip(*rows)
+        self.resize(tickers=frozenset(fund_col))
+        a = [self.account_index[account_id] for account_id in account_col]
+        f = [self.fund_index[ticker] for ticker in fund_col]
+        d = [day.toordinal() - self.start for day in date_col]
+        self.shares[a, f, d] = shares_col
+        self.balances[a, f, d] = balance_col
+
+    def load_holdings(self, account_ids, fund_id, from_date, to_date):
+        r'''Loads the AccountHoldings between the dates.
+
+        The balances are the shares times the closes in the price_cache,
+        looking back up to a week as AccountHoldings.fund_balances does.
+        '''
+        query = models.AccountHoldings.objects \
+                                      .filter(account_id__in=account_ids,
+                                              valid_from__lte=to_date,
+                                              valid_to__gte=from_date)
+        if fund_id is not None:
+            query = query.filter(fund_id=fund_id)
+        rows = list(query.values_list('account_id', 'fund_id', 'shares',
+                                      'valid_from', 'valid_to'))
+        if not rows:
+            return
+        self.resize(tickers=frozenset(row[1] for row in rows))
+        lo = from_date.toordinal() - self.start
+        hi = to_date.toordinal() - self.start + 1
+        for account_id, ticker, shares, valid_from, valid_to in rows:
+            self.shares[self.account_index[account_id],
+                        self.fund_index[ticker],
+                        max(valid_from.toordinal() - self.start, lo)
+                          :min(valid_to.toordinal() - self.start + 1, hi)] = \
+              shares
+
+        a = np.array([self.account_index[account_id]
+                      for account_id in account_ids])
+        for ticker in sorted(frozenset(row[1] for row in rows)):
+            f = self.fund_index[ticker]
+            shares = self.shares[a, f, lo:hi]
+            if self.money_markets[f]:
+                self.balances[a, f, lo:hi] = shares
+                continue
+            prices = price_series(ticker, price_cache.get(ticker))
+            held = shares.any(axis=0)
+            closes = np.zeros(hi - lo)
+            closes[held] = prices.closes[prices.as_of(self.days(lo, hi)[held],
+                                                      max_days=7)]
+            self.balances[a, f, lo:hi] = shares * closes
+
+    def refresh(self, changes=()):
+        r'''Brings the cube up to date with the shares in the database.
+
+        `changes` are (account_id, fund_id, from_date, to_date) for the shares
+        changed in place, with None for all accounts, all funds or the ends.
+        '''
+        ranges = {account_id: (start_date, end_date)
+                  for account_id, start_date, end_date
+                   in models.Account.objects
+                                    .filter(shares_start_date__isnull=False)
+                                    .values_list('id', 'shares_start_date',
+                                                 'shares_end_date')}
+        if any(account_id is None and fund_id is None and from_date is None
+               for account_id, fund_id, from_date, _ in changes):
+            self.__init__()
+            changes = ()
+
+        # (account_ids, fund_id, from_date, to_date) to load.
+        loads = []
+        for account_id, (start_date, end_date) in sorted(ranges.items()):
+            old = self.ranges.get(account_id)
+            if old is None or old[0] != start_date or end_date < old[1]:
+                loads.append(([account_id], None, None, None))
+            elif end_date > old[1]:
+                loads.append(([account_id], None, old[1] + models.One_day,
+                              None))
+        for account_id, fund_id, from_date, to_date in changes:
+            account_ids = sorted(ranges) if account_id is None \
+                                         else [account_id]
+            loads.append(([account_id for account_id in account_ids
+                                      if account_id in ranges],
+                          fund_id, from_date, to_date))
+
+        if ranges:
+            self.resize(ranges,
+                        start=min(start for start, _ in ranges.values())
+                                .toordinal(),
+                        end=max(end for _, end in ranges.values())
+                              .toordinal())
+        else:
+            self.__init__()
+        for account_ids, fund_id, from_date, to_date in loads:
+            self.load(account_ids, fund_id, from_date, to_date)
+        self.ranges = ranges
+
+    def slice(self, account_ids=None, tickers=None, start_date=None,
+              end_date=None):
+        r'''Returns a models.attrs of the shares and balances in the slice.
+
+        `account_ids`, `tickers` and the dates (both included) default to the
+        whole axis.  The attrs has the `account_ids`, `tickers` and `dates`
+        of the slice's axes, and its `shares` and `balances` arrays, indexed
+        [account, fund, day].
+        '''
+        if account_ids is None:
+            account_ids = self.account_ids
+        if tickers is None:
+            tickers = self.tickers
+        a = np.array([self.account_index[account_id]
+                      for account_id in account_ids], dtype=np.int64)
+        f = np.array([self.fund_index[ticker] for ticker in tickers],
+                     dtype=np.int64)
+        lo, hi = self.day_range(start_date, end_date)
+        index = np.ix_(a, f, np.arange(lo, hi))
+        return models.attrs(account_ids=list(account_ids),
+                            tickers=list(tickers),
+                            dates=self.dates(lo, hi),
+                            shares=self.shares[index],
+                            balances=self.balances[index])
+
+    def on_date(self, d):
+        r'''Returns {account_id: {ticker: (shares, balance)}} on date `d`.
+
+        Only the funds held are included.
+        '''
+        i = self.day_index(d)
+        if i is None:
+            return {}
+        shares = self.shares[:, :, i]
+        balances = self.balances[:, :, i]
+        return {account_id: {self.tickers[f]: (float(shares[a, f]),
+                                               float(balances[a, f]))
+                             for f in np.flatnonzero(shares[a]).tolist()}
+                for a, account_id in enumerate(self.account_ids)}
+
+    def balances_on_date(self, d):
+        r'''Returns {account_id: balance} on date `d`.
+        '''
+        i = self.day_index(d)
+        if i is None:
+            return {account_id: 0.0 for account_id in self.account_ids}
+        return dict(zip(self.account_ids,
+                        self.balances[:, :, i].sum(axis=1).tolist()))
+
+    def balance_history(self, account_id=None, start_date=None,
+                        end_date=None):
+        r'''Returns dates, balances for `account_id` (default all accounts).
+        '''
+        lo, hi = self.day_range(start_date, end_date)
+        balances = self.balances[:, :, lo:hi].sum(axis=1)
+        if account_id is None:
+            balances = balances.sum(axis=0)
+        else:
+            balances = balances[self.account_index[account_id]]
+        return self.dates(lo, hi), balances
+
+    def fund_history(self, ticker, account_id=None, start_date=None,
+                     end_date=None):
+        r'''Returns dates, shares, balances of `ticker` over the dates.
+
+        These are for `account_id`, or summed over all accounts.
+        '''
+        lo, hi = self.day_range(start_date, end_date)
+        f = self.fund_index.get(ticker)
+        if f is None:
+            return self.dates(lo, hi), np.zeros(hi - lo), np.zeros(hi - lo)
+        if account_id is None:
+            shares = self.shares[:, f, lo:hi].sum(axis=0)
+            balances = self.balances[:, f, lo:hi].sum(axis=0)
+        else:
+            a = self.account_index[account_id]
+            shares = self.shares[a, f, lo:hi]
+            balances = self.balances[a, f, lo:hi]
+        return self.dates(lo, hi), shares, balances
+
+    def allocation_history(self, account_id=None, start_date=None,
+                           end_date=None):
+        r'''Returns dates, the fraction of the balance in each fund.
+
+        The fractions are indexed [day, fund] (see `tickers`), for
+        `account_id` or all accounts.  Days without any balance are all 0.
+        '''
+        lo, hi = self.day_range(start_date, end_date)
+        if account_id is None:
+            balances = self.balances[:, :, lo:hi].sum(axis=0)
+        else:
+            balances = self.balances[self.account_index[account_id], :, lo:hi]
+        totals = balances.sum(axis=0)
+        fractions = np.divide(balances, totals,
+                              out=np.zeros_like(balances),
+                              where=totals != 0)
+        return self.dates(lo, hi), fractions.T
+
+    def allocation(self, d, account_id=None):
+        r'''Returns {ticker: fraction of the balance} on date `d`.
+
+        Only the funds held are included.
+        '''
+        _, fractions = self.allocation_history(account_id, d, d)
+        if not len(fractions):
+            return {}
+        return {self.tickers[f]: fraction
+                for f, fraction in enumerate(fractions[0].tolist())
+                 if fraction}
+
+    def drift(self, targets, account_id=None, start_date=None, end_date=None):
+        r'''Returns dates, how far each fund's fraction is from its target.
+
+        `targets` is {ticker: target fraction}, with 0 for the funds not
+        given.  The drifts are the allocation_history fractions less the
+        targets, indexed [day, fund].
+        '''
+        dates, fractions = self.allocation_history(account_id, start_date,
+                                                   end_date)
+        return dates, fractions - np.array([targets.get(ticker, 0.0)
+                                            for ticker in self.tickers])
+
+
+Cube = None
+Cube_lock = threading.Lock()
+
+# (account_id, fund_id, from_date, to_date) changed since the last `get`.
+Changed = []
+
+
+def get():
+    r'''Returns the holdings_cube, up to date.
+    '''
+    global Cube
+
+    with Cube_lock:
+        if Cube is None:
+            Cube = holdings_cube()
+        changes = list(Changed)
+        Changed.clear()
+        Cube.refresh(changes)
+        return Cube
+
+
+@receiver(models.shares_changed)
+def shares_changed(sender, account_id=None, fund_id=None, from_date=None,
+                   to_date=None, **kwargs):
+    r'''Notes shares changed in place, to be reloaded by the next `get`.
+    '''
+    with Cube_lock:
+        Changed.append((account_id, fund_id, from_date, to_date))
+
+
+def invalidate():
+    r'''Drops the cube, to be loaded again by the next `get`.
+    '''
+    global Cube
+
+    with Cube_lock:
+        Cube = None
+        Changed.clear()
@@ -0,0 +1,189 @@
+# ingest.py
+
+r'''Loads all of the downloads dropped into a directory in one batch.
+
+The directory is set by INGEST_DIR in settings.py.  Each file there
+matching INGEST_PATTERNS is a download from one of the brokers that
+parsers.py reads.  `ingest` loads all of them, oldest first, in one transaction, then
+moves them into INGEST_ARCHIVE_DIR.  Then it brings the shares up to date for
+just the accounts that got new transactions.
+
+The end_date of each download (the "To" date given to Vanguard) is taken
+from its filename, if that has a YYYY-MM-DD date in it.  Otherwise, it is the
+day before the file was downloaded (see help.html).
+
+Files already loaded (see ImportedFile) are just archived.  A file that
+can't be loaded (it can't be read or parsed, or has an account that isn't set
+up) is left out of the batch and moved into INGEST_REJECTS_DIR, and the rest
+are loaded without it.  Any other error fails the whole batch.
+
+Use the ingest_downloads command to do this once, or to watch the directory.
+'''
+
+import os
+import os.path
+import re
+import time
+import glob
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import transaction
+
+from . import parsers
+from .models import (
+    Account, AccountCheckpoint, AccountShares, ImportedFile, One_day, attrs,
+)
+
+
+def ingest_dir():
+    return getattr(settings, 'INGEST_DIR',
+                   os.path.expanduser(os.path.join('~', 'Downloads',
+                                                   'investment_tracker')))
+
+
+def archive_dir():
+    return getattr(settings, 'INGEST_ARCHIVE_DIR',
+                   os.path.join(ingest_dir(), 'archive'))
+
+
+def rejects_dir():
+    return getattr(settings, 'INGEST_REJECTS_DIR',
+                   os.path.join(ingest_dir(), 'rejects'))
+
+
+def ingest_patterns():
+    return getattr(settings, 'INGEST_PATTERNS', ('*.csv', '*.ofx', '*.qfx'))
+
+
+# Files modified more recently than this are still being written.
+Settle_seconds = 2
+
+# The errors that reject just the file that has them.
+Reject_exceptions = (parsers.Parser_exception, Account.DoesNotExist, OSError,
+                     UnicodeDecodeError)
+
+Date_in_filename = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+
+def download_end_date(path):
+    r'''Returns the end_date of the download in `path`.
+    '''
+    match = Date_in_filename.search(os.path.basename(path))
+    if match:
+        return date(*map(int, match.groups()))
+    return datetime.fromtimestamp(os.path.getmtime(path)).date() - One_day
+
+
+def pending_files(directory=None):
+    r'''Returns [(end_date, path)] of the downloads in `directory`.
+
+    These are in date order.
+    '''
+    if directory is None:
+        directory = ingest_dir()
+    now = time.time()
+    files = []
+    for pattern in ingest_patterns():
+        for path in glob.glob(os.path.join(directory, pattern)):
+            mtime = os.path.getmtime(path)
+            if os.path.isfile(path) and now - mtime >= Settle_seconds:
+                files.append((download_end_date(path), mtime, path))
+    files.sort()
+    return [(end_date, path) for end_date, _, path in files]
+
+
+def archive(path, fingerprint, directory=None):
+    r'''Moves `path` into `directory` (default the archive_dir).
+
+    The fingerprint goes into the archived name, so the Vanguard downloads,
+    which are all named ofxdownload.csv, don't overwrite each other.
+    '''
+    if directory is None:
+        directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(path))
+    os.replace(path,
+               os.path.join(directory, f"{stem}-{fingerprint[:12]}{ext}"))
+
+
+def ingest(directory=None, update_shares=True):
+    r'''Loads all of the pending_files in `directory` in one transaction.
+
+    Each file is loaded within its own savepoint, so a file that fails with
+    one of the Reject_exceptions is rolled back on its own, and moved into
+    the rejects_dir once the rest have been committed.  Any other exception
+    rolls back the whole batch, leaving all of the files where they are.
+
+    If `update_shares`, AccountShares.update is done afterwards for the
+    accounts that got new transactions.
+
+    Returns attrs with the number of `files` loaded, the number `skipped`
+    (already loaded), the number `rejected`, the `reasons` they were
+    rejected ({path: message}), the set of changed `accounts` and the number
+    of `new_funds`.
+    '''
+    files = pending_files(directory)
+    loaded = []     # [(path, fingerprint)]
+    rejected = []   # [(path, fingerprint)]
+    reasons = {}    # {path: message}
+    num_skipped = 0
+    account_ids = set()
+    num_new_funds = 0
+    with transaction.atomic():
+        for end_date, path in files:
+            fingerprint = None
+            try:
+                fingerprint = ImportedFile.fingerprint_file(path)
+                with transaction.atomic():
+                    with open(path, newline='') as file:
+                        ans = Account.import_csv(file, end_date, fingerprint,
+                                                 os.path.basename(path))
+            except Reject_exceptions as e:
+                reasons[path] = str(e)
+                # If it can't even be read, it's told apart by the time.
+                rejected.append((path, fingerprint or f"{time.time_ns():x}"))
+                continue
+            if ans is None:
+                num_skipped += 1
+            else:
+                trans_accts, new_funds = ans
+                account_ids.update(acct.id for acct in trans_accts)
+                num_new_funds += new_funds
+            loaded.append((path, fingerprint))
+        if account_ids:
+            AccountCheckpoint.update(
+              Account.objects.filter(pk__in=account_ids))
+
+    # Only once the transaction has committed.
+    for path, fingerprint in loaded:
+        archive(path, fingerprint)
+    for path, fingerprint in rejected:
+        archive(path, fingerprint, rejects_dir())
+
+    if update_shares and account_ids:
+        AccountShares.update(
+          accounts=Account.objects.filter(pk__in=account_ids))
+    return attrs(files=len(loaded) - num_skipped, skipped=num_skipped,
+                 rejected=len(rejected), reasons=reasons,
+                 accounts=account_ids,
+                 new_funds=num_new_funds)
+
+
+def watch(directory=None, interval=None, update_shares=True):
+    r'''Runs `ingest` whenever new downloads appear.  Never returns.
+
+    The directory is checked every `interval` seconds (INGEST_INTERVAL in
+    settings.py).  If an `ingest` fails as a whole (the files that fail are
+    just rejected), it is tried again on the next check.
+    '''
+    if interval is None:
+        interval = getattr(settings, 'INGEST_INTERVAL', 10)
+    print("ingest: watching", directory or ingest_dir())
+    while True:
+        if pending_files(directory):
+            try:
+                ingest(directory, update_shares)
+            except Exception as e:
+                print("ingest: failed --", repr(e))
+        time.sleep(interval)
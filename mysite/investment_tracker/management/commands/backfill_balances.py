@@ -0,0 +1,20 @@
+# backfill_balances.py
+
+from django.core.management.base import BaseCommand
+
+from investment_tracker import models
+
+
+class Command(BaseCommand):
+    help = "Reloads AccountBalance from the shares already loaded."
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int,
+                            help="accounts to reload (default all)")
+
+    def handle(self, *args, account_ids, **options):
+        accounts = models.Account.objects.all()
+        if account_ids:
+            accounts = accounts.filter(pk__in=account_ids)
+        count = models.AccountBalance.backfill(accounts)
+        self.stdout.write(f"{count} balances loaded.")
@@ -0,0 +1,30 @@
+# backfill_prices.py
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from investment_tracker import models
+
+
+def todate(s):
+    return datetime.strptime(s, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = "Loads (or replaces) a fund's prices over a range of dates."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ticker')
+        parser.add_argument('start_date', type=todate, help="YYYY-MM-DD")
+        parser.add_argument('end_date', type=todate, nargs='?',
+                            help="YYYY-MM-DD (default the day before the "
+                                 "first price loaded)")
+
+    def handle(self, *args, ticker, start_date, end_date, **options):
+        fund = models.Fund.objects.get(pk=ticker.upper())
+        try:
+            count = fund.backfill_prices(start_date, end_date)
+        except models.Provider_exception as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"{fund}: {count} prices loaded.")
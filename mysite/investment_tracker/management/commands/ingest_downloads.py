@@ -0,0 +1,33 @@
+# ingest_downloads.py
+
+from django.core.management.base import BaseCommand
+
+from investment_tracker import ingest
+
+
+class Command(BaseCommand):
+    help = "Loads the broker downloads in the INGEST_DIR in one batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', nargs='?',
+                            help="directory to load from (default INGEST_DIR)")
+        parser.add_argument('--watch', action='store_true',
+                            help="keep loading new downloads as they appear")
+        parser.add_argument('--interval', type=float,
+                            help="seconds between checks with --watch "
+                                 "(default INGEST_INTERVAL)")
+        parser.add_argument('--no-shares', action='store_false',
+                            dest='update_shares',
+                            help="don't update the shares afterwards")
+
+    def handle(self, *args, directory, watch, interval, update_shares,
+               **options):
+        if watch:
+            ingest.watch(directory, interval, update_shares)
+        ans = ingest.ingest(directory, update_shares)
+        for path, reason in ans.reasons.items():
+            self.stderr.write(f"rejected {path}: {reason}")
+        self.stdout.write(f"{ans.files} downloads loaded, {ans.skipped} "
+                            f"already loaded, {ans.rejected} rejected, "
+                            f"{len(ans.accounts)} accounts changed, "
+                            f"{ans.new_funds} new funds created.")
@@ -0,0 +1,29 @@
+# recompute_peaks.py
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from investment_tracker import models
+
+
+class Command(BaseCommand):
+    help = "Recalculates the FundPriceHistory peaks/troughs from the closes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('tickers', nargs='*',
+                            help="funds to recalculate (default all)")
+
+    def handle(self, *args, tickers, **options):
+        funds = models.Fund.objects.filter(money_market=False) \
+                                   .order_by('ticker')
+        if tickers:
+            funds = funds.filter(pk__in=[ticker.upper()
+                                         for ticker in tickers])
+        changed = 0
+        for fund in funds:
+            with transaction.atomic():
+                from_date = models.FundPriceHistory.recompute_peaks(fund)
+                if from_date is not None:
+                    models.FundPriceHistory.corrected(fund, from_date)
+                    changed += 1
+        self.stdout.write(f"{changed} of {len(funds)} funds changed.")
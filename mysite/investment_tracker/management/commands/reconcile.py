@@ -0,0 +1,34 @@
+# reconcile.py
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Reports the funds whose shares have drifted from the broker's."
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int,
+                            help="accounts to check (default all)")
+        parser.add_argument('--tolerance', type=float,
+                            help="in shares (default RECONCILE_TOLERANCE)")
+        parser.add_argument('--cash-tolerance', type=float,
+                            help="in dollars, for money market funds "
+                                 "(default RECONCILE_CASH_TOLERANCE)")
+
+    def handle(self, *args, account_ids, tolerance, cash_tolerance,
+               **options):
+        # NumPy is only needed for this.
+        from investment_tracker import reconcile
+
+        report = reconcile.reconcile(account_ids or None, tolerance,
+                                     cash_tolerance)
+        for drift in report.drifts:
+            self.stdout.write(
+              f"account {drift.account_id} {drift.ticker}: "
+              f"{drift.shares:.4f} shares, broker {drift.broker_shares:.4f} "
+              f"on {drift.date}; off since {drift.first_drift} "
+              f"(matched {drift.last_match}, "
+              f"first suspect trade {drift.suspect_date})")
+        self.stdout.write(f"{report.checked} balances checked, "
+                          f"{report.skipped} not loaded yet, "
+                          f"{len(report.drifts)} funds drifted.")
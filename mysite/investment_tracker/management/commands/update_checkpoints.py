@@ -0,0 +1,22 @@
+# update_checkpoints.py
+
+from django.core.management.base import BaseCommand
+
+from investment_tracker import models
+
+
+class Command(BaseCommand):
+    help = "Takes the new AccountCheckpoints from the transactions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int,
+                            help="accounts to update (default all)")
+        parser.add_argument('--reload', action='store_true',
+                            help="retake all of the checkpoints")
+
+    def handle(self, *args, account_ids, reload, **options):
+        accounts = models.Account.objects.all()
+        if account_ids:
+            accounts = accounts.filter(pk__in=account_ids)
+        count = models.AccountCheckpoint.update(accounts, reload)
+        self.stdout.write(f"{count} checkpoints taken.")
@@ -0,0 +1,19 @@
+# update_price_matrix.py
+
+from django.core.management.base import BaseCommand
+
+from investment_tracker import price_matrix
+
+
+class Command(BaseCommand):
+    help = "Writes a new version of the fund price matrix file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('tickers', nargs='*',
+                            help="funds to reread from the database "
+                                 "(default all)")
+
+    def handle(self, *args, tickers, **options):
+        version = price_matrix.write([ticker.upper() for ticker in tickers]
+                                     or None)
+        self.stdout.write(f"Price matrix version {version} written.")
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.8 on 2026-10-18 01:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0009_categorylink_tag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountHoldings',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shares', models.FloatField()),
+                ('valid_from', models.DateField()),
+                ('valid_to', models.DateField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.account')),
+                ('fund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.fund')),
+            ],
+            options={
+                'get_latest_by': 'valid_to',
+                'indexes': [models.Index(fields=['account', 'valid_to', 'valid_from'], name='account_holdings_by_date')],
+                'constraints': [models.UniqueConstraint(fields=('account', 'fund', 'valid_from'), name='unique_account_holdings_per_date')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.8 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0010_accountholdings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('balance', models.FloatField()),
+                ('cash', models.FloatField()),
+                ('invested', models.FloatField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.account')),
+            ],
+            options={
+                'get_latest_by': 'date',
+                'constraints': [models.UniqueConstraint(fields=('account', 'date'), name='unique_account_balance_per_date')],
+            },
+        ),
+    ]
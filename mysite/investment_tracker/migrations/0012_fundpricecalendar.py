@@ -0,0 +1,75 @@
+from datetime import date, timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+One_day = timedelta(days=1)
+
+# The FundPriceHistory/FundPriceCalendar fields carried into the calendar.
+Calendar_fields = ('date', 'close', 'peak_close', 'peak_date', 'trough_close',
+                   'trough_date')
+
+
+def build_calendars(apps, schema_editor):
+    r'''Fills in each fund's calendar, from its first price through yesterday.
+
+    This is what FundPriceCalendar.refresh did for a fund without a calendar
+    when this was written, copied here so that later changes to it don't
+    change this migration.
+    '''
+    Fund = apps.get_model('investment_tracker', 'Fund')
+    FundPriceHistory = apps.get_model('investment_tracker', 'FundPriceHistory')
+    FundPriceCalendar = apps.get_model('investment_tracker',
+                                       'FundPriceCalendar')
+    for fund in Fund.objects.filter(money_market=False):
+        prices = list(FundPriceHistory.objects.filter(fund_id=fund.ticker)
+                                              .order_by('date')
+                                              .values_list(*Calendar_fields))
+        if not prices:
+            continue
+        through = max(date.today() - One_day, prices[-1][0])
+
+        def rows():
+            for price, next_price in zip(prices, prices[1:] + [None]):
+                end = through if next_price is None \
+                              else next_price[0] - One_day
+                day = price[0]
+                while day <= end:
+                    yield FundPriceCalendar(
+                            fund_id=fund.ticker,
+                            carried_forward=day != price[0],
+                            **dict(zip(Calendar_fields,
+                                       (day,) + price[1:])))
+                    day += One_day
+
+        FundPriceCalendar.objects.bulk_create(rows(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0011_accountbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FundPriceCalendar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('close', models.FloatField()),
+                ('peak_close', models.FloatField()),
+                ('peak_date', models.DateField()),
+                ('trough_close', models.FloatField(null=True)),
+                ('trough_date', models.DateField(null=True)),
+                ('carried_forward', models.BooleanField()),
+                ('fund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.fund')),
+            ],
+            options={
+                'get_latest_by': 'date',
+                'constraints': [models.UniqueConstraint(fields=('fund', 'date'), name='unique_fundcalendar_by_date')],
+            },
+        ),
+        migrations.RunPython(build_calendars, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.8 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0012_fundpricecalendar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyShares',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_date', models.DateField()),
+                ('to_date', models.DateField(null=True)),
+                ('account', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.account')),
+                ('fund', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.fund')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0013_dirtyshares'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shares', models.FloatField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.account')),
+                ('fund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.fund')),
+            ],
+            options={
+                'get_latest_by': 'date',
+                'indexes': [models.Index(fields=['account', 'date'], name='account_checkpoint_by_date')],
+                'constraints': [models.UniqueConstraint(fields=('account', 'fund', 'date'), name='unique_account_checkpoint')],
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+import hashlib
+from itertools import islice
+
+from django.db import migrations, models
+
+
+# These are models.Transaction_key_fields and models.transaction_key as they
+# were when this was written, copied here so that later changes to them
+# don't change this migration.
+
+Transaction_key_fields = (
+    'account_id', 'trade_date', 'settlement_date', 'transaction_type',
+    'transaction_desc', 'investment_name', 'fund_id', 'shares', 'share_price',
+    'principal_amount', 'commission_fees', 'net_amount', 'accrued_interest',
+    'account_type',
+)
+
+def transaction_key(fields, occurrence):
+    text = '\x1f'.join(map(str, fields + (occurrence,)))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def fill_row_keys(apps, schema_editor):
+    AccountTransactionHistory = apps.get_model('investment_tracker',
+                                               'AccountTransactionHistory')
+    occurrences = {}
+    rows = AccountTransactionHistory.objects.order_by('id').iterator()
+    while True:
+        batch = list(islice(rows, 1000))
+        if not batch:
+            break
+        for trans in batch:
+            fields = tuple(getattr(trans, name)
+                           for name in Transaction_key_fields)
+            occurrence = occurrences.get(fields, 0)
+            occurrences[fields] = occurrence + 1
+            trans.row_key = transaction_key(fields, occurrence)
+        AccountTransactionHistory.objects.bulk_update(batch, ['row_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0014_accountcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('filename', models.CharField(blank=True, max_length=200)),
+                ('end_date', models.DateField()),
+                ('loaded', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='accounttransactionhistory',
+            name='row_key',
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.RunPython(fill_row_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='accounttransactionhistory',
+            constraint=models.UniqueConstraint(fields=('account', 'row_key'), name='unique_transaction_row_key'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.8 on 2026-10-18 18:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_tracker', '0015_transaction_row_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BrokerBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shares', models.FloatField()),
+                ('share_price', models.FloatField()),
+                ('balance', models.FloatField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.account')),
+                ('fund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_tracker.fund')),
+            ],
+            options={
+                'get_latest_by': 'date',
+                'constraints': [models.UniqueConstraint(fields=('account', 'fund', 'date'), name='unique_broker_balance')],
+            },
+        ),
+    ]
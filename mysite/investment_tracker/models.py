@@ -1,19 +1,99 @@
 # models.py
 
-from datetime import datetime
-from itertools import groupby
+from datetime import datetime, date, timedelta
+from itertools import groupby, islice
 from operator import attrgetter, itemgetter
-import csv
-
-from django.db import models, transaction
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import calendar
+import hashlib
+
+import django
+from django.conf import settings
+from django.db import models, transaction, connections
 from django.db.models import Q
+from django.dispatch import Signal
 
 from .plan_models import *
 from .fund_models import *
+from .fund_models import One_day, One_week
 from .hash import hash
+from . import price_cache
+from . import parsers
+from .parsers import split_csv, todate
 
 # Create your models here.
 
+# Sent with the account_id, fund_id, from_date and to_date of shares changed
+# in place, rather than added to (None for all accounts, all funds or no end).
+# The holdings_cube reloads these.
+shares_changed = Signal()
+
+def shares_storage():
+    r'''Returns how the daily shares are stored: 'daily' or 'intervals'.
+
+    This is set by SHARES_STORAGE in settings.py:
+
+      * 'daily' stores one AccountShares row per account/fund/day.
+
+      * 'intervals' stores one AccountHoldings row for each run of days over
+        which the shares in an account's fund did not change.
+
+    Switching between these requires an AccountShares.update(reload=True).
+    '''
+    return getattr(settings, 'SHARES_STORAGE', 'daily')
+
+
+def shares_engine():
+    r'''Returns how AccountShares.update calculates the daily shares.
+
+    This is set by SHARES_ENGINE in settings.py:
+
+      * 'legacy' walks each account's dates one at a time.
+
+      * 'vectorized' calculates each fund's dates as NumPy arrays (see
+        vector_shares.py).  This requires numpy.
+
+      * 'sql' has the database calculate the rows and insert them directly
+        (see sql_shares.py).  This requires SQLite.  From SQLite 3.43 on,
+        its shares may differ from the other engines' in the last bits.
+
+      * 'stream' walks the dates like 'legacy', but writes the rows in
+        batches as they are generated (see `shares_batch_size`), reading the
+        prices a fund at a time.  So its memory use doesn't grow with the
+        length of the history.
+    '''
+    return getattr(settings, 'SHARES_ENGINE', 'legacy')
+
+
+def shares_workers():
+    r'''Returns the number of processes AccountShares.update uses.
+
+    This is set by SHARES_WORKERS in settings.py.  With more than 1, the
+    accounts are calculated in parallel (one account per process at a time).
+    '''
+    return getattr(settings, 'SHARES_WORKERS', 1)
+
+
+def shares_batch_size():
+    r'''Returns how many rows the 'stream' shares engine writes at a time.
+
+    This is set by SHARES_BATCH_SIZE in settings.py.
+    '''
+    return getattr(settings, 'SHARES_BATCH_SIZE', 5000)
+
+
+def checkpoint_cadence():
+    r'''Returns how often AccountCheckpoint takes checkpoints.
+
+    This is set by CHECKPOINT_CADENCE in settings.py: 'month', 'quarter' or
+    'year'.  The checkpoints are taken at the end of each.
+
+    Changing this requires an AccountCheckpoint.update(reload=True).
+    '''
+    return getattr(settings, 'CHECKPOINT_CADENCE', 'month')
+
+
 class User(models.Model):
     name = models.CharField(max_length=15)
 
@@ -21,21 +101,6 @@ class User(models.Model):
         return self.name
 
 
-class split_csv:
-    def __init__(self, file):
-        self.file = file
-
-    def gen(self):
-        blanks = 0
-        for line in self.file:
-            if not line.strip():
-                blanks += 1
-                if blanks >= 2: break
-            else:
-                blanks = 0
-                yield line
-
-
 class Account(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=40)
@@ -65,41 +130,148 @@ class Account(models.Model):
 
     def balance_on_date(self, date):
         r'''Returns the account balance on `date`.
+
+        This comes from AccountBalance, if it has been loaded for `date`.
         '''
+        if self.shares_start_date is not None and \
+           self.shares_start_date <= date <= self.shares_end_date:
+            balance = AccountBalance.objects.filter(account=self, date=date) \
+                                            .values_list('balance', flat=True) \
+                                            .first()
+            if balance is not None:
+                return balance
         shares_by_ticker = self.shares_on_date(date)
         return sum(account_share.balance 
                    for account_share in shares_by_ticker.values())
 
+    @classmethod
+    def balances_on_dates(cls, accounts, dates):
+        r'''Returns {account_id: {date: balance}} for all `accounts` and `dates`.
+
+        These are the same as balance_on_date for each account and date, but
+        are done in a fixed number of queries, rather than one per account
+        per date.
+
+        These come from AccountBalance.  Any that haven't been loaded there
+        are summed from the shares.  Dates outside of the shares loaded are
+        summed from the AccountCheckpoints, which takes a few more queries
+        for each account that has any (see AccountCheckpoint.shares_on_dates).
+        '''
+        accounts = list(accounts)
+        dates = sorted(set(dates))
+        if not accounts or not dates:
+            return {acct.id: {date: 0 for date in dates} for acct in accounts}
+        def in_range(acct, date):
+            return acct.shares_start_date is not None and \
+                   acct.shares_start_date <= date <= acct.shares_end_date
+        balances = {(account_id, date): balance
+                    for account_id, date, balance
+                     in AccountBalance.objects
+                                      .filter(account__in=accounts,
+                                              date__in=dates)
+                                      .values_list('account_id', 'date',
+                                                   'balance')}
+        missing_accounts = [acct for acct in accounts
+                             if any(in_range(acct, date) and
+                                      (acct.id, date) not in balances
+                                    for date in dates)]
+        if missing_accounts:
+            print("balances_on_dates: AccountBalance not loaded for",
+                  missing_accounts)
+            if shares_storage() == 'intervals':
+                summed = AccountHoldings.balances_on_dates(missing_accounts,
+                                                           dates)
+            else:
+                summed = AccountShares.balances_on_dates(missing_accounts,
+                                                         dates)
+            for key, balance in summed.items():
+                balances.setdefault(key, balance)
+        for acct in accounts:
+            for date, shares_by_ticker \
+             in AccountCheckpoint.shares_on_dates(
+                  acct,
+                  [date for date in dates if not in_range(acct, date)]) \
+                                 .items():
+                balances[acct.id, date] = \
+                  sum(account_share.balance
+                      for account_share in shares_by_ticker.values())
+        return {acct.id: {date: balances.get((acct.id, date), 0)
+                          for date in dates}
+                for acct in accounts}
+
     def shares_on_date(self, date):
         r'''Returns {ticker: AccountShare} as of `date`.
+
+        Dates outside of the shares loaded by AccountShares.update are worked
+        out from the AccountCheckpoints instead.
         '''
-        if not (self.shares_start_date <= date <= self.shares_end_date):
-            return {}
+        if self.shares_start_date is None or \
+           not (self.shares_start_date <= date <= self.shares_end_date):
+            return AccountCheckpoint.shares_on_date(self, date)
+        if shares_storage() == 'intervals':
+            return AccountHoldings.shares_on_date(self, date)
         return {row.fund_id: row
                 for row
                 in AccountShares.objects.filter(account=self, date=date).all()}
 
     @staticmethod
     @transaction.atomic
-    def load_csv(file, end_date):
+    def load_csv(file, end_date, fingerprint=None, filename=''):
         r'''Loads fund transactions from Vanguard download.
 
-        Returns trans_accts, new_trans_funds.
+        `fingerprint` is the ImportedFile.fingerprint_file of the download.
+        A download that has already been loaded is skipped.
+
+        Returns trans_accts, new_trans_funds, or None if skipped.
         '''
-        split = split_csv(file)
+        loaded = Account.import_csv(file, end_date, fingerprint, filename)
+        if loaded is None:
+            return None
+        trans_accts, new_funds = loaded
+        AccountCheckpoint.update(
+          Account.objects.filter(pk__in=[acct.id for acct in trans_accts]))
+        #AccountShares.update()
+        return len(trans_accts), new_funds
 
-        accounts, num_new_funds = read_balances_csv(split.gen())
+    @staticmethod
+    def import_csv(file, end_date, fingerprint=None, filename=''):
+        r'''Does the work of load_csv, without updating the checkpoints.
+
+        The balances in the download are stored as the BrokerBalances on
+        `end_date`.
+
+        Must be called within a transaction.
+
+        Returns frozenset of accounts with transactions, number of funds
+        created, or None if skipped.
+        '''
+        if fingerprint is not None:
+            if ImportedFile.objects.filter(fingerprint=fingerprint).exists():
+                print("Account.load_csv:", filename or fingerprint,
+                      "already loaded")
+                return None
+            ImportedFile.objects.create(fingerprint=fingerprint,
+                                        filename=filename,
+                                        end_date=end_date)
+
+        download = parsers.parse(file)
+        cache = import_cache()
+
+        accounts, num_new_funds = read_balances(download.balances, cache)
+        BrokerBalance.record(accounts, end_date)
         trans_accts, new_trans_funds = \
-          AccountTransactionHistory.load_csv(split.gen(), end_date)
+          AccountTransactionHistory.load(download.transactions, end_date,
+                                         cache)
 
         # Update transaction_end_date for accounts with no new transactions
         for account, _ in accounts.values():
             if account.id not in trans_accts:
                 fresh_account = Account.objects.get(pk=account.id)
-                fresh_account.transaction_end_date = end_date
-                fresh_account.save()
-        #AccountShares.update()
-        return len(trans_accts), num_new_funds + new_trans_funds
+                if fresh_account.transaction_end_date is None or \
+                   end_date > fresh_account.transaction_end_date:
+                    fresh_account.transaction_end_date = end_date
+                    fresh_account.save()
+        return trans_accts, num_new_funds + new_trans_funds
 
     class Meta:
         constraints = [
@@ -109,14 +281,79 @@ class Account(models.Model):
         ordering = ['owner', 'name']
 
 
-def todate(s):
-    r'''Converts Vanguard date to Python date object.
+def import_batch_size():
+    r'''Returns the number of transactions inserted at a time by the imports.
+
+    This is set by IMPORT_BATCH_SIZE in settings.py.
+    '''
+    return getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+
 
-    Vanguard date format is: MM/DD/YYYY
+class import_cache:
+    r'''The Accounts and Funds looked up during one import.
 
-    Note that this is different than Yahoo's format (see fund_models.py)!
+    The Accounts are found by their hashed account numbers (see hash.py), so
+    each account number is only hashed once per import.  New Funds are held
+    until `flush_funds` creates them all with one bulk_create.
+    '''
+    def __init__(self):
+        self.hashed = None    # {hashed account_number: Account}
+        self.accounts = {}    # {account_number: Account}
+        self.funds = {fund.ticker: fund for fund in Fund.objects.all()}
+        self.new_funds = []   # not yet created
+        self.num_new_funds = 0
+
+    def account(self, account_number):
+        acct = self.accounts.get(account_number)
+        if acct is None:
+            if self.hashed is None:
+                self.hashed = {acct.account_number: acct
+                               for acct in Account.objects.all()}
+            acct = self.hashed.get(hash(account_number))
+            if acct is None:
+                raise Account.DoesNotExist(
+                        f"No Account for account number {account_number}")
+            self.accounts[account_number] = acct
+        return acct
+
+    def fund(self, ticker, name):
+        r'''Returns the Fund for `ticker`, adding a new one if necessary.
+        '''
+        fund = self.funds.get(ticker)
+        if fund is None:
+            print("Adding Fund", ticker, name)
+            fund = self.funds[ticker] = Fund(ticker=ticker, name=name)
+            self.new_funds.append(fund)
+            self.num_new_funds += 1
+        return fund
+
+    def flush_funds(self):
+        r'''Creates the new Funds added since the last flush_funds.
+        '''
+        if self.new_funds:
+            Fund.objects.bulk_create(self.new_funds)
+            self.new_funds = []
+
+
+# The AccountTransactionHistory fields identifying a transaction.
+Transaction_key_fields = (
+    'account_id', 'trade_date', 'settlement_date', 'transaction_type',
+    'transaction_desc', 'investment_name', 'fund_id', 'shares', 'share_price',
+    'principal_amount', 'commission_fees', 'net_amount', 'accrued_interest',
+    'account_type',
+)
+
+def transaction_key(fields, occurrence=0):
+    r'''Returns the AccountTransactionHistory.row_key for a transaction.
+
+    `fields` are the values of the Transaction_key_fields.  The brokers can
+    send identical transactions, so these are told apart by their `occurrence`
+    (0 for the first one in the download, 1 for the second, etc).  The same
+    transaction gets the same key in every download that has its whole trade
+    date.
     '''
-    return datetime.strptime(s, "%m/%d/%Y").date()
+    text = '\x1f'.join(map(str, fields + (occurrence,)))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
 
 
 class attrs:
@@ -124,11 +361,28 @@ class attrs:
         for k, v in kwargs.items():
             setattr(self, k, v)
 
-def read_balances_csv(file):
-    r'''Reads the current balance info for each account from Vanguard.
+def batches(iterable, size):
+    r'''Generates lists of up to `size` items from `iterable`.
+    '''
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def days_between(start_date, end_date):
+    r'''Returns a list of the dates from `start_date` through `end_date`.
+    '''
+    return [start_date + timedelta(days=i)
+            for i in range((end_date - start_date).days + 1)]
+
+def read_balances_csv(file, cache=None):
+    r'''Reads the current balance info for each account from a download.
 
     These are taken from an ofxdownload.csv file manually downloaded from
-    Vanguard.
+    Vanguard, or another download that parsers.py reads.  `cache` is the
+    import_cache to share with the rest of the import, if any.
 
     Returns {account_id: account, {ticker: attrs}}, num_new_funds where attrs
     has the following attributes:
@@ -139,35 +393,89 @@ def read_balances_csv(file):
       * share_price: the current share price
       * balance: the dollar value of these shares
     '''
-    accts = {acct.account_number: acct
-             for acct in Account.objects.all()}
-    funds = {fund.ticker: fund
-             for fund in Fund.objects.all()}
-    num_new_funds = 0
-    def lookup_fund(row):
-        nonlocal num_new_funds
-        ticker = row['Symbol']
-        if ticker not in funds:
-            name = row['Investment Name']
-            print("Adding Fund", ticker, name)
-            fund = Fund(ticker=ticker, name=name)
-            fund.save()
-            funds[ticker] = fund
-            num_new_funds += 1
-        return funds[ticker]
+    return read_balances(parsers.parse(file).balances, cache)
+
+def read_balances(balances, cache=None):
+    r'''Does read_balances_csv for the parsers.Balance records `balances`.
+    '''
+    if cache is None:
+        cache = import_cache()
+    start_new_funds = cache.num_new_funds
     ans = {}
     for account_number, rows \
-     in groupby(sorted(csv.DictReader(file), key=itemgetter('Account Number')),
-                key=itemgetter('Account Number')):
-        acct = accts[hash(account_number)]
-        tickers = {row['Symbol']: attrs(acct=acct,
-                                        fund=lookup_fund(row),
-                                        shares=float(row['Shares']),
-                                        share_price=float(row['Share Price']),
-                                        balance=float(row['Total Value']))
+     in groupby(sorted(balances, key=attrgetter('account_number')),
+                key=attrgetter('account_number')):
+        acct = cache.account(account_number)
+        tickers = {row.ticker: attrs(acct=acct,
+                                     fund=cache.fund(row.ticker,
+                                                     row.investment_name),
+                                     shares=row.shares,
+                                     share_price=row.share_price,
+                                     balance=row.balance)
                    for row in rows}
         ans[acct.id] = acct, tickers
-    return ans, num_new_funds
+    cache.flush_funds()
+    return ans, cache.num_new_funds - start_new_funds
+
+
+class ImportedFile(models.Model):
+    r'''A Vanguard download that has been loaded, by its fingerprint.
+
+    Account.load_csv skips downloads that are already here.
+    '''
+    fingerprint = models.CharField(max_length=64, unique=True)
+    filename = models.CharField(max_length=200, blank=True)
+    end_date = models.DateField()
+    loaded = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.filename} {self.fingerprint[:12]}"
+
+    @staticmethod
+    def fingerprint_file(path):
+        r'''Returns the sha256 hex digest of the contents of `path`.
+        '''
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+class BrokerBalance(models.Model):
+    r'''The shares in each account's funds as reported by the broker.
+
+    These are the balances from each download, as of its end_date.
+    reconcile.py checks the shares calculated from the transactions against
+    them.
+    '''
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    fund = models.ForeignKey('Fund', on_delete=models.CASCADE)
+    date = models.DateField()
+    shares = models.FloatField()
+    share_price = models.FloatField()
+    balance = models.FloatField()
+
+    @classmethod
+    def record(cls, accounts, date):
+        r'''Stores the balances read by read_balances as of `date`.
+
+        These replace any balances already stored for these accounts on
+        `date`.
+        '''
+        cls.objects.filter(account_id__in=list(accounts), date=date).delete()
+        cls.objects.bulk_create(
+          cls(account=acct, fund=row.fund, date=date, shares=row.shares,
+              share_price=row.share_price, balance=row.balance)
+          for acct, tickers in accounts.values()
+          for row in tickers.values())
+
+    class Meta:
+        get_latest_by = 'date'
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'fund', 'date'],
+                                    name='unique_broker_balance'),
+        ]
 
 
 class AccountTransactionHistory(models.Model):
@@ -212,103 +520,192 @@ class AccountTransactionHistory(models.Model):
     accrued_interest = models.FloatField()
     account_type = models.CharField(max_length=20)
 
+    # See transaction_key.
+    row_key = models.CharField(max_length=32, null=True)
+
     @classmethod
-    def load_csv(cls, file, end_date):
-        r'''Loads csv `file` produced by Vanguard.
+    def load_csv(cls, file, end_date, cache=None):
+        r'''Loads the transactions section of the csv `file` produced by
+        Vanguard.
+
+        See `load`.
+        '''
+        return cls.load(parsers.Vanguard_parser().transactions(file),
+                        end_date, cache)
+
+    @classmethod
+    def load(cls, transactions, end_date, cache=None):
+        r'''Loads the parsers.Transaction records `transactions`.
 
         Updates Account.transaction_start_date and Account.transaction_end_date.
 
+        The records are streamed from `transactions` and inserted
+        IMPORT_BATCH_SIZE at a time.  `cache` is the import_cache to share
+        with the rest of the import, if any.
+
+        The download may overlap the transactions already loaded.  The rows
+        that are already there (by their row_key) are skipped.  The accounts
+        that get new rows within their loaded transactions have their shares
+        marked as out of date from there (see DirtyShares).
+
         Returns frozenset of accounts seen, number of funds created.
         '''
-        print("AccountTransactionHistory.load_csv", end_date)
+        print("AccountTransactionHistory.load", end_date)
+        if cache is None:
+            cache = import_cache()
+        start_new_funds = cache.num_new_funds
         accounts_seen = {}  # account_number: Account, start_date, prev_end_date
-        funds_created = 0
-        for row in csv.DictReader(file):
-            trade_date = todate(row['Trade Date'])
-
-            # Get account record from accounts_seen
-            account_number = row['Account Number']
-            if account_number in accounts_seen:
-                acct, start_date, prev_end_date = accounts_seen[account_number]
-            else:
-                acct = Account.get_account_number(account_number)
+        occurrences = {}    # {transaction_key fields: number seen}
 
-                # These may be None
-                start_date = acct.transaction_start_date
-                prev_end_date = acct.transaction_end_date
+        def new_transactions():
+            for record in transactions:
+                trade_date = record.trade_date
 
-                accounts_seen[account_number] = acct, start_date, prev_end_date
+                # Get account record from accounts_seen
+                account_number = record.account_number
+                if account_number in accounts_seen:
+                    acct, start_date, prev_end_date = \
+                      accounts_seen[account_number]
+                else:
+                    acct = cache.account(account_number)
+
+                    # These may be None
+                    start_date = acct.transaction_start_date
+                    prev_end_date = acct.transaction_end_date
+
+                    accounts_seen[account_number] = \
+                      acct, start_date, prev_end_date
+
+                if start_date is None or trade_date < start_date:
+                    start_date = trade_date
 
-            assert prev_end_date is None or trade_date > prev_end_date, \
-                   f"Earlier trade_date than expected.  Got {trade_date}, " \
-                     f"expected later than {prev_end_date}."
-
-            if start_date is None or trade_date < start_date:
-                start_date = trade_date
-
-            # Automatically create fund records for all funds seen here
-            ticker = row['Symbol']
-
-            # The VMFXX settlement fund comes in with a blank ticker.
-            # But "CASH" also comes in with a blank ticker.
-            # We convert the investment_name 'VANGUARD FEDERAL MONEY MARKET
-            # FUND' to a 'VMFXX' ticker.  The "CASH" transactions remain NULL.
-            # Got hit 10/17/2021: assert ticker != 'VMFXX', f"Got unexpected 'VMFXX' ticker!"
-            if not ticker:
-                if row['Investment Name'].upper() == \
-                       'VANGUARD FEDERAL MONEY MARKET FUND':
-                    ticker = 'VMFXX'
+                # Automatically create fund records for all funds seen here
+                if record.ticker is None:
+                    # Cash
+                    fund = None
                 else:
-                    # Investment Name should only be either the VMFXX name or
-                    # "CASH".  If it's something else, then we should probably
-                    # investigate...
-                    assert row['Investment Name'].upper() == 'CASH', \
-                           f"Got unknown blank ticker investment name: " \
-                           f"{row['Investment Name']}"
-            if not ticker:
-                # "CASH"
-                fund = None
-            else:
-                try:
-                    fund = Fund.objects.get(pk=ticker)
-                except Fund.DoesNotExist:
-                    print("Creating Fund", ticker, row['Investment Name'])
-                    fund = Fund(ticker=ticker, name=row['Investment Name'])
-                    fund.save()
-                    funds_created += 1
-            cls(account=acct,
-                trade_date=trade_date,
-                settlement_date=todate(row['Settlement Date']),
-                transaction_type=row['Transaction Type'],
-                transaction_desc=row['Transaction Description'],
-                investment_name=row['Investment Name'],
-                fund=fund,
-                shares=float(row['Shares']),
-                share_price=float(row['Share Price']),
-                principal_amount=float(row['Principal Amount']),
-                commission_fees=float(row['Commission Fees']),
-                net_amount=float(row['Net Amount']),
-                accrued_interest=float(row['Accrued Interest']),
-                account_type=row['Account Type'],
-            ).save()
-
-            # Update start_date
-            accounts_seen[account_number] = acct, start_date, prev_end_date
+                    fund = cache.fund(record.ticker, record.investment_name)
+                trans = cls(account=acct,
+                            trade_date=trade_date,
+                            settlement_date=record.settlement_date,
+                            transaction_type=record.transaction_type,
+                            transaction_desc=record.transaction_desc,
+                            investment_name=record.investment_name,
+                            fund=fund,
+                            shares=record.shares,
+                            share_price=record.share_price,
+                            principal_amount=record.principal_amount,
+                            commission_fees=record.commission_fees,
+                            net_amount=record.net_amount,
+                            accrued_interest=record.accrued_interest,
+                            account_type=record.account_type,
+                           )
+                fields = tuple(getattr(trans, name)
+                               for name in Transaction_key_fields)
+                occurrence = occurrences.get(fields, 0)
+                occurrences[fields] = occurrence + 1
+                trans.row_key = transaction_key(fields, occurrence)
+                yield trans
+
+                # Update start_date
+                accounts_seen[account_number] = acct, start_date, prev_end_date
+
+        num_skipped = 0
+        dirty = {}          # {Account: first new date within its transactions}
+        for batch in batches(new_transactions(), import_batch_size()):
+            # The new funds in this batch have to be there first.
+            cache.flush_funds()
+            new_rows = cls.new_rows(batch)
+            num_skipped += len(batch) - len(new_rows)
+            for trans in new_rows:
+                acct = trans.account
+                if acct.transaction_start_date is not None and \
+                   trans.trade_date <= acct.transaction_end_date and \
+                   (acct not in dirty or trans.trade_date < dirty[acct]):
+                    dirty[acct] = trans.trade_date
+            cls.objects.bulk_create(new_rows, ignore_conflicts=True)
+        if num_skipped:
+            print("AccountTransactionHistory.load: skipped", num_skipped,
+                  "rows already loaded")
+
+        for acct, from_date in dirty.items():
+            DirtyShares.mark_account(acct, from_date)
 
         # Update transaction_start_date and transaction_end_date in Accounts.
-        for acct, start_date, _ in accounts_seen.values():
+        for acct, start_date, prev_end_date in accounts_seen.values():
+            if prev_end_date is not None and prev_end_date > end_date:
+                acct_end_date = prev_end_date
+            else:
+                acct_end_date = end_date
             print(acct.id, "storing start_date", start_date,
-                  "end_date", end_date)
+                  "end_date", acct_end_date)
             acct.transaction_start_date = start_date
-            acct.transaction_end_date = end_date
+            acct.transaction_end_date = acct_end_date
             acct.save()
 
         return (frozenset(acct for acct, start, end in accounts_seen.values()),
-                funds_created)
+                cache.num_new_funds - start_new_funds)
+
+    @classmethod
+    def new_rows(cls, batch):
+        r'''Returns the transactions in `batch` that aren't already loaded.
+
+        Only the rows within their account's loaded transactions are looked
+        up, so a download that carries on from the last one doesn't need
+        any queries.
+        '''
+        overlap = {}  # {Account: [trans]}
+        for trans in batch:
+            acct = trans.account
+            if acct.transaction_start_date is not None and \
+               acct.transaction_start_date <= trans.trade_date \
+                                           <= acct.transaction_end_date:
+                overlap.setdefault(acct, []).append(trans)
+        if not overlap:
+            return batch
+        loaded = set()
+        for acct, rows in overlap.items():
+            dates = [trans.trade_date for trans in rows]
+            loaded.update(
+              cls.objects.filter(account=acct,
+                                 trade_date__range=(min(dates), max(dates)))
+                         .values_list('account_id', 'row_key'))
+        return [trans for trans in batch
+                if (trans.account_id, trans.row_key) not in loaded]
+
+    @staticmethod
+    def fund_shares_query(query):
+        r'''Selects the rows in `query` that change the shares of non-VMFXX funds.
+
+        Returns a django queryset ordered by fund_id, trade_date.
+        '''
+        return query.filter(fund_id__isnull=False) \
+                    .exclude(fund_id='VMFXX') \
+                    .exclude(shares=0) \
+                    .order_by('fund_id', 'trade_date')
+
+    @staticmethod
+    def vmfxx_query(query):
+        r'''Selects the rows in `query` whose net_amount make up VMFXX.
+
+        See the class doc string for these rules.
+
+        Returns a django queryset ordered by trade_date.
+        '''
+        return query.exclude(net_amount=0) \
+                    .filter(Q(fund_id__isnull=True) |
+                            ~(Q(fund_id='VMFXX') |
+                              Q(transaction_type__startswith='Transfer')) |
+                            Q(fund_id='VMFXX', transaction_type='Dividend')) \
+                    .order_by('trade_date')
 
     class Meta:
         get_latest_by = 'trade_date'
         ordering = ['-trade_date']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'row_key'],
+                                    name='unique_transaction_row_key'),
+        ]
 
 
 class AccountShares(models.Model):
@@ -339,13 +736,68 @@ class AccountShares(models.Model):
     trough_date = models.DateField(null=True)
 
     @classmethod
-    @transaction.atomic
-    def update(cls, reload=False):
+    def balances_on_dates(cls, accounts, dates):
+        r'''Returns {(account_id, date): balance} for `accounts` on `dates`.
+
+        This is one query, only reading the balances.  Each balance is summed
+        in the same order as Account.balance_on_date.
+        '''
+        return {key: totals.balance
+                for key, totals
+                 in AccountBalance.totals(
+                      cls.fund_balances(
+                        cls.objects.filter(account__in=accounts,
+                                           date__in=dates))).items()}
+
+    @staticmethod
+    def fund_balances(query):
+        r'''Generates account_id, date, balance, money_market for `query`.
+
+        These are in the order that AccountShares.update created them.
+        '''
+        for account_id, date, fund_id, balance, money_market \
+         in query.order_by('account_id', 'date', 'id') \
+                 .values_list('account_id', 'date', 'fund_id', 'balance',
+                              'fund__money_market'):
+            yield (account_id, date, balance,
+                   fund_id == 'VMFXX' or money_market)
+
+    @classmethod
+    def update(cls, reload=False, engine=None, workers=None, accounts=None):
         r'''Loads new rows from AccountTransactionHistory.
+
+        Only `accounts` (default all) are loaded.  The others are left as
+        they are, so this can't be combined with `reload`.
+
+        `engine` selects how the new rows are calculated, 'legacy',
+        'vectorized', 'sql' or 'stream' (see `shares_engine`).  All produce
+        the same rows, except for rounding with 'sql' on SQLite 3.43 or
+        later (see sql_shares.Exact_sums).
+
+        With more than one of `workers` (see `shares_workers`), the accounts
+        are calculated in parallel in a pool of processes (see
+        `parallel_rows`).  In that case, this must not be called within a
+        transaction.  Either way, all of the new rows are written in one
+        transaction here.  The 'sql' and 'stream' engines write the rows
+        themselves, so they always use one worker.
+
+        With the 'intervals' shares_storage, this is done by
+        AccountHoldings.update instead.
         '''
-        if reload:
-            # Delete the entire table and rebuild it.
-            cls.objects.all().delete()
+        assert not (reload and accounts is not None), \
+               "update: can't reload just some accounts"
+        if shares_storage() == 'intervals':
+            AccountHoldings.update(reload, accounts)
+            return
+
+        if engine is None:
+            engine = shares_engine()
+        assert engine in ('legacy', 'vectorized', 'sql', 'stream'), \
+               f"Unknown shares engine, {engine!r}"
+        if workers is None:
+            workers = shares_workers()
+        if engine in ('sql', 'stream'):
+            workers = 1
 
         # Get all money market fund tickers
         money_markets = frozenset(
@@ -353,138 +805,764 @@ class AccountShares(models.Model):
                           for f in Fund.objects.filter(money_market=True).all())
         print("update: money_markets", money_markets)
 
-        for acct in Account.objects.all():
+        if not reload:
+            with transaction.atomic():
+                DirtyShares.rebuild(engine, money_markets)
+
+        if accounts is None:
+            accounts = Account.objects.all()
+        accounts = list(accounts)
+        if workers > 1:
+            results = cls.parallel_rows(accounts, reload, engine,
+                                        money_markets, workers)
+        else:
+            results = (cls.account_rows(acct, reload, engine, money_markets)
+                       for acct in accounts)
+
+        with transaction.atomic():
+            if reload:
+                # Delete the entire table and rebuild it.
+                cls.objects.all().delete()
+                AccountBalance.objects.all().delete()
+                DirtyShares.objects.all().delete()
+                shares_changed.send(sender=cls)
+
+            for acct, (start_date, new_rows) in zip(accounts, results):
+                end_date = acct.transaction_end_date
+
+                #print("  Creating new rows")
+                cls.objects.bulk_create(new_rows)
+                AccountBalance.load(cls.row_balances(new_rows, money_markets))
+
+                if acct.shares_start_date is None:
+                    print("setting", acct, "shares_start_date to", start_date)
+                    acct.shares_start_date = start_date
+                print("setting", acct, "shares_end_date to", end_date)
+                acct.shares_end_date = end_date
+                acct.save()
+
+    @classmethod
+    def account_rows(cls, acct, reload, engine, money_markets):
+        r'''Calculates the new rows for `acct` with `engine`.
+
+        If `reload`, the rows already loaded are ignored.
+
+        Returns start_date, new_rows.
+        '''
+        end_date = acct.transaction_end_date
+        if reload:
+            last_date, start_date, starting_shares = \
+              None, acct.transaction_start_date, {}
+        else:
+            last_date, start_date, starting_shares = cls.starting_point(acct)
+
+        print("Doing", acct, "last_date", last_date,
+              "start_date", start_date, "end_date", end_date)
+
+        get_rows = cls.engine_rows(engine)
+        return start_date, get_rows(acct, last_date, start_date,
+                                    starting_shares, money_markets)
+
+    @classmethod
+    def engine_rows(cls, engine):
+        r'''Returns the function that calculates the new rows for `engine`.
+        '''
+        if engine == 'vectorized':
+            return cls.vectorized_rows
+        if engine == 'sql':
+            return cls.sql_rows
+        if engine == 'stream':
+            return cls.stream_rows
+        return cls.legacy_rows
+
+    @staticmethod
+    def row_balances(rows, money_markets):
+        r'''Generates account_id, date, balance, money_market for `rows`.
+
+        See AccountBalance.load.
+        '''
+        for row in rows:
+            yield (row.account_id, row.date, row.balance,
+                   row.fund_id == 'VMFXX' or row.fund_id in money_markets)
+
+    @classmethod
+    def parallel_rows(cls, accounts, reload, engine, money_markets, workers):
+        r'''Calculates the new rows for `accounts` in `workers` processes.
+
+        Each account is calculated by account_rows in a worker process, which
+        only reads the database.  Each account's progress is reported as it
+        finishes.
+
+        Returns [(start_date, new_rows)] in the same order as `accounts`.
+        '''
+        # The worker processes can't share our database connection.
+        connections.close_all()
+
+        results = {}  # {account_id: (start_date, new_rows)}
+        with ProcessPoolExecutor(workers, initializer=django.setup) as pool:
+            futures = {pool.submit(account_rows_worker, acct.id, reload,
+                                   engine, money_markets): acct
+                       for acct in accounts}
+            for done, future in enumerate(as_completed(futures), 1):
+                acct = futures[future]
+                results[acct.id] = future.result()
+                print(f"{acct}: {len(results[acct.id][1])} rows calculated "
+                        f"({done} of {len(accounts)} accounts)")
+        return [results[acct.id] for acct in accounts]
+
+    @classmethod
+    def priced(cls, account, date, fund_shares):
+        r'''Returns {ticker: AccountShares} for `fund_shares` held on `date`.
+
+        `fund_shares` is [(Fund, shares)].  The AccountShares are not saved in
+        the database.  They are filled in with the share prices on `date`,
+        the same way that `update` would have, and are in the order that
+        `update` creates its rows, so that balances sum the same.
+
+        Funds without a price on `date` (such as before their
+        FundPriceHistory starts) are left out, as `update` can't load rows
+        for them either.
+        '''
+        fund_shares = sorted(fund_shares,
+                             key=lambda fs: (fs[0].ticker == 'VMFXX',
+                                             fs[0].ticker))
+        def money_market(fund):
+            return fund.ticker == 'VMFXX' or fund.money_market
+        share_prices = FundPriceHistory.share_prices(
+                         (fund.ticker for fund, _ in fund_shares
+                                       if not money_market(fund)),
+                         date)
+        ans = {}
+        for fund, shares in fund_shares:
+            if money_market(fund):
+                fph = attrs(close=1.0, peak_pct_of_close=1.0,
+                            peak_date=date, trough_pct_of_close=None,
+                            trough_date=None)
+            elif fund.ticker in share_prices:
+                fph = share_prices[fund.ticker]
+            else:
+                print("priced: no price for", fund.ticker, "on", date)
+                continue
+            ans[fund.ticker] = \
+              cls(account=account, fund=fund, date=date,
+                  shares=shares, share_price=fph.close,
+                  balance=shares * fph.close,
+                  peak_pct_of_balance=fph.peak_pct_of_close,
+                  peak_date=fph.peak_date,
+                  trough_pct_of_balance=fph.trough_pct_of_close,
+                  trough_date=fph.trough_date)
+        return ans
+
+    @classmethod
+    def truncate(cls, acct, from_date):
+        r'''Drops `acct`'s rows from `from_date` on.
+
+        The next `update` loads them again.
+        '''
+        if acct.shares_end_date is None or from_date > acct.shares_end_date:
+            return
+        if from_date <= acct.shares_start_date:
+            print(acct, "dropping all shares")
+            cls.objects.filter(account=acct).delete()
+            AccountBalance.objects.filter(account=acct).delete()
+            acct.shares_start_date = None
+            acct.shares_end_date = None
+        else:
+            print(acct, "dropping shares from", from_date)
+            cls.objects.filter(account=acct, date__gte=from_date).delete()
+            AccountBalance.objects.filter(account=acct, date__gte=from_date) \
+                                  .delete()
+            acct.shares_end_date = from_date - One_day
+        acct.save()
+
+    @classmethod
+    def rebuild_slice(cls, acct, from_date, to_date, engine, money_markets):
+        r'''Recalculates `acct`'s rows from `from_date` through `to_date`.
+
+        The rows after `to_date` are left alone, so this is only right if the
+        shares after `to_date` are unchanged.  Use `truncate` otherwise.
+        '''
+        if acct.shares_end_date is None or from_date > acct.shares_end_date:
+            return
+        to_date = min(to_date, acct.shares_end_date)
+        if from_date <= acct.shares_start_date:
+            last_date, start_date, starting_shares = \
+              None, acct.transaction_start_date, {}
+        else:
+            last_date = from_date - One_day
+            start_date = from_date
+            starting_shares = dict(cls.objects.filter(account=acct,
+                                                      date=last_date)
+                                              .values_list('fund_id',
+                                                           'shares'))
+        print("Rebuilding", acct, "from", start_date, "through", to_date)
+
+        get_rows = cls.engine_rows(engine)
+        new_rows = [row
+                    for row in get_rows(acct, last_date, start_date,
+                                        starting_shares, money_markets)
+                     if row.date <= to_date]
+
+        old_rows = cls.objects.filter(account=acct, date__lte=to_date)
+        old_balances = AccountBalance.objects.filter(account=acct,
+                                                     date__lte=to_date)
+        if last_date is not None:
+            old_rows = old_rows.filter(date__gte=start_date)
+            old_balances = old_balances.filter(date__gte=start_date)
+        old_rows.delete()
+        old_balances.delete()
+        cls.objects.bulk_create(new_rows)
+        AccountBalance.load(cls.row_balances(new_rows, money_markets))
+        if last_date is None:
+            acct.shares_start_date = start_date
+            acct.save()
+
+    @classmethod
+    def reprice(cls, fund_id, from_date, to_date=None):
+        r'''Redoes the share prices of `fund_id` from `from_date` on.
+
+        This is for when the fund's prices have been corrected.  Only this
+        fund's rows, from `from_date` through `to_date` (None for the end),
+        are changed, along with the AccountBalance on those dates.
+
+        Returns the number of rows changed.
+        '''
+        rows = cls.objects.filter(fund_id=fund_id, date__gte=from_date)
+        if to_date is not None:
+            rows = rows.filter(date__lte=to_date)
+        rows = list(rows)
+        if not rows:
+            return 0
+        prices = price_cache.get(fund_id)
+        for row in rows:
+            fph = prices.as_of(row.date, max_days=5)
+            assert fph is not None, \
+                   f"Missing fund history date for {fund_id} on {row.date}"
+            row.share_price = fph.close
+            row.balance = row.shares * fph.close
+            row.peak_pct_of_balance = fph.peak_pct_of_close
+            row.peak_date = fph.peak_date
+            row.trough_pct_of_balance = fph.trough_pct_of_close
+            row.trough_date = fph.trough_date
+        cls.objects.bulk_update(rows,
+                                ['share_price', 'balance',
+                                 'peak_pct_of_balance', 'peak_date',
+                                 'trough_pct_of_balance', 'trough_date'],
+                                batch_size=1000)
+        AccountBalance.reload(frozenset(row.account_id for row in rows),
+                              from_date, to_date)
+        print(f"{fund_id}: {len(rows)} shares repriced from {from_date}")
+        return len(rows)
+
+    @classmethod
+    def starting_point(cls, acct):
+        r'''Returns last_date, start_date, starting_shares for `acct`.
+
+        `last_date` is the last date already loaded (None if nothing has been
+        loaded), `start_date` is the first date to load, and
+        `starting_shares` is {ticker: shares} on `last_date`.
+        '''
+        try:
+            latest = cls.objects.filter(account_id=acct.id).latest()
+            last_date = latest.date
+            assert last_date == acct.shares_end_date, \
+                   f"last_date, {last_date}, != " \
+                     f"shares_end_date, {acct.shares_end_date}"
+            starting_shares = {row.fund_id: row.shares
+                               for row
+                                in cls.objects.filter(account_id=acct.id,
+                                                      date=last_date)
+                                              .all()}
+            return last_date, last_date + One_day, starting_shares
+        except cls.DoesNotExist:
+            return None, acct.transaction_start_date, {}
+
+    @staticmethod
+    def new_transactions(acct, start_date, last_date):
+        r'''Returns the AccountTransactionHistory query for the new rows.
+        '''
+        ath_query = AccountTransactionHistory.objects \
+                                             .filter(account_id=acct.id)
+        if last_date is None:
+            return ath_query
+        return ath_query.filter(trade_date__gte=start_date)
+
+    @classmethod
+    def legacy_rows(cls, acct, last_date, start_date, starting_shares,
+                    money_markets):
+        r'''Returns the new rows for `acct`, walking the dates one by one.
+        '''
+        return list(cls.iter_legacy_rows(acct, last_date, start_date,
+                                         starting_shares, money_markets,
+                                         price_cache.get))
+
+    @classmethod
+    def iter_legacy_rows(cls, acct, last_date, start_date, starting_shares,
+                         money_markets, get_prices):
+        r'''Generates the new rows for `acct`, walking the dates one by one.
+
+        `get_prices(ticker)` returns the prices to look the closes up in (a
+        price_cache.fund_prices or price_cache.calendar_stream).  Each fund's
+        dates are looked up in order, one fund after another.
+        '''
+        end_date = acct.transaction_end_date
+        ath_within_dates = cls.new_transactions(acct, start_date, last_date)
+
+        def get_fph(ticker, date):
+            if ticker in money_markets:
+                return attrs(close=1.0, peak_pct_of_close=1.0,
+                             peak_date=date, trough_pct_of_close=None,
+                             trough_date=None)
+            fph = get_prices(ticker).as_of(date, max_days=5)
+            assert fph is not None, \
+                   f"Missing fund history date for {ticker} on {date}"
+            return fph
+
+        # Gather all but VMFXX funds:
+        ordered_ath = \
+          AccountTransactionHistory.fund_shares_query(ath_within_dates)
+
+        tickers_seen = set()
+        for ticker, ath in groupby(ordered_ath.iterator(),
+                                   key=attrgetter('fund_id')):
+            tickers_seen.add(ticker)
+            # Get starting number of shares
+            if last_date is None:
+                shares = 0.0
+            else:
+                shares = starting_shares.get(ticker, 0.0)
+
+            print(ticker, "starting shares", shares)
+
+            next_date = start_date
+            for a in ath:
+                if abs(shares) > 0.01:
+                    #print("shares", shares)
+                    while next_date < a.trade_date:
+                        assert shares >= 0, \
+                               f"Got unexpected negative shares on " \
+                                 f"{next_date}"
+                        fph = get_fph(ticker, next_date)
+                        yield cls(account_id=acct.id, fund_id=ticker,
+                                  date=next_date, shares=shares,
+                                  share_price=fph.close,
+                                  balance=shares * fph.close,
+                                  peak_pct_of_balance=fph.peak_pct_of_close,
+                                  peak_date=fph.peak_date,
+                                  trough_pct_of_balance=fph.trough_pct_of_close,
+                                  trough_date=fph.trough_date)
+                        next_date += One_day
+                else:
+                    next_date = a.trade_date
+                shares += a.shares
+
+            if abs(shares) > 0.01:
+                assert shares >= 0, \
+                       f"Got unexpected negative shares on {next_date}"
+                while next_date <= end_date:
+                    fph = get_fph(ticker, next_date)
+                    yield cls(account_id=acct.id, fund_id=ticker,
+                              date=next_date, shares=shares,
+                              share_price=fph.close,
+                              balance=shares * fph.close,
+                              peak_pct_of_balance=fph.peak_pct_of_close,
+                              peak_date=fph.peak_date,
+                              trough_pct_of_balance=fph.trough_pct_of_close,
+                              trough_date=fph.trough_date)
+                    next_date += One_day
+
+        # Bring forward any shares that didn't have any transactions.
+        for ticker, shares in starting_shares.items():
+            if ticker != 'VMFXX' and ticker not in tickers_seen and \
+               abs(shares) > 0.01:
+                assert shares >= 0, \
+                       f"Got unexpected negative shares on {next_date}"
+                next_date = start_date
+                while next_date <= end_date:
+                    fph = get_fph(ticker, next_date)
+                    yield cls(account_id=acct.id, fund_id=ticker,
+                              date=next_date, shares=shares,
+                              share_price=fph.close,
+                              balance=shares * fph.close,
+                              peak_pct_of_balance=fph.peak_pct_of_close,
+                              peak_date=fph.peak_date,
+                              trough_pct_of_balance=fph.trough_pct_of_close,
+                              trough_date=fph.trough_date)
+                    next_date += One_day
+
+        # Gather VMFXX fund:
+        ordered_ath = \
+          AccountTransactionHistory.vmfxx_query(ath_within_dates)
+
+        if last_date is None:
+            shares = 0.0
+        else:
+            shares = starting_shares['VMFXX']
+
+        next_date = start_date
+        for a in ordered_ath.iterator():
+            #print("shares", shares)
+            while next_date < a.trade_date:
+                assert shares >= 0, \
+                       f"Got unexpected negative shares, {shares}, " \
+                         f"on {next_date}"
+                yield cls(account_id=acct.id, fund_id='VMFXX',
+                          date=next_date, shares=shares, share_price=1.0,
+                          peak_pct_of_balance=1.0, peak_date=next_date,
+                          balance=shares)
+                next_date += One_day
+            shares += a.net_amount
+
+        while next_date <= end_date:
+            assert shares >= 0, \
+                   f"Got unexpected negative shares on {next_date}"
+            yield cls(account_id=acct.id, fund_id='VMFXX',
+                      date=next_date, shares=shares, share_price=1.0,
+                      peak_pct_of_balance=1.0, peak_date=next_date,
+                      balance=shares)
+            next_date += One_day
+
+    @classmethod
+    def vectorized_rows(cls, acct, last_date, start_date, starting_shares,
+                        money_markets):
+        r'''Returns the new rows for `acct`, calculated with NumPy arrays.
+
+        See vector_shares.py.
+        '''
+        # NumPy is only needed for this engine.
+        from . import vector_shares
+
+        ath_within_dates = cls.new_transactions(acct, start_date, last_date)
+        fund_trans = list(
+          AccountTransactionHistory.fund_shares_query(ath_within_dates)
+                                   .values_list('fund_id', 'trade_date',
+                                                'shares'))
+        vmfxx_trans = list(
+          AccountTransactionHistory.vmfxx_query(ath_within_dates)
+                                   .values_list('trade_date', 'net_amount'))
+
+        tickers = frozenset(row[0] for row in fund_trans) \
+                    .union(starting_shares) \
+                    .difference(money_markets, ('VMFXX',))
+        prices = {ticker: price_cache.get(ticker) for ticker in tickers}
+
+        return [cls(account_id=acct.id,
+                    **dict(zip(vector_shares.Row_fields, row)))
+                for row
+                 in vector_shares.account_rows(
+                      fund_trans, vmfxx_trans, prices, money_markets,
+                      starting_shares, last_date, start_date,
+                      acct.transaction_end_date)]
+
+    @classmethod
+    def sql_rows(cls, acct, last_date, start_date, starting_shares,
+                 money_markets):
+        r'''Inserts the new rows for `acct`, calculated by the database.
+
+        See sql_shares.py.  The AccountBalance rows are loaded here too.  The
+        starting shares are read by the query, rather than from
+        `starting_shares`.
+
+        Returns [], as the rows have already been written.
+        '''
+        from . import sql_shares
+
+        count = sql_shares.insert_rows(acct, last_date, start_date,
+                                       cls.new_transactions(acct, start_date,
+                                                            last_date))
+        new_rows = cls.objects.filter(account=acct)
+        if last_date is not None:
+            new_rows = new_rows.filter(date__gte=start_date)
+        AccountBalance.load(cls.fund_balances(new_rows))
+        print(acct, count, "rows inserted")
+        return []
+
+    @classmethod
+    def stream_rows(cls, acct, last_date, start_date, starting_shares,
+                    money_markets):
+        r'''Writes the new rows for `acct` as they are generated.
+
+        The rows from `iter_legacy_rows` are written `shares_batch_size` at a
+        time, and their AccountBalance totals are added up as they go by.
+        The prices are read from each fund's FundPriceCalendar for just the
+        dates needed, one fund at a time (see price_cache.calendar_stream),
+        rather than through the price_cache.  So only one batch of rows is
+        held at a time.
+
+        Returns [], as the rows have already been written.
+        '''
+        end_date = acct.transaction_end_date
+        streams = {}   # {ticker: calendar_stream} for the current fund
+        def get_prices(ticker):
+            if ticker not in streams:
+                streams.clear()
+                streams[ticker] = price_cache.calendar_stream(ticker,
+                                                              start_date,
+                                                              end_date)
+            return streams[ticker]
+
+        balances = {}
+        count = 0
+        for batch in batches(cls.iter_legacy_rows(acct, last_date, start_date,
+                                                  starting_shares,
+                                                  money_markets, get_prices),
+                             shares_batch_size()):
+            cls.objects.bulk_create(batch)
+            AccountBalance.totals(cls.row_balances(batch, money_markets),
+                                  balances)
+            count += len(batch)
+        AccountBalance.objects.bulk_create(balances.values(), batch_size=1000)
+        print(acct, count, "rows written")
+        return []
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'fund', 'date'],
+                                    name='unique_account_shares_per_date'),
+        ]
+        get_latest_by = 'date'
+
+
+def account_rows_worker(account_id, reload, engine, money_markets):
+    r'''Runs AccountShares.account_rows in a worker process.
+
+    See AccountShares.parallel_rows.
+    '''
+    acct = Account.objects.get(pk=account_id)
+    return AccountShares.account_rows(acct, reload, engine, money_markets)
+
+
+class AccountHoldings(models.Model):
+    r'''The number of shares in each account's fund as change-point intervals.
+
+    This is the 'intervals' shares_storage alternative to AccountShares.
+    Rather than one row per account/fund/day, each row covers the days from
+    `valid_from` through `valid_to` (inclusive) over which the number of
+    shares did not change.  The share prices are joined in from
+    FundPriceHistory when the holdings are looked up, so these rows only
+    change when the transactions do.
+
+    The shares follow the same rules as AccountShares, and only cover the
+    days for which AccountShares would have had a row.
+    '''
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    fund = models.ForeignKey('Fund', on_delete=models.CASCADE)
+    shares = models.FloatField()
+    valid_from = models.DateField()
+    valid_to = models.DateField()
+
+    @classmethod
+    def balances_on_dates(cls, accounts, dates):
+        r'''Returns {(account_id, date): balance} for `accounts` on `dates`.
+
+        `dates` must be sorted.
+
+        Each balance is summed in the same order as shares_on_date.
+        '''
+        return {key: totals.balance
+                for key, totals
+                 in AccountBalance.totals(
+                      cls.fund_balances(accounts, dates)).items()}
+
+    @classmethod
+    def fund_balances(cls, accounts, dates):
+        r'''Generates account_id, date, balance, money_market for each fund.
+
+        These cover `accounts` on `dates`, which must be sorted.  Each
+        account's funds are in the order that shares_on_date puts them.
+
+        This is one query for the holdings covering any of the `dates`.  The
+        closes come from the price_cache.
+        '''
+        if not dates:
+            return
+        holdings = sorted(cls.objects.filter(account__in=accounts,
+                                             valid_from__lte=dates[-1],
+                                             valid_to__gte=dates[0])
+                                     .values_list('account_id', 'fund_id',
+                                                  'shares', 'valid_from',
+                                                  'valid_to',
+                                                  'fund__money_market'),
+                          key=lambda h: (h[0], h[1] == 'VMFXX', h[1]))
+        def close_on(fund_id, date):
+            # Like FundPriceHistory.share_prices, look back up to a week.
+            prices = price_cache.get(fund_id)
+            i = prices.index_on(date, max_days=7)
+            assert i is not None, \
+                   f"Missing fund history date for {fund_id} on {date}"
+            return prices.closes[i]
+
+        for account_id, fund_id, shares, valid_from, valid_to, money_market \
+         in holdings:
+            money_market = fund_id == 'VMFXX' or money_market
+            for date in dates[bisect_left(dates, valid_from)
+                              :bisect_right(dates, valid_to)]:
+                if money_market:
+                    close = 1.0
+                else:
+                    close = close_on(fund_id, date)
+                yield account_id, date, shares * close, money_market
+
+    @classmethod
+    def shares_on_date(cls, account, date):
+        r'''Returns {ticker: AccountShares} as of `date`.
+
+        The AccountShares are not saved in the database.  They are filled in
+        from the holdings covering `date` and the share prices on `date`, the
+        same way that AccountShares.update would have.
+        '''
+        holdings = cls.objects.filter(account=account, valid_from__lte=date,
+                                      valid_to__gte=date) \
+                              .select_related('fund').all()
+        return AccountShares.priced(account, date,
+                                    [(h.fund, h.shares) for h in holdings])
+
+    @classmethod
+    def truncate(cls, acct, from_date):
+        r'''Drops `acct`'s holdings from `from_date` on.
+
+        The intervals running through `from_date` are cut short.  The next
+        `update` loads the rest again.
+        '''
+        if acct.shares_end_date is None or from_date > acct.shares_end_date:
+            return
+        if from_date <= acct.shares_start_date:
+            print(acct, "dropping all holdings")
+            cls.objects.filter(account=acct).delete()
+            AccountBalance.objects.filter(account=acct).delete()
+            acct.shares_start_date = None
+            acct.shares_end_date = None
+        else:
+            print(acct, "dropping holdings from", from_date)
+            cls.objects.filter(account=acct, valid_from__gte=from_date) \
+                       .delete()
+            cls.objects.filter(account=acct, valid_to__gte=from_date) \
+                       .update(valid_to=from_date - One_day)
+            AccountBalance.objects.filter(account=acct, date__gte=from_date) \
+                                  .delete()
+            acct.shares_end_date = from_date - One_day
+        acct.save()
+
+    @classmethod
+    def accounts_holding(cls, fund_id, from_date, to_date=None):
+        r'''Returns the account_ids holding `fund_id` between the dates.
+
+        `to_date` None is the end.
+        '''
+        holdings = cls.objects.filter(fund_id=fund_id,
+                                      valid_to__gte=from_date)
+        if to_date is not None:
+            holdings = holdings.filter(valid_from__lte=to_date)
+        return frozenset(holdings.values_list('account_id', flat=True))
+
+    @classmethod
+    @transaction.atomic
+    def update(cls, reload=False, accounts=None):
+        r'''Loads new intervals from AccountTransactionHistory.
+
+        Only `accounts` (default all) are loaded.
+
+        The shares only change on trade dates, so this walks the transactions
+        rather than the days in between, and doesn't need the share prices.
+
+        Intervals still open on Account.shares_end_date are extended if their
+        shares don't change.
+        '''
+        if reload:
+            # Delete the entire table and rebuild it.
+            cls.objects.all().delete()
+            AccountBalance.objects.all().delete()
+            DirtyShares.objects.all().delete()
+            shares_changed.send(sender=cls)
+        else:
+            DirtyShares.rebuild()
+
+        if accounts is None:
+            accounts = Account.objects.all()
+        for acct in accounts:
             end_date = acct.transaction_end_date
 
             ath_query = AccountTransactionHistory.objects \
                                                  .filter(account_id=acct.id)
             try:
                 latest = cls.objects.filter(account_id=acct.id).latest()
-                last_date = latest.date
+                last_date = latest.valid_to
                 assert last_date == acct.shares_end_date, \
                        f"last_date, {last_date}, != " \
                          f"shares_end_date, {acct.shares_end_date}"
-                starting_shares = {row.fund_id: row.shares
-                                   for row
-                                    in cls.objects.filter(account_id=acct.id,
-                                                          date=last_date)
-                                                  .all()}
+                # {ticker: AccountHoldings}
+                open_intervals = {row.fund_id: row
+                                  for row
+                                   in cls.objects.filter(account_id=acct.id,
+                                                         valid_to=last_date)
+                                                 .all()}
                 start_date = last_date + One_day
                 ath_within_dates = ath_query.filter(trade_date__gte=start_date)
-                fph_query = \
-                  FundPriceHistory.objects.filter(
-                    date__gte=start_date - One_week)
             except cls.DoesNotExist:
                 last_date = None
-                starting_shares = {}
+                open_intervals = {}
                 start_date = acct.transaction_start_date
                 ath_within_dates = ath_query
-                fph_query = FundPriceHistory.objects
+            starting_shares = {ticker: row.shares
+                               for ticker, row in open_intervals.items()}
 
             print("Doing", acct, "last_date", last_date,
                   "start_date", start_date, "end_date", end_date)
 
-            fund_history = {(fph.fund_id, fph.date): fph
-                            for fph in fph_query.all()}
-
-            def get_fph(ticker, date, count=0):
-                if ticker in money_markets:
-                    return attrs(close=1.0, peak_pct_of_close=1.0,
-                                 peak_date=date, trough_pct_of_close=None,
-                                 trough_date=None)
-                if (ticker, date) in fund_history:
-                    return fund_history[ticker, date]
-                assert count < 5, \
-                       f"Missing fund history date for {ticker} on {date}"
-                return get_fph(ticker, date - One_day, count + 1)
+            new_rows = []
+            extended_rows = {}  # {id: AccountHoldings}
+
+            def add_interval(ticker, shares, from_date, to_date,
+                             min_shares=0.01):
+                r'''Records `shares` held from `from_date` through `to_date`.
+
+                Nothing is recorded for `min_shares` or less (if not None).
+                '''
+                if from_date > to_date:
+                    return
+                if min_shares is not None and abs(shares) <= min_shares:
+                    return
+                assert shares >= 0, \
+                       f"Got unexpected negative shares, {shares}, " \
+                         f"for {ticker} on {from_date}"
+                prev = open_intervals.get(ticker)
+                if prev is not None and prev.shares == shares and \
+                   prev.valid_to + One_day == from_date:
+                    prev.valid_to = to_date
+                    if prev.id is not None:
+                        extended_rows[prev.id] = prev
+                else:
+                    prev = cls(account_id=acct.id, fund_id=ticker,
+                               shares=shares, valid_from=from_date,
+                               valid_to=to_date)
+                    new_rows.append(prev)
+                    open_intervals[ticker] = prev
 
             # Gather all but VMFXX funds:
-            ordered_ath = ath_within_dates.filter(fund_id__isnull=False) \
-                                          .exclude(fund_id='VMFXX') \
-                                          .exclude(shares=0) \
-                                          .order_by('fund_id', 'trade_date')
+            ordered_ath = \
+              AccountTransactionHistory.fund_shares_query(ath_within_dates)
 
-            new_rows = []
             tickers_seen = set()
             for ticker, ath in groupby(ordered_ath.all(),
                                        key=attrgetter('fund_id')):
                 tickers_seen.add(ticker)
-                # Get starting number of shares
-                if last_date is None:
-                    shares = 0.0
-                else:
-                    shares = starting_shares.get(ticker, 0.0)
-
-                print(ticker, "starting shares", shares)
-
+                shares = starting_shares.get(ticker, 0.0)
                 next_date = start_date
                 for a in ath:
-                    if abs(shares) > 0.01:
-                        #print("shares", shares)
-                        while next_date < a.trade_date:
-                            assert shares >= 0, \
-                                   f"Got unexpected negative shares on " \
-                                     f"{next_date}"
-                            fph = get_fph(ticker, next_date)
-                            new_rows.append(
-                              cls(account_id=acct.id, fund_id=ticker,
-                                  date=next_date, shares=shares,
-                                  share_price=fph.close,
-                                  balance=shares * fph.close,
-                                  peak_pct_of_balance=fph.peak_pct_of_close,
-                                  peak_date=fph.peak_date,
-                                  trough_pct_of_balance=fph.trough_pct_of_close,
-                                  trough_date=fph.trough_date))
-                            next_date += One_day
-                    else:
-                        next_date = a.trade_date
+                    add_interval(ticker, shares, next_date,
+                                 a.trade_date - One_day)
+                    next_date = max(next_date, a.trade_date)
                     shares += a.shares
-
-                if abs(shares) > 0.01:
-                    assert shares >= 0, \
-                           f"Got unexpected negative shares on {next_date}"
-                    while next_date <= end_date:
-                        fph = get_fph(ticker, next_date)
-                        new_rows.append(
-                          cls(account_id=acct.id, fund_id=ticker,
-                              date=next_date, shares=shares,
-                              share_price=fph.close,
-                              balance=shares * fph.close,
-                              peak_pct_of_balance=fph.peak_pct_of_close,
-                              peak_date=fph.peak_date,
-                              trough_pct_of_balance=fph.trough_pct_of_close,
-                              trough_date=fph.trough_date))
-                        next_date += One_day
+                add_interval(ticker, shares, next_date, end_date)
 
             # Bring forward any shares that didn't have any transactions.
             for ticker, shares in starting_shares.items():
-                if ticker != 'VMFXX' and ticker not in tickers_seen and \
-                   abs(shares) > 0.01:
-                    assert shares >= 0, \
-                           f"Got unexpected negative shares on {next_date}"
-                    next_date = start_date
-                    while next_date <= end_date:
-                        fph = get_fph(ticker, next_date)
-                        new_rows.append(
-                          cls(account_id=acct.id, fund_id=ticker,
-                              date=next_date, shares=shares,
-                              share_price=fph.close,
-                              balance=shares * fph.close,
-                              peak_pct_of_balance=fph.peak_pct_of_close,
-                              peak_date=fph.peak_date,
-                              trough_pct_of_balance=fph.trough_pct_of_close,
-                              trough_date=fph.trough_date))
-                        next_date += One_day
+                if ticker != 'VMFXX' and ticker not in tickers_seen:
+                    add_interval(ticker, shares, start_date, end_date)
 
             # Gather VMFXX fund:
             ordered_ath = \
-              ath_within_dates \
-                .exclude(net_amount=0) \
-                .filter(Q(fund_id__isnull=True) |
-                        ~(Q(fund_id='VMFXX') |
-                          Q(transaction_type__startswith='Transfer')) |
-                        Q(fund_id='VMFXX', transaction_type='Dividend')) \
-                .order_by('trade_date')
+              AccountTransactionHistory.vmfxx_query(ath_within_dates)
 
             if last_date is None:
                 shares = 0.0
@@ -493,31 +1571,19 @@ class AccountShares(models.Model):
 
             next_date = start_date
             for a in ordered_ath.all():
-                #print("shares", shares)
-                while next_date < a.trade_date:
-                    assert shares >= 0, \
-                           f"Got unexpected negative shares, {shares}, " \
-                             f"on {next_date}"
-                    new_rows.append(
-                      cls(account_id=acct.id, fund_id='VMFXX',
-                          date=next_date, shares=shares, share_price=1.0,
-                          peak_pct_of_balance=1.0, peak_date=next_date,
-                          balance=shares))
-                    next_date += One_day
+                add_interval('VMFXX', shares, next_date,
+                             a.trade_date - One_day, min_shares=None)
+                next_date = max(next_date, a.trade_date)
                 shares += a.net_amount
+            add_interval('VMFXX', shares, next_date, end_date,
+                         min_shares=None)
 
-            while next_date <= end_date:
-                assert shares >= 0, \
-                       f"Got unexpected negative shares on {next_date}"
-                new_rows.append(
-                  cls(account_id=acct.id, fund_id='VMFXX',
-                      date=next_date, shares=shares, share_price=1.0,
-                      peak_pct_of_balance=1.0, peak_date=next_date,
-                      balance=shares))
-                next_date += One_day
-
-            #print("  Creating new rows")
             cls.objects.bulk_create(new_rows)
+            cls.objects.bulk_update(extended_rows.values(), ['valid_to'])
+            if start_date is not None and start_date <= end_date:
+                AccountBalance.load(
+                  cls.fund_balances([acct], days_between(start_date,
+                                                         end_date)))
 
             if acct.shares_start_date is None:
                 print("setting", acct, "shares_start_date to", start_date)
@@ -526,10 +1592,485 @@ class AccountShares(models.Model):
             acct.shares_end_date = end_date
             acct.save()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'fund', 'valid_from'],
+                                    name='unique_account_holdings_per_date'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'valid_to', 'valid_from'],
+                         name='account_holdings_by_date'),
+        ]
+        get_latest_by = 'valid_to'
+
+
+class AccountBalance(models.Model):
+    r'''The total balance of each account by date.
+
+    This is kept up to date by AccountShares.update (and
+    AccountHoldings.update) as they load the shares, so that looking up an
+    account's balance doesn't have to sum its funds.  The `balance` is summed
+    in the same order as Account.balance_on_date would, so it is exactly the
+    same.
+
+    `cash` is the part of the balance in money market funds, and `invested`
+    is the rest.
+
+    Shares loaded before this table existed are loaded into it by `backfill`
+    (see the backfill_balances command).
+    '''
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    date = models.DateField()
+    balance = models.FloatField()
+    cash = models.FloatField()
+    invested = models.FloatField()
+
+    @classmethod
+    def totals(cls, fund_balances, ans=None):
+        r'''Returns {(account_id, date): AccountBalance} (not saved).
+
+        `fund_balances` are account_id, date, balance, money_market for each
+        fund (see AccountShares.fund_balances and
+        AccountHoldings.fund_balances).  These are added to `ans`, if given.
+        '''
+        if ans is None:
+            ans = {}
+        for account_id, date, balance, money_market in fund_balances:
+            key = account_id, date
+            totals = ans.get(key)
+            if totals is None:
+                totals = ans[key] = cls(account_id=account_id, date=date,
+                                        balance=0, cash=0, invested=0)
+            totals.balance += balance
+            if money_market:
+                totals.cash += balance
+            else:
+                totals.invested += balance
+        return ans
+
+    @classmethod
+    def load(cls, fund_balances, batch_size=1000):
+        r'''Adds the totals of `fund_balances` (see `totals`).
+
+        Returns the number of rows added.
+        '''
+        rows = list(cls.totals(fund_balances).values())
+        cls.objects.bulk_create(rows, batch_size=batch_size)
+        return len(rows)
+
+    @classmethod
+    def reload(cls, accounts, from_date, to_date=None):
+        r'''Reloads the balances for `accounts` between the dates.
+
+        `to_date` None is the end.  The balances are reloaded from the shares.
+
+        Returns the number of rows loaded.
+        '''
+        accounts = list(Account.objects.filter(pk__in=accounts,
+                                               shares_start_date__isnull=False))
+        balances = cls.objects.filter(account__in=accounts,
+                                      date__gte=from_date)
+        if to_date is not None:
+            balances = balances.filter(date__lte=to_date)
+        balances.delete()
+        if shares_storage() == 'intervals':
+            end_date = max((acct.shares_end_date for acct in accounts),
+                           default=None)
+            if to_date is not None and end_date is not None:
+                end_date = min(end_date, to_date)
+            if end_date is None or end_date < from_date:
+                return 0
+            fund_balances = AccountHoldings.fund_balances(
+                              accounts, days_between(from_date, end_date))
+        else:
+            query = AccountShares.objects.filter(account__in=accounts,
+                                                 date__gte=from_date)
+            if to_date is not None:
+                query = query.filter(date__lte=to_date)
+            fund_balances = AccountShares.fund_balances(query)
+        return cls.load(fund_balances)
+
+    @classmethod
+    @transaction.atomic
+    def backfill(cls, accounts=None):
+        r'''Reloads the balances for `accounts` (default all) from the shares.
+
+        Returns the number of rows loaded.
+        '''
+        if accounts is None:
+            accounts = Account.objects.all()
+        total = 0
+        for acct in accounts:
+            cls.objects.filter(account=acct).delete()
+            if acct.shares_start_date is None:
+                print(f"{acct}: no shares loaded -- skipped")
+                continue
+            if shares_storage() == 'intervals':
+                fund_balances = AccountHoldings.fund_balances(
+                                  [acct],
+                                  days_between(acct.shares_start_date,
+                                               acct.shares_end_date))
+            else:
+                fund_balances = AccountShares.fund_balances(
+                                  AccountShares.objects.filter(account=acct))
+            count = cls.load(fund_balances)
+            print(f"{acct}: {count} balances loaded")
+            total += count
+        return total
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'date'],
+                                    name='unique_account_balance_per_date'),
+        ]
+        get_latest_by = 'date'
+
+
+class DirtyShares(models.Model):
+    r'''Slices of the loaded shares that are out of date.
+
+    Each row marks the shares from `from_date` through `to_date` (None for the
+    end) as needing to be recalculated, either for one `account` (its
+    transactions changed), or for one `fund` in all accounts (its prices
+    changed).
+
+    The next AccountShares.update recalculates just these slices (see
+    `rebuild`) before loading the new days, rather than reloading everything.
+    '''
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, null=True)
+    fund = models.ForeignKey('Fund', on_delete=models.CASCADE, null=True)
+    from_date = models.DateField()
+    to_date = models.DateField(null=True)
+
+    @classmethod
+    def mark_account(cls, account, from_date, to_date=None):
+        r'''Marks `account`'s shares from `from_date` as out of date.
+
+        Only give a `to_date` if the shares after it are unchanged.
+
+        The account's AccountCheckpoints from `from_date` on are dropped, to
+        be taken again by AccountCheckpoint.update.
+        '''
+        print("Marking", account, "shares from", from_date, "through", to_date)
+        cls.objects.create(account=account, from_date=from_date,
+                           to_date=to_date)
+        AccountCheckpoint.objects.filter(account=account,
+                                         date__gte=from_date) \
+                                 .delete()
+
+    @classmethod
+    def mark_fund(cls, fund, from_date, to_date=None):
+        r'''Marks `fund`'s prices from `from_date` as out of date.
+        '''
+        print("Marking", fund, "prices from", from_date, "through", to_date)
+        cls.objects.create(fund=fund, from_date=from_date, to_date=to_date)
+
+    @staticmethod
+    def merge(marks):
+        r'''Merges the slices in `marks`, which are key, from_date, to_date.
+
+        Returns {key: (from_date, to_date)} covering all of the slices for
+        each key.
+        '''
+        ans = {}
+        for key, from_date, to_date in marks:
+            if key in ans:
+                prev_from, prev_to = ans[key]
+                from_date = min(from_date, prev_from)
+                if to_date is not None and prev_to is not None:
+                    to_date = max(to_date, prev_to)
+                else:
+                    to_date = None
+            ans[key] = from_date, to_date
+        return ans
+
+    @classmethod
+    def rebuild(cls, engine=None, money_markets=frozenset()):
+        r'''Recalculates the marked slices, and clears the marks.
+
+        The funds are repriced first, in just that fund's rows.  Then each
+        marked account is redone from its `from_date`.  With the 'daily'
+        shares_storage, an account slice with a `to_date` is recalculated in
+        place (see AccountShares.rebuild_slice), except with the 'sql' and
+        'stream' engines, which only load whole days from `from_date` on.
+        Otherwise, the shares are dropped from `from_date` on, for the update
+        to load again.
+
+        With the 'intervals' shares_storage, the holdings don't have the
+        prices, so only the balances are redone for the funds.
+
+        Must be called within a transaction.
+        '''
+        marks = list(cls.objects.all())
+        if not marks:
+            return
+        intervals = shares_storage() == 'intervals'
+        if engine is None:
+            engine = shares_engine()
+
+        fund_slices = cls.merge((mark.fund_id, mark.from_date, mark.to_date)
+                                for mark in marks
+                                 if mark.fund_id is not None)
+        money_market_funds = frozenset(
+                               Fund.objects.filter(pk__in=fund_slices,
+                                                   money_market=True)
+                                           .values_list('ticker', flat=True))
+        for fund_id, (from_date, to_date) in sorted(fund_slices.items()):
+            if fund_id == 'VMFXX' or fund_id in money_market_funds:
+                continue
+            if intervals:
+                AccountBalance.reload(
+                  AccountHoldings.accounts_holding(fund_id, from_date,
+                                                   to_date),
+                  from_date, to_date)
+            else:
+                AccountShares.reprice(fund_id, from_date, to_date)
+            shares_changed.send(sender=cls, fund_id=fund_id,
+                                from_date=from_date, to_date=to_date)
+
+        account_slices = cls.merge((mark.account_id, mark.from_date,
+                                    mark.to_date)
+                                   for mark in marks
+                                    if mark.account_id is not None)
+        for acct in Account.objects.filter(pk__in=account_slices):
+            from_date, to_date = account_slices[acct.id]
+            if intervals:
+                AccountHoldings.truncate(acct, from_date)
+            elif to_date is None or engine in ('sql', 'stream') or \
+                 acct.transaction_start_date is None:
+                AccountShares.truncate(acct, from_date)
+            else:
+                AccountShares.rebuild_slice(acct, from_date, to_date, engine,
+                                            money_markets)
+            shares_changed.send(sender=cls, account_id=acct.id,
+                                from_date=from_date, to_date=to_date)
+        AccountCheckpoint.update(Account.objects.filter(pk__in=account_slices))
+
+        cls.objects.filter(pk__in=[mark.id for mark in marks]).delete()
+
+
+class AccountCheckpoint(models.Model):
+    r'''The shares in each account's funds at the end of each period.
+
+    These are taken from AccountTransactionHistory at the end of each
+    month, quarter or year (see `checkpoint_cadence`), through the account's
+    transaction_end_date.  The shares on any other date are then the shares
+    at the last checkpoint before it, plus the transactions since (see
+    `shares_on_date`), without needing AccountShares.
+
+    The `shares` are the running sums of the transactions, following the same
+    rules (and added in the same order) as AccountShares.update.  So adding
+    the transactions after a checkpoint gives exactly the same shares.  A
+    fund is included from its first transaction on, even if its shares have
+    gone back down to 0.
+
+    Missing checkpoints only make the lookups slower, as they then start from
+    an earlier checkpoint (or the first transaction).
+    '''
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    fund = models.ForeignKey('Fund', on_delete=models.CASCADE)
+    date = models.DateField()
+    shares = models.FloatField()
+
+    @staticmethod
+    def period_ends(start_date, end_date, cadence=None):
+        r'''Returns the period end dates from `start_date` through `end_date`.
+        '''
+        if cadence is None:
+            cadence = checkpoint_cadence()
+        months = {'month': 1, 'quarter': 3, 'year': 12}[cadence]
+        ans = []
+        year = start_date.year
+        month = start_date.month + (-start_date.month % months)
+        while True:
+            period_end = date(year, month,
+                              calendar.monthrange(year, month)[1])
+            if period_end > end_date:
+                return ans
+            ans.append(period_end)
+            month += months
+            if month > 12:
+                year += 1
+                month -= 12
+
+    @staticmethod
+    def moves(ath_query):
+        r'''Returns the changes to the shares in `ath_query`.
+
+        These are [(trade_date, ticker, amount)] in the order they are added
+        to the shares.  The VMFXX amounts are the net_amounts of the
+        AccountTransactionHistory.vmfxx_query.
+        '''
+        # This sort is stable, so each fund's moves stay in the order that
+        # AccountShares.update adds them.
+        return sorted(
+          [(trade_date, ticker, shares)
+           for ticker, trade_date, shares
+            in AccountTransactionHistory.fund_shares_query(ath_query)
+                                        .values_list('fund_id', 'trade_date',
+                                                     'shares')] +
+          [(trade_date, 'VMFXX', net_amount)
+           for trade_date, net_amount
+            in AccountTransactionHistory.vmfxx_query(ath_query)
+                                        .values_list('trade_date',
+                                                     'net_amount')],
+          key=itemgetter(0))
+
+    @classmethod
+    def latest_shares(cls, account, date=None):
+        r'''Returns the date and {ticker: shares} of the last checkpoint.
+
+        This is the last checkpoint on or before `date` (None for the last
+        one).  Returns None, {} if there isn't one.
+        '''
+        checkpoints = cls.objects.filter(account=account)
+        if date is not None:
+            checkpoints = checkpoints.filter(date__lte=date)
+        checkpoint_date = checkpoints.order_by('-date') \
+                                     .values_list('date', flat=True) \
+                                     .first()
+        if checkpoint_date is None:
+            return None, {}
+        return checkpoint_date, \
+               dict(cls.objects.filter(account=account, date=checkpoint_date)
+                               .values_list('fund_id', 'shares'))
+
+    @classmethod
+    @transaction.atomic
+    def update(cls, accounts=None, reload=False):
+        r'''Takes the new checkpoints for `accounts` (default all).
+
+        With `reload`, the checkpoints already taken are dropped first.
+
+        Returns the number of rows added.
+        '''
+        if accounts is None:
+            accounts = Account.objects.all()
+        total = 0
+        for acct in accounts:
+            if reload or acct.transaction_start_date is None:
+                cls.objects.filter(account=acct).delete()
+            if acct.transaction_start_date is None:
+                continue
+            last_date, shares = cls.latest_shares(acct)
+            ath_query = AccountTransactionHistory.objects \
+                                                 .filter(account=acct)
+            if last_date is None:
+                start_date = acct.transaction_start_date
+            else:
+                start_date = last_date + One_day
+                ath_query = ath_query.filter(trade_date__gte=start_date)
+            period_ends = cls.period_ends(start_date,
+                                          acct.transaction_end_date)
+            if not period_ends:
+                continue
+            moves = cls.moves(ath_query.filter(trade_date__lte=period_ends[-1]))
+
+            new_rows = []
+            i = 0
+            for period_end in period_ends:
+                while i < len(moves) and moves[i][0] <= period_end:
+                    _, ticker, amount = moves[i]
+                    shares[ticker] = shares.get(ticker, 0.0) + amount
+                    i += 1
+                new_rows.extend(cls(account=acct, fund_id=ticker,
+                                    date=period_end, shares=num_shares)
+                                for ticker, num_shares in shares.items())
+            cls.objects.bulk_create(new_rows, batch_size=1000)
+            print(f"{acct}: {len(period_ends)} checkpoints taken through "
+                    f"{period_ends[-1]}")
+            total += len(new_rows)
+        return total
+
+    @classmethod
+    def shares_on_date(cls, account, date):
+        r'''Returns {ticker: AccountShares} as of `date`.
+
+        These are worked out from the last checkpoint on or before `date`,
+        and the transactions since.  The AccountShares are not saved in the
+        database (see AccountShares.priced).
+
+        Returns {} for dates outside of the account's transactions.
+        '''
+        return cls.shares_on_dates(account, [date])[date]
+
+    @classmethod
+    def shares_on_dates(cls, account, dates):
+        r'''Returns {date: {ticker: AccountShares}} for each of `dates`.
+
+        These are the same as shares_on_date for each date, but are done in
+        a fixed number of queries for all of the dates.
+        '''
+        ans = {date: {} for date in dates}
+        if account.transaction_start_date is None:
+            return ans
+        dates = sorted(date for date in ans
+                        if account.transaction_start_date <= date
+                             <= account.transaction_end_date)
+        if not dates:
+            return ans
+
+        # The last checkpoint on or before each date (None if there isn't
+        # one).
+        checkpoint_dates = list(cls.objects.filter(account=account,
+                                                   date__lte=dates[-1])
+                                           .order_by('date')
+                                           .values_list('date', flat=True)
+                                           .distinct())
+        starts = {}
+        for date in dates:
+            i = bisect_right(checkpoint_dates, date)
+            starts[date] = checkpoint_dates[i - 1] if i else None
+        checkpoints = {}  # {checkpoint date: {ticker: shares}}
+        for checkpoint_date, ticker, shares \
+         in cls.objects.filter(account=account,
+                               date__in={start for start in starts.values()
+                                                if start is not None}) \
+                       .values_list('date', 'fund_id', 'shares'):
+            checkpoints.setdefault(checkpoint_date, {})[ticker] = shares
+
+        ath_query = AccountTransactionHistory.objects \
+                                             .filter(account=account,
+                                                     trade_date__lte=dates[-1])
+        if None not in starts.values():
+            ath_query = ath_query.filter(trade_date__gt=min(starts.values()))
+        moves = cls.moves(ath_query)
+        trade_dates = [trade_date for trade_date, _, _ in moves]
+
+        shares_by_date = {}
+        for date in dates:
+            start = starts[date]
+            if start is None:
+                shares = {}
+                lo = 0
+            else:
+                shares = dict(checkpoints.get(start, {}))
+                lo = bisect_right(trade_dates, start)
+            for _, ticker, amount \
+             in moves[lo:bisect_right(trade_dates, date)]:
+                shares[ticker] = shares.get(ticker, 0.0) + amount
+            shares.setdefault('VMFXX', 0.0)
+            shares_by_date[date] = shares
+        funds = Fund.objects.in_bulk(list({ticker
+                                           for shares
+                                            in shares_by_date.values()
+                                           for ticker in shares}))
+        for date, shares in shares_by_date.items():
+            ans[date] = AccountShares.priced(
+                          account, date,
+                          [(funds[ticker], num_shares)
+                           for ticker, num_shares in shares.items()
+                            if ticker == 'VMFXX' or abs(num_shares) > 0.01])
+        return ans
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['account', 'fund', 'date'],
-                                    name='unique_account_shares_per_date'),
+                                    name='unique_account_checkpoint'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'date'],
+                         name='account_checkpoint_by_date'),
         ]
         get_latest_by = 'date'
 
@@ -28,10 +28,15 @@ The overrides for the Category tree are at the parent/child link level, rather
 than directly on the Category objects.
 '''
 
+import copy
+import threading
+from collections import OrderedDict
 from itertools import groupby, chain
 from operator import attrgetter
 
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_init, post_save
 
 
 __all__ = (
@@ -91,6 +96,60 @@ def add_context(query, account, initial_order=None, tags=None):
     return filtered_query.order_by(*order_fields)
 
 
+# {(account_id, category_id, tags): tree} of the trees returned by
+# Category.get_tree, least recently used first.  These are never handed out
+# directly, only copies of them.
+#
+# This is cleared whenever anything that goes into the trees is saved or
+# deleted (see clear_tree_cache): the Categories, CategoryLinks, Plans,
+# CategoryFunds and Funds, and the owner or category of an Account.  Changes
+# made with QuerySet.update (which sends no signals) must call
+# clear_tree_cache themselves.
+#
+# The cache is per process, and only the changes made in this process clear
+# it.  Other processes keep their trees until they are pushed out, so they
+# need restarting after the categories have been changed elsewhere (e.g.
+# through the admin of another server process).
+Tree_cache = OrderedDict()
+Tree_cache_lock = threading.Lock()
+
+def tree_cache_size():
+    r'''Returns the number of trees kept in Tree_cache.
+
+    This is set by TREE_CACHE_SIZE in settings.py.
+    '''
+    return getattr(settings, 'TREE_CACHE_SIZE', 100)
+
+def clear_tree_cache(**kwargs):
+    r'''Signal receiver to clear the Tree_cache.
+    '''
+    with Tree_cache_lock:
+        Tree_cache.clear()
+
+# The Account fields that go into its trees.
+Account_tree_fields = ('owner_id', 'category_id')
+
+def note_account_tree_fields(sender, instance, **kwargs):
+    r'''Signal receiver to note the Account_tree_fields as loaded.
+    '''
+    instance._tree_fields = \
+      tuple(instance.__dict__.get(name) for name in Account_tree_fields)
+
+def account_saved(sender, instance, created, **kwargs):
+    r'''Signal receiver to clear the Tree_cache when an Account's trees
+    change.
+
+    The Accounts are saved all of the time as their shares are updated, so
+    this only clears the Tree_cache when one of the Account_tree_fields has
+    changed.
+    '''
+    tree_fields = tuple(getattr(instance, name)
+                        for name in Account_tree_fields)
+    if created or tree_fields != getattr(instance, '_tree_fields', None):
+        clear_tree_cache()
+    instance._tree_fields = tree_fields
+
+
 class Category(models.Model):
     name = models.CharField(max_length=40)
 
@@ -117,7 +176,31 @@ class Category(models.Model):
 
           - children (in order)
 
+        The trees are cached (see Tree_cache).  Each call gets its own copy,
+        so the caller is free to add more attributes.
+        '''
+        key = account.id, self.id, tuple(tags)
+        with Tree_cache_lock:
+            tree = Tree_cache.get(key)
+            if tree is not None:
+                Tree_cache.move_to_end(key)
+        if tree is None:
+            tree = self.resolve_tree(account, tags)
+            with Tree_cache_lock:
+                Tree_cache[key] = tree
+                while len(Tree_cache) > tree_cache_size():
+                    Tree_cache.popitem(last=False)
+
+        # The copies share the caller's `account`.
+        return copy.deepcopy(tree, {id(tree[0].account): account})
+
+    def resolve_tree(self, account, tags=()):
+        r'''Does the work for get_tree, without the cache.
+
+        The CategoryLinks, Plans and CategoryFunds for the whole tree are
+        loaded up front (see tree_context), rather than node by node.
         '''
+        context = tree_context(account, tags)
         tree = []
         order = 1
 
@@ -129,10 +212,10 @@ class Category(models.Model):
             cat.depth = depth
             cat.order = order
             order += 1
-            cat.plan = cat.get_plan(account, tags=tags)
+            cat.plan = context.get_plan(cat)
             #print("cat", cat.name, "plan", cat.plan)
-            cat.fund = cat.get_fund(account)
-            cat.children = cat.get_children(account, tags=tags)
+            cat.fund = context.get_fund(cat)
+            cat.children = context.get_children(cat)
             for child in cat.children:
                 fill_in_cat(child, depth=depth+1)
 
@@ -161,12 +244,18 @@ class Category(models.Model):
         r'''Returns a list of this Category's children.
         '''
         # get all applicable children (ordered by order)
+        return self.select_children(add_context(self.child_links, account,
+                                                'order', tags=tags)
+                                      .all())
+
+    def select_children(self, links):
+        r'''Returns a list of the children selected from `links`.
+
+        `links` are this Category's CategoryLinks as ordered by add_context
+        (by `order`, then most relevant first).
+        '''
         links = [tuple(matches)
-                    for _, matches
-                     in groupby(add_context(self.child_links, account,
-                                            'order', tags=tags)
-                                  .all(),
-                                key=attrgetter('order'))]
+                    for _, matches in groupby(links, key=attrgetter('order'))]
         ans = []
         if links:
             selected_tag = links[0][0].tag
@@ -196,6 +285,52 @@ class Category(models.Model):
         return tested
 
 
+class tree_context:
+    r'''All of the CategoryLinks, Plans and CategoryFunds for one account/tags.
+
+    These are loaded in three queries, using add_context so that the
+    owner/account/tag overrides are the same as Category.get_plan, get_fund
+    and get_children.  The methods here then return the same results as
+    those, without going back to the database.
+    '''
+    def __init__(self, account, tags=()):
+        # {parent_id: [CategoryLink]} ordered by order, most relevant first.
+        # sorted is stable, so this keeps the add_context order within each
+        # `order`.
+        self.links = {
+          parent_id: list(links)
+          for parent_id, links
+           in groupby(sorted(add_context(CategoryLink.objects
+                                                     .select_related('child'),
+                                         account, tags=tags),
+                             key=attrgetter('parent_id', 'order')),
+                      key=attrgetter('parent_id'))
+        }
+
+        # {category_id: Plan}, taking the most relevant one.
+        self.plans = {}
+        for plan in add_context(Plan.objects.all(), account, tags=tags):
+            self.plans.setdefault(plan.category_id, plan)
+
+        # {category_id: Fund}, taking the most relevant one.
+        self.funds = {}
+        for cf in add_context(CategoryFund.objects.select_related('fund'),
+                              account):
+            self.funds.setdefault(cf.category_id, cf.fund)
+
+    def get_plan(self, cat):
+        return self.plans.get(cat.id)
+
+    def get_fund(self, cat):
+        return self.funds.get(cat.id)
+
+    def get_children(self, cat):
+        # The children are copied, because the same Category may appear more
+        # than once in the tree.
+        return [copy.copy(child)
+                for child in cat.select_children(self.links.get(cat.id, ()))]
+
+
 class CategoryLink(models.Model):
     r'''Links subordinate Categories to their parent Categories.
 
@@ -301,3 +436,17 @@ class CategoryFund(models.Model):
     account = models.ForeignKey('Account', on_delete=models.CASCADE,
                                 null=True, blank=True)
 
+
+for sender in (Category, CategoryLink, Plan, CategoryFund,
+               'investment_tracker.Fund'):
+    post_save.connect(clear_tree_cache, sender=sender,
+                      dispatch_uid='clear_tree_cache')
+    post_delete.connect(clear_tree_cache, sender=sender,
+                        dispatch_uid='clear_tree_cache')
+post_init.connect(note_account_tree_fields,
+                  sender='investment_tracker.Account',
+                  dispatch_uid='note_account_tree_fields')
+post_save.connect(account_saved, sender='investment_tracker.Account',
+                  dispatch_uid='clear_tree_cache')
+post_delete.connect(clear_tree_cache, sender='investment_tracker.Account',
+                    dispatch_uid='clear_tree_cache')
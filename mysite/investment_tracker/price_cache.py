@@ -0,0 +1,339 @@
+# price_cache.py
+
+r'''Per-process cache of each fund's FundPriceCalendar as arrays.
+
+Each fund's calendar is held as a `fund_prices` object: one compact array per
+column, with a row for every day.  So the price as of any date within the
+calendar is found by indexing straight into the arrays (`fund_prices.index_on`).
+The dates are held as ordinals (see date.toordinal).
+
+Use `get` to get a fund's prices.  The first `get` loads the fund's whole
+calendar.  After that, the fund is checked again when:
+
+  * `prices_added` has been called for the fund (as the price loaders in this
+    process do), or
+
+  * PRICE_CACHE_REFRESH seconds have gone by since the fund was last checked,
+    to pick up prices loaded by other processes.
+
+Each check reloads the days after the last real (not carried forward)
+close.  The days through that close are only reloaded if they have changed
+in the database since they were loaded, as when another process has
+corrected or backfilled the prices (see FundPriceHistory.upsert_prices).
+This is found by their count and largest id (the calendar rows are
+replaced, not updated, when they are redone), which is one query.
+
+Funds are evicted, least recently used first, to keep the cache within
+PRICE_CACHE_MAX_BYTES.  Use `invalidate` to reload a fund at once after
+changing its prices in this process.
+
+For a single pass over a window of one fund's dates, a `calendar_stream`
+reads the calendar rows as they are needed instead, without caching them.
+
+With PRICE_MATRIX 'on', `get` returns the prices of the funds in the shared
+price_matrix file instead, and only caches the rest.
+'''
+
+import math
+import time
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import date
+
+from django.conf import settings
+from django.db import models
+
+
+def max_bytes():
+    return getattr(settings, 'PRICE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+
+def refresh_seconds():
+    return getattr(settings, 'PRICE_CACHE_REFRESH', 60)
+
+
+class fund_prices:
+    r'''One fund's FundPriceCalendar as arrays, with a row for every day.
+
+    `close_days` are the days of the closes (which differ from `dates` on the
+    carried forward days).  The missing trough_closes are NaN and the missing
+    trough_dates are 0.
+    '''
+    Columns = ('dates', 'close_days', 'closes', 'peak_closes', 'peak_dates',
+               'trough_closes', 'trough_dates')
+
+    def __init__(self, fund_id):
+        self.fund_id = fund_id
+        self.dates = array('q')
+        self.close_days = array('q')
+        self.closes = array('d')
+        self.peak_closes = array('d')
+        self.peak_dates = array('q')
+        self.trough_closes = array('d')
+        self.trough_dates = array('q')
+        self.checked = None   # time.time() of the last load
+
+        # The count and largest id of the calendar rows through the last
+        # close, as loaded.
+        self.marker = 0, 0
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def nbytes(self):
+        return len(self) * len(self.Columns) * 8
+
+    def truncate(self, n):
+        r'''Drops all but the first `n` rows.
+        '''
+        for name in self.Columns:
+            del getattr(self, name)[n:]
+
+    def extend(self, rows):
+        r'''Appends `rows` (see `load`), which must follow on from the last day.
+        '''
+        for d, close, peak_close, peak_date, trough_close, trough_date, \
+            carried_forward \
+         in rows:
+            day = d.toordinal()
+            assert not self.dates or day == self.dates[-1] + 1, \
+                   f"price_cache: {self.fund_id} row for {d} out of order"
+            self.dates.append(day)
+            self.close_days.append(self.close_days[-1] if carried_forward
+                                                       else day)
+            self.closes.append(close)
+            self.peak_closes.append(peak_close)
+            self.peak_dates.append(peak_date.toordinal())
+            self.trough_closes.append(math.nan if trough_close is None
+                                               else trough_close)
+            self.trough_dates.append(0 if trough_date is None
+                                       else trough_date.toordinal())
+
+    def load(self):
+        r'''Loads the days after the last close from the database.
+
+        The carried forward days after the last close are reloaded too, as
+        they are redone when new closes are added.  If the days through the
+        last close have changed since they were loaded, everything is
+        reloaded.
+        '''
+        # Avoid a circular import.
+        from .fund_models import FundPriceCalendar, Calendar_fields
+
+        query = FundPriceCalendar.objects.filter(fund_id=self.fund_id)
+        if self.dates:
+            last_close = self.close_days[-1]
+            loaded = query.filter(date__lte=date.fromordinal(last_close)) \
+                          .aggregate(count=models.Count('id'),
+                                     max_id=models.Max('id'))
+            if (loaded['count'], loaded['max_id'] or 0) == self.marker:
+                self.truncate(last_close - self.dates[0] + 1)
+                query = query.filter(date__gt=date.fromordinal(last_close))
+            else:
+                print(f"price_cache: {self.fund_id} changed, reloading")
+                self.truncate(0)
+                self.marker = 0, 0
+
+        def rows():
+            # Moves each row through the last close into the marker.
+            count, max_id = self.marker
+            carried = []    # the ids of the rows since the last close
+            for row in query.order_by('date') \
+                            .values_list('id', *Calendar_fields,
+                                         'carried_forward') \
+                            .iterator():
+                yield row[1:]
+                if row[-1]:
+                    carried.append(row[0])
+                else:
+                    count += len(carried) + 1
+                    max_id = max(max_id, row[0], *carried)
+                    carried = []
+            self.marker = count, max_id
+
+        self.extend(rows())
+        self.checked = time.time()
+
+    def index_on(self, d, max_days=None):
+        r'''Returns the index of the price as of date `d`.
+
+        Returns None if `d` is before the first price.  If `d` is after the
+        last day in the calendar, the last day is used, unless it's more than
+        `max_days` (if not None) before `d`.
+        '''
+        if not self.dates:
+            return None
+        day = d.toordinal()
+        i = day - self.dates[0]
+        if i < 0:
+            return None
+        if i < len(self.dates):
+            return i
+        if max_days is not None and day - self.dates[-1] > max_days:
+            return None
+        return len(self.dates) - 1
+
+    def fph(self, i):
+        r'''Returns the FundPriceHistory (not saved) for index `i`.
+
+        Its date is that of the close.
+        '''
+        from .fund_models import FundPriceHistory
+
+        trough_close = self.trough_closes[i]
+        return FundPriceHistory(
+                 fund_id=self.fund_id,
+                 date=date.fromordinal(self.close_days[i]),
+                 close=self.closes[i],
+                 peak_close=self.peak_closes[i],
+                 peak_date=date.fromordinal(self.peak_dates[i]),
+                 trough_close=None if math.isnan(trough_close)
+                                   else trough_close,
+                 trough_date=date.fromordinal(self.trough_dates[i])
+                               if self.trough_dates[i] else None)
+
+    def as_of(self, d, max_days=None):
+        r'''Returns the FundPriceHistory (not saved) as of date `d`.
+
+        Returns None if there isn't one (see `index_on`).
+        '''
+        i = self.index_on(d, max_days)
+        if i is None:
+            return None
+        return self.fph(i)
+
+
+class calendar_stream:
+    r'''Reads one fund's FundPriceCalendar from `start_date` on, in order.
+
+    This has the same `as_of` as `fund_prices`, but the dates asked for must
+    not go backwards.  Only the rows from the last one on or before
+    `start_date` through `end_date` (None for the end) are read, `chunk_size`
+    at a time, and only the current row is kept.
+    '''
+    def __init__(self, fund_id, start_date, end_date=None, chunk_size=2000):
+        # Avoid a circular import.
+        from .fund_models import FundPriceCalendar, Calendar_fields
+
+        self.fund_id = fund_id
+        calendar = FundPriceCalendar.objects.filter(fund_id=fund_id)
+        self.current = calendar.filter(date__lte=start_date) \
+                               .order_by('-date') \
+                               .values_list(*Calendar_fields,
+                                            'carried_forward') \
+                               .first()
+        self.close_day = None
+        if self.current is not None:
+            self.close_day = self.current[0]
+            if self.current[-1]:
+                self.close_day = calendar.filter(date__lt=self.current[0],
+                                                 carried_forward=False) \
+                                         .order_by('-date') \
+                                         .values_list('date', flat=True) \
+                                         .first()
+        rows = calendar.filter(date__gt=start_date)
+        if end_date is not None:
+            rows = rows.filter(date__lte=end_date)
+        self.rows = rows.order_by('date') \
+                        .values_list(*Calendar_fields, 'carried_forward') \
+                        .iterator(chunk_size=chunk_size)
+        self.next = next(self.rows, None)
+        self.last_day = None
+
+    def as_of(self, d, max_days=None):
+        r'''Returns the FundPriceHistory (not saved) as of date `d`.
+
+        Returns None if there isn't one (see `fund_prices.index_on`).
+        '''
+        from .fund_models import FundPriceHistory
+
+        assert self.last_day is None or d >= self.last_day, \
+               f"calendar_stream: {self.fund_id} {d} is before {self.last_day}"
+        self.last_day = d
+        while self.next is not None and self.next[0] <= d:
+            self.current = self.next
+            if not self.current[-1]:
+                self.close_day = self.current[0]
+            self.next = next(self.rows, None)
+        if self.current is None:
+            return None
+        if self.next is None and max_days is not None and \
+           (d - self.current[0]).days > max_days:
+            return None
+        _, close, peak_close, peak_date, trough_close, trough_date, _ = \
+          self.current
+        return FundPriceHistory(fund_id=self.fund_id, date=self.close_day,
+                                close=close, peak_close=peak_close,
+                                peak_date=peak_date, trough_close=trough_close,
+                                trough_date=trough_date)
+
+
+# {fund_id: fund_prices}, least recently used first.
+Cache = OrderedDict()
+Cache_lock = threading.Lock()
+
+# fund_ids with prices added since they were loaded.
+Added = set()
+
+
+def get(fund_id):
+    r'''Returns the fund_prices for `fund_id`, up to date.
+    '''
+    # Avoid a circular import.
+    from . import price_matrix
+
+    if price_matrix.matrix_mode() == 'on':
+        prices = price_matrix.get(fund_id)
+        if prices is not None:
+            return prices
+    with Cache_lock:
+        prices = Cache.get(fund_id)
+        if prices is None:
+            prices = fund_prices(fund_id)
+            prices.load()
+            Cache[fund_id] = prices
+            Added.discard(fund_id)
+            evict(keep=fund_id)
+        else:
+            Cache.move_to_end(fund_id)
+            if fund_id in Added or \
+               time.time() - prices.checked > refresh_seconds():
+                prices.load()
+                Added.discard(fund_id)
+                evict(keep=fund_id)
+        return prices
+
+
+def prices_added(fund_id):
+    r'''Called when prices are added after the last date for `fund_id`.
+    '''
+    with Cache_lock:
+        Added.add(fund_id)
+
+
+def invalidate(fund_id=None):
+    r'''Drops `fund_id` (default all funds) from the cache.
+    '''
+    with Cache_lock:
+        if fund_id is None:
+            Cache.clear()
+            Added.clear()
+        else:
+            Cache.pop(fund_id, None)
+            Added.discard(fund_id)
+
+
+def evict(keep=None):
+    r'''Evicts the least recently used funds to fit within `max_bytes`.
+
+    `keep` is never evicted.  Must be called with the Cache_lock held.
+    '''
+    limit = max_bytes()
+    total = sum(prices.nbytes for prices in Cache.values())
+    for fund_id in list(Cache):
+        if total <= limit:
+            break
+        if fund_id != keep:
+            total -= Cache.pop(fund_id).nbytes
@@ -0,0 +1,280 @@
+# price_matrix.py
+
+r'''Memory-mapped fund x date matrix of all of the FundPriceCalendars.
+
+This is controlled by PRICE_MATRIX in settings.py:
+
+  * 'off' leaves each process to load its own prices into the price_cache
+    (the default).
+
+  * 'on' has the price_cache serve the prices of the funds in the matrix
+    from a file under PRICE_MATRIX_DIR instead.  The file is mapped into
+    memory read-only, so all of the web workers and batch jobs share one
+    copy of it (through the operating system's page cache), and nothing is
+    copied out of it.  A process starting up only reads the small index,
+    rather than the price table.
+
+The data file has a block of rows for each of the fund_prices columns
+(other than `dates`), in `Blocks` order.  Each block has a row per fund and
+a column per day, from the first day of any fund's calendar through the
+last.  Each value is 8 bytes (a float or an ordinal).  The days before a
+fund's first day and after its last day are 0.
+
+`index.json` has the version, the name of the data file, the first day and
+number of days, and each fund's row, first day and last day.
+
+The price loaders call `update` (after their transactions commit) with the
+funds they changed.  This writes a new data file, with those funds read from
+FundPriceCalendar and the rest copied from the current version, then
+replaces index.json to point to it.  Both files are written under temporary
+names and renamed into place, so readers see either the old version or the
+new one.  The writers lock `lock` in PRICE_MATRIX_DIR, so that only one
+writes at a time.  Readers check index.json on each `get`.  The prices
+already handed out keep using their version's file.  Only the current and
+previous data files are kept.
+
+Use the update_price_matrix command to write the first version.
+'''
+
+import os
+import os.path
+import json
+import mmap
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the writers aren't locked against each other there.
+    fcntl = None
+
+from django.conf import settings
+
+from .price_cache import fund_prices
+
+
+def matrix_mode():
+    r'''Returns 'off' or 'on'.  See above.
+    '''
+    return getattr(settings, 'PRICE_MATRIX', 'off')
+
+
+def matrix_dir():
+    return getattr(settings, 'PRICE_MATRIX_DIR',
+                   os.path.join(settings.BASE_DIR, 'price_matrix'))
+
+
+def index_path():
+    return os.path.join(matrix_dir(), 'index.json')
+
+
+# The blocks of rows in the data file, in order, with their array typecodes.
+Blocks = (
+    ('close_days', 'q'),
+    ('closes', 'd'),
+    ('peak_closes', 'd'),
+    ('peak_dates', 'q'),
+    ('trough_closes', 'd'),
+    ('trough_dates', 'q'),
+)
+
+
+class mapped_prices(fund_prices):
+    r'''One fund's prices, as views into a matrix_version.
+
+    These have the same columns as fund_prices, but `dates` is a range and
+    the rest are memoryviews of the mapped file.  They can't be loaded.
+    '''
+    def __init__(self, fund_id, first_day, last_day, columns):
+        self.fund_id = fund_id
+        self.dates = range(first_day, last_day + 1)
+        for name, _ in Blocks:
+            setattr(self, name, columns[name])
+        self.checked = None
+
+    @property
+    def nbytes(self):
+        # The mapped pages are shared, not held by this process.
+        return 0
+
+    def load(self):
+        raise AssertionError(f"price_matrix: {self.fund_id} can't be loaded")
+
+
+class matrix_version:
+    r'''One version of the matrix, mapped into memory.
+
+    `funds` is {ticker: (row, first_day, last_day)}.
+    '''
+    def __init__(self, index):
+        self.version = index['version']
+        self.data = index['data']
+        self.start = index['start']
+        self.num_days = index['days']
+        self.funds = {ticker: (row, first_day, last_day)
+                      for ticker, row, first_day, last_day in index['funds']}
+        self.views = {}
+        self.prices = {}   # {ticker: mapped_prices}
+        if self.funds and self.num_days:
+            with open(os.path.join(matrix_dir(), self.data), 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            block_bytes = len(self.funds) * self.num_days * 8
+            for i, (name, typecode) in enumerate(Blocks):
+                self.views[name] = \
+                  memoryview(self.mm)[i * block_bytes:(i + 1) * block_bytes] \
+                    .cast(typecode)
+
+    def get(self, ticker):
+        r'''Returns the mapped_prices for `ticker`, or None if not in here.
+        '''
+        prices = self.prices.get(ticker)
+        if prices is None and ticker in self.funds:
+            row, first_day, last_day = self.funds[ticker]
+            lo = row * self.num_days + first_day - self.start
+            hi = lo + last_day - first_day + 1
+            prices = self.prices[ticker] = \
+              mapped_prices(ticker, first_day, last_day,
+                            {name: view[lo:hi]
+                             for name, view in self.views.items()})
+        return prices
+
+
+Current = None        # matrix_version
+Current_stat = None   # os.stat of the index.json it came from
+Current_lock = threading.Lock()
+
+
+def current():
+    r'''Returns the current matrix_version, or None if none has been written.
+    '''
+    global Current, Current_stat
+
+    path = index_path()
+    with Current_lock:
+        for tries in range(2):
+            try:
+                st = os.stat(path)
+                stat = st.st_ino, st.st_mtime_ns, st.st_size
+                if Current is None or stat != Current_stat:
+                    with open(path) as f:
+                        Current = matrix_version(json.load(f))
+                    Current_stat = stat
+                return Current
+            except FileNotFoundError:
+                # There's no index yet, or its data file was deleted after
+                # we read it, because two new versions were written since.
+                Current = Current_stat = None
+        return None
+
+
+def get(fund_id):
+    r'''Returns the mapped_prices for `fund_id`, or None if not in the matrix.
+    '''
+    version = current()
+    if version is None:
+        return None
+    return version.get(fund_id)
+
+
+@contextmanager
+def write_lock():
+    r'''Holds the lock on `lock` in the matrix_dir, for `write`.
+    '''
+    directory = matrix_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'lock'), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield     # closing f releases the lock
+
+
+def update(tickers=None):
+    r'''Writes a new version of the matrix, if PRICE_MATRIX is 'on'.
+
+    See `write`.
+    '''
+    if matrix_mode() == 'on':
+        return write(tickers)
+    return None
+
+
+def write(tickers=None):
+    r'''Writes a new version of the matrix.
+
+    `tickers` are the funds whose FundPriceCalendars have changed (None for
+    all).  The other funds are copied from the current version, unless their
+    calendars now cover different days.
+
+    Returns the new version number.
+    '''
+    # Avoid a circular import.
+    from django.db.models import Min, Max
+    from .fund_models import FundPriceCalendar
+
+    # The index is read and replaced, and the old data files removed, by
+    # one process at a time.  Otherwise two writers would both make the
+    # same next version, each removing the other's data file.
+    with write_lock():
+        old = current()
+        ranges = {fund_id: (first_date.toordinal(), last_date.toordinal())
+                  for fund_id, first_date, last_date
+                   in FundPriceCalendar.objects.values('fund_id')
+                                       .annotate(Min('date'), Max('date'))
+                                       .order_by('fund_id')
+                                       .values_list('fund_id', 'date__min',
+                                                    'date__max')}
+
+        def fund_columns(ticker):
+            if old is not None and tickers is not None and \
+               ticker not in tickers and \
+               old.funds.get(ticker, (None,))[1:] == ranges[ticker]:
+                return old.get(ticker)
+            prices = fund_prices(ticker)
+            prices.load()
+            assert (prices.dates[0], prices.dates[-1]) == ranges[ticker], \
+                   f"price_matrix: {ticker} calendar changed while writing"
+            return prices
+
+        version = 1 if old is None else old.version + 1
+        start = min((first_day for first_day, _ in ranges.values()),
+                    default=0)
+        end = max((last_day for _, last_day in ranges.values()),
+                  default=-1)
+        num_days = end - start + 1
+        funds = sorted(ranges)
+        columns = [fund_columns(ticker) for ticker in funds]
+
+        directory = matrix_dir()
+        data = f"prices-{version}-{os.getpid()}.bin"
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            for name, _ in Blocks:
+                for ticker, prices in zip(funds, columns):
+                    first_day, last_day = ranges[ticker]
+                    f.write(bytes((first_day - start) * 8))
+                    f.write(getattr(prices, name))
+                    f.write(bytes((end - last_day) * 8))
+        os.replace(temp_path, os.path.join(directory, data))
+
+        index = dict(version=version, data=data, start=start, days=num_days,
+                     funds=[(ticker, row) + ranges[ticker]
+                            for row, ticker in enumerate(funds)])
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, index_path())
+
+        # Keep the previous version for readers that have just read the old
+        # index.json.
+        keep = {data} if old is None else {data, old.data}
+        for name in os.listdir(directory):
+            if name.startswith('prices-') and name not in keep:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass   # still open elsewhere (Windows)
+        print(f"price_matrix: version {version} written, {len(funds)} funds, "
+                f"{num_days} days")
+        return version
@@ -0,0 +1,226 @@
+# providers.py
+
+r'''Market-data providers for the fund history.
+
+A provider gets a fund's daily closing prices and its dividends from
+somewhere.  FundPriceHistory and FundDividendHistory load them through
+`get_provider`, which returns the provider selected by MARKET_DATA_PROVIDER
+in settings.py:
+
+  * 'yahoo' gets them from finance.yahoo.com.
+
+  * 'standin' gets them from the local stand-in server (see
+    standin_server.py) at MARKET_DATA_STANDIN_URL.  This serves synthetic
+    data in the same format as Yahoo, for testing without a network.
+
+To add a provider, subclass Provider and add a function to create it to
+`Providers`.
+'''
+
+import calendar
+from datetime import datetime, date, timedelta
+import csv
+
+import requests
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from . import yahoo_cache
+
+
+class Provider_exception(Exception):
+    r'''Raised by providers when they can't get the data.
+    '''
+    def response(self):
+        r = HttpResponse(self.args[0])
+        r.status_code = 503
+        return r
+
+
+One_day = timedelta(days=1)
+
+
+class Provider:
+    r'''The interface to a market-data provider.
+    '''
+    def prices(self, ticker, start_date=None):
+        r'''Generates date, close for `ticker` in date order.
+
+        These run from `start_date` (default: as far back as the provider
+        goes) through yesterday.  `close` is None for dates that the provider
+        has no closing price for.  The closes include splits, but not
+        dividends.
+
+        Raises Provider_exception if the prices can't be gotten.
+        '''
+        raise NotImplementedError
+
+    def dividends(self, ticker, start_date=None):
+        r'''Generates date, dividends for `ticker` in date order.
+
+        Otherwise, like `prices`.
+        '''
+        raise NotImplementedError
+
+
+def yahoo_period(d, as_end_date=False):
+    r'''Yahoo uses standard Unix seconds since the epoch for its periods.
+
+    If `as_end_date` is False, returns midnight UTC on the morning of day `d`.
+    Otherwise, returns midnight UTC at the end of day `d`.
+
+    `d` must be a Python date object.
+    '''
+    if as_end_date:
+        d += One_day
+    return calendar.timegm(d.timetuple())
+
+def yahoo_url(ticker, events, start_date=None, end_date=None,
+              base_url='https://query1.finance.yahoo.com'):
+    r'''Returns the URL to query Yahoo for fund history.
+
+    `start_date` is the first day to include in the data (defaults to
+    the beginning of time).
+
+    `end_date` is the last day to include in the data (defaults to yesterday).
+
+    This asserts that start_date <= end_date, and end_date < today.
+
+    We don't need adjusted close data from Yahoo.
+    '''
+    if start_date is None:
+        start_date = date(1970, 1, 1)
+        print("Defaulting start_date to", start_date)
+    period1 = yahoo_period(start_date, as_end_date=False)
+    print("start_date is", start_date, "period1 is", period1)
+    if end_date is None:
+        # default to yesterday
+        end_date = date.today() - One_day
+    period2 = yahoo_period(end_date, as_end_date=True)
+    print("end_date is", end_date, "period2 is", period2)
+
+    assert period1 <= period2, \
+           f"yahoo_url: start_date, {start_date}, must be <= end_date, " \
+             f"{end_date}"
+
+    assert end_date < date.today(), \
+           f"yahoo_url: end_date, {end_date}, must be < today"
+
+    url = f"{base_url}/v7/finance/download/{ticker}" \
+          f"?period1={period1}&period2={period2}&interval=1d&events={events}"
+    #print("yahoo_url:", url)
+    return url
+
+def yahoo_workers():
+    r'''Returns the number of funds fetched from Yahoo at the same time.
+
+    This is set by YAHOO_WORKERS in settings.py.
+    '''
+    return getattr(settings, 'YAHOO_WORKERS', 4)
+
+
+Yahoo_session = None
+
+def yahoo_session():
+    r'''Returns the requests Session shared by all Yahoo requests.
+
+    This reuses its connections, keeping up to `yahoo_workers` of them open.
+    '''
+    global Yahoo_session
+    if Yahoo_session is None:
+        session = requests.Session()
+        session.headers.update({'user-agent': 'Mozilla'})
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=yahoo_workers())
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        Yahoo_session = session
+    return Yahoo_session
+
+def get_yahoo(url, stream=False):
+    r'''Returns the requests response for the Yahoo `url`.
+
+    With `stream`, the body is left to be read as it arrives (see
+    `csv_rows`).  Use the response as a context manager in that case.
+
+    The response may come from the yahoo_cache (see YAHOO_CACHE in
+    settings.py), in which case it is never streamed.
+    '''
+    if yahoo_cache.cache_mode() == 'off':
+        return yahoo_session().get(url, stream=stream)
+    return yahoo_cache.get(url, lambda: yahoo_session().get(url))
+
+
+def csv_rows(r):
+    r'''Generates the csv rows in the streamed response `r` as they arrive.
+
+    Each row is a dict, as from csv.DictReader.
+    '''
+    if r.encoding is None:
+        r.encoding = 'utf-8'
+    return csv.DictReader(r.iter_lines(decode_unicode=True))
+
+
+def todate(s):
+    r'''This converts a date downloaded from Yahoo into a Python date object.
+
+    The Yahoo format is: YYYY-MM-DD
+
+    Note that this is different than Vanguard's format (see models.py)!
+    '''
+    return datetime.strptime(s, "%Y-%m-%d").date()
+
+
+class Yahoo_provider(Provider):
+    r'''Gets the data from Yahoo's csv downloads at `base_url`.
+    '''
+    def __init__(self, base_url='https://query1.finance.yahoo.com'):
+        self.base_url = base_url
+
+    def yahoo_rows(self, ticker, events, what, start_date):
+        r'''Generates the csv rows from Yahoo as dicts.
+
+        `what` is just for the error messages.
+        '''
+        url = yahoo_url(ticker, events, start_date, base_url=self.base_url)
+        with get_yahoo(url, stream=True) as r:
+            if r.status_code != 200:
+                print(f"Bad status code from Yahoo {r.status_code} "
+                        f"for {ticker} {what}, "
+                        f"content-type {r.headers['content-type']}")
+                print(r.text)
+                raise Provider_exception(
+                        f"Bad status code from yahoo for {ticker} {what}: "
+                          f"{r.status_code}")
+            if r.headers['content-type'].split(';')[0] != 'text/csv':
+                raise Provider_exception(
+                        f"Expected text/csv from yahoo for {ticker} {what}, "
+                          f"got {r.headers['content-type']}")
+            yield from csv_rows(r)
+
+    def prices(self, ticker, start_date=None):
+        for row in self.yahoo_rows(ticker, 'history', 'prices', start_date):
+            #print(row)
+            if row['Close'] == 'null':
+                yield todate(row['Date']), None
+            else:
+                yield todate(row['Date']), float(row['Close'])
+
+    def dividends(self, ticker, start_date=None):
+        for row in self.yahoo_rows(ticker, 'div', 'dividends', start_date):
+            #print(row)
+            yield todate(row['Date']), float(row['Dividends'])
+
+
+# {name: function returning the Provider}
+Providers = {
+    'yahoo': Yahoo_provider,
+    'standin': lambda: Yahoo_provider(
+                         getattr(settings, 'MARKET_DATA_STANDIN_URL',
+                                 'http://localhost:8765')),
+}
+
+def get_provider():
+    r'''Returns the Provider selected by MARKET_DATA_PROVIDER in settings.py.
+    '''
+    return Providers[getattr(settings, 'MARKET_DATA_PROVIDER', 'yahoo')]()
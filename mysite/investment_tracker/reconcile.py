@@ -0,0 +1,213 @@
+# reconcile.py
+
+r'''Checks the shares calculated from the transactions against the broker.
+
+Each download's balances are stored as BrokerBalances, as of its end_date
+(see Account.import_csv).  `reconcile` looks up the calculated shares for
+all of them at once in the holdings_cube, and reports each account's fund
+whose shares have drifted from the broker's by more than the tolerance:
+
+  * RECONCILE_TOLERANCE in settings.py is the tolerance in shares.
+
+  * RECONCILE_CASH_TOLERANCE is the tolerance for the money market funds,
+    in dollars.  Their calculated shares leave out the accrued dividends
+    (see AccountTransactionHistory), so they are always a little off.
+
+The funds that the broker doesn't report are taken as 0 shares, so funds
+that should have been sold off are caught too.
+
+For each fund that has drifted, the report gives the first broker date
+where it is off (`first_drift`) and the last broker date before that where
+it matched (`last_match`).  The calculation went wrong between these dates.
+The shares only change on trade dates, so `suspect_date` (the first
+transaction in that fund after `last_match`) is the earliest date where the
+calculation could have gone wrong.
+
+The broker dates after the shares loaded (before update_shares has been
+run) are skipped.
+
+This requires numpy.
+'''
+
+from datetime import date
+
+from django.conf import settings
+
+import numpy as np
+
+from . import models, holdings_cube
+
+
+def tolerance():
+    return getattr(settings, 'RECONCILE_TOLERANCE', 0.01)
+
+
+def cash_tolerance():
+    return getattr(settings, 'RECONCILE_CASH_TOLERANCE', 1.0)
+
+
+def reconcile(account_ids=None, shares_tolerance=None,
+              money_market_tolerance=None):
+    r'''Returns the report on the accounts' funds that have drifted.
+
+    `account_ids` defaults to all accounts.  The tolerances default to the
+    settings above.
+
+    Returns a models.attrs with:
+
+      * checked: the number of account fund dates checked (the broker
+        balances, plus the funds held that the broker didn't report),
+      * skipped: the number of broker balances outside the shares loaded,
+      * drifts: a list of models.attrs, one for each account's fund that has
+        drifted, in account_id, holdings_cube fund order.  These have the account_id,
+        ticker, first_drift, last_match, suspect_date, and the date,
+        broker_shares, shares (calculated), drift (shares less
+        broker_shares), broker_balance and balance on the latest broker
+        date.
+    '''
+    if shares_tolerance is None:
+        shares_tolerance = tolerance()
+    if money_market_tolerance is None:
+        money_market_tolerance = cash_tolerance()
+
+    cube = holdings_cube.get()
+    query = models.BrokerBalance.objects.all()
+    if account_ids is not None:
+        query = query.filter(account_id__in=account_ids)
+    rows = list(query.values_list('account_id', 'fund_id', 'date', 'shares',
+                                  'balance'))
+    if not rows:
+        return models.attrs(checked=0, skipped=0, drifts=[])
+
+    # The funds on the fund axis here are the cube's, plus the ones only
+    # the broker has.
+    tickers = list(cube.tickers)
+    fund_index = dict(cube.fund_index)
+    for _, ticker, _, _, _ in rows:
+        if ticker not in fund_index:
+            fund_index[ticker] = len(tickers)
+            tickers.append(ticker)
+    money_markets = frozenset(models.Fund.objects.filter(money_market=True)
+                                                 .values_list('ticker',
+                                                              flat=True))
+    tolerances = np.array([money_market_tolerance
+                             if ticker == 'VMFXX' or ticker in money_markets
+                             else shares_tolerance
+                           for ticker in tickers])
+
+    account_col, fund_col, date_col, shares_col, balance_col = zip(*rows)
+    accounts = np.array(account_col, dtype=np.int64)
+    funds = np.array([fund_index[ticker] for ticker in fund_col],
+                     dtype=np.int64)
+    days = np.array([d.toordinal() for d in date_col], dtype=np.int64)
+    broker_shares = np.array(shares_col)
+    broker_balances = np.array(balance_col)
+
+    # Only the broker dates within the account's loaded shares are checked.
+    first_days = np.array([cube.ranges[account_id][0].toordinal()
+                             if account_id in cube.ranges else 0
+                           for account_id in account_col])
+    last_days = np.array([cube.ranges[account_id][1].toordinal()
+                            if account_id in cube.ranges else -1
+                          for account_id in account_col])
+    loaded = (first_days <= days) & (days <= last_days)
+    num_skipped = int((~loaded).sum())
+    if not loaded.any():
+        return models.attrs(checked=0, skipped=num_skipped, drifts=[])
+    accounts, funds, days, broker_shares, broker_balances = \
+      accounts[loaded], funds[loaded], days[loaded], broker_shares[loaded], \
+      broker_balances[loaded]
+
+    # Add the funds held on each broker date that the broker didn't report.
+    a = np.array([cube.account_index[account_id]
+                  for account_id in accounts.tolist()], dtype=np.int64)
+    d = days - cube.start
+    snapshots, snapshot_of_row = np.unique(np.stack((a, d)), axis=1,
+                                           return_inverse=True)
+    snapshot_of_row = snapshot_of_row.reshape(-1)
+    reported = np.zeros((snapshots.shape[1], len(tickers)), dtype=bool)
+    reported[snapshot_of_row, funds] = True
+    held = np.zeros_like(reported)
+    held[:, :len(cube.tickers)] = cube.shares[snapshots[0], :, snapshots[1]] \
+                                  != 0
+    extra_snapshot, extra_funds = np.nonzero(held & ~reported)
+    if len(extra_snapshot):
+        extra_a = snapshots[0][extra_snapshot]
+        extra_d = snapshots[1][extra_snapshot]
+        no_shares = np.zeros(len(extra_snapshot))
+        a = np.concatenate((a, extra_a))
+        d = np.concatenate((d, extra_d))
+        accounts = np.concatenate(
+                     (accounts,
+                      np.array(cube.account_ids, dtype=np.int64)[extra_a]))
+        funds = np.concatenate((funds, extra_funds))
+        days = np.concatenate((days, extra_d + cube.start))
+        broker_shares = np.concatenate((broker_shares, no_shares))
+        broker_balances = np.concatenate((broker_balances, no_shares))
+
+    # The calculated shares and balances, 0 for funds not in the cube.
+    in_cube = funds < len(cube.tickers)
+    shares = np.zeros(len(funds))
+    balances = np.zeros(len(funds))
+    shares[in_cube] = cube.shares[a[in_cube], funds[in_cube], d[in_cube]]
+    balances[in_cube] = cube.balances[a[in_cube], funds[in_cube], d[in_cube]]
+    drifts = shares - broker_shares
+    off = np.abs(drifts) > tolerances[funds]
+
+    # Each account's fund, in date order.
+    order = np.lexsort((days, funds, accounts))
+    accounts, funds, days, broker_shares, broker_balances, shares, \
+    balances, drifts, off = \
+      accounts[order], funds[order], days[order], broker_shares[order], \
+      broker_balances[order], shares[order], balances[order], drifts[order], \
+      off[order]
+    keys = accounts * len(tickers) + funds
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    ends = np.concatenate((starts[1:], [len(keys)]))
+
+    drifted = np.logical_or.reduceat(off, starts)
+
+    report = []
+    for lo, hi in zip(starts[drifted].tolist(), ends[drifted].tolist()):
+        first = lo + int(np.argmax(off[lo:hi]))
+        last = hi - 1
+        report.append(models.attrs(
+          account_id=int(accounts[lo]),
+          ticker=tickers[funds[lo]],
+          first_drift=date.fromordinal(int(days[first])),
+          last_match=date.fromordinal(int(days[first - 1]))
+                       if first > lo else None,
+          suspect_date=None,
+          date=date.fromordinal(int(days[last])),
+          broker_shares=float(broker_shares[last]),
+          shares=float(shares[last]),
+          drift=float(drifts[last]),
+          broker_balance=float(broker_balances[last]),
+          balance=float(balances[last])))
+    find_suspect_dates(report)
+    return models.attrs(checked=len(keys), skipped=num_skipped, drifts=report)
+
+
+def find_suspect_dates(report):
+    r'''Sets the suspect_date of each drift in the `report`.
+
+    This is the first transaction in the fund after last_match, through
+    first_drift.
+    '''
+    if not report:
+        return
+    suspects = {(drift.account_id, drift.ticker): drift for drift in report}
+    query = models.AccountTransactionHistory.objects \
+                  .filter(account_id__in={drift.account_id
+                                          for drift in report},
+                          fund_id__in={drift.ticker for drift in report},
+                          trade_date__lte=max(drift.first_drift
+                                              for drift in report)) \
+                  .order_by('trade_date') \
+                  .values_list('account_id', 'fund_id', 'trade_date')
+    for account_id, ticker, trade_date in query.iterator():
+        drift = suspects.get((account_id, ticker))
+        if drift is not None and drift.suspect_date is None and \
+           (drift.last_match is None or trade_date > drift.last_match) and \
+           trade_date <= drift.first_drift:
+            drift.suspect_date = trade_date
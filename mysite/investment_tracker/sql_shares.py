@@ -0,0 +1,192 @@
+# sql_shares.py
+
+r'''SQL version of the AccountShares.update calculations.
+
+This is the 'sql' shares engine (see models.shares_engine).  The running
+sums of each fund's shares (and of the VMFXX net_amounts) are done by the
+database as window functions, the share prices are joined in from
+FundPriceCalendar, and the new rows are written with one INSERT ... SELECT per
+account.  So the rows never come back through Python.
+
+The transactions are selected with the same querysets as the other engines
+(AccountTransactionHistory.fund_shares_query and vmfxx_query), so the same
+transactions are summed in the same order.  Before SQLite 3.43, the running
+sums are added in order, so they match the other engines exactly.  From 3.43
+on, SQLite compensates for rounding in SUM, so the shares (and so the
+balances) may differ from the other engines' in the last bits (see
+`Exact_sums`).
+
+This uses SQLite's date functions, so it only works on SQLite.
+'''
+
+import sqlite3
+
+from django.db import connection
+
+
+# True if the running sums match the other engines exactly.  See above.
+Exact_sums = sqlite3.sqlite_version_info < (3, 43)
+
+
+def table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+# The new rows for one account, built up from:
+#
+#   start_rows: the shares on last_date (none if loading from scratch).
+#   moves: the transactions that change the shares of each fund.
+#   events: start_rows and moves.  VMFXX starts at 0.0 if not in start_rows.
+#   running: the running sum for each fund after each event.
+#   levels: the shares held from valid_from through valid_to.
+#   days: each day covered by the levels.
+#   held: the shares on each day, with the row order that the legacy engine
+#         creates them in (grp, grp_order, fund_id, date): the funds with
+#         moves by fund_id (grp 0), then the ones only in start_rows in
+#         their start_rows order (grp 1), then VMFXX (grp 2).
+#   priced: held, with the fund's prices as of each day.
+Rows_sql = '''
+WITH RECURSIVE
+  start_rows(fund_id, amount, seq) AS (
+    SELECT fund_id, shares, id
+      FROM {shares}
+     WHERE account_id = %s AND date = %s),
+  moves(fund_id, trade_date, amount, seq) AS (
+    SELECT fund_id, trade_date, shares, id FROM ({fund_sql})
+    UNION ALL
+    SELECT 'VMFXX', trade_date, net_amount, id FROM ({vmfxx_sql})),
+  events(fund_id, eff_date, is_move, amount, seq) AS (
+    SELECT fund_id, %s, 0, amount, seq FROM start_rows
+    UNION ALL
+    SELECT 'VMFXX', %s, 0, 0.0, 0
+     WHERE NOT EXISTS (SELECT 1 FROM start_rows WHERE fund_id = 'VMFXX')
+    UNION ALL
+    SELECT fund_id, trade_date, 1, amount, seq FROM moves),
+  running(fund_id, eff_date, total, nth_from_end) AS (
+    SELECT fund_id, eff_date,
+           SUM(amount) OVER (PARTITION BY fund_id
+                             ORDER BY is_move, eff_date, seq
+                             ROWS UNBOUNDED PRECEDING),
+           ROW_NUMBER() OVER (PARTITION BY fund_id, eff_date
+                              ORDER BY is_move DESC, seq DESC)
+      FROM events),
+  levels(fund_id, valid_from, valid_to, shares) AS (
+    SELECT fund_id, eff_date,
+           COALESCE(date(LEAD(eff_date) OVER (PARTITION BY fund_id
+                                              ORDER BY eff_date),
+                         '-1 day'),
+                    %s),
+           total
+      FROM running
+     WHERE nth_from_end = 1),
+  days(day) AS (
+    SELECT %s WHERE %s <= (SELECT MAX(valid_to) FROM levels)
+    UNION ALL
+    SELECT date(day, '+1 day') FROM days
+     WHERE day < (SELECT MAX(valid_to) FROM levels)),
+  held(grp, grp_order, fund_id, day, shares, money_market) AS (
+    SELECT CASE WHEN l.fund_id = 'VMFXX' THEN 2
+                WHEN l.fund_id IN (SELECT fund_id FROM moves) THEN 0
+                ELSE 1
+           END,
+           COALESCE((SELECT seq FROM start_rows s
+                      WHERE s.fund_id = l.fund_id
+                        AND l.fund_id NOT IN (SELECT fund_id FROM moves)),
+                    0),
+           l.fund_id, days.day, l.shares,
+           l.fund_id = 'VMFXX' OR COALESCE(f.money_market, 0)
+      FROM levels l
+           JOIN days ON days.day BETWEEN l.valid_from AND l.valid_to
+           LEFT JOIN {fund} f ON f.ticker = l.fund_id
+     WHERE l.fund_id = 'VMFXX' OR abs(l.shares) > 0.01),
+  calendar_ends(fund_id, last_day) AS (
+    SELECT fund_id, MAX(date)
+      FROM {calendar}
+     WHERE fund_id IN (SELECT fund_id FROM levels)
+     GROUP BY fund_id),
+  priced AS (
+    SELECT h.*, c.close, c.peak_close, c.peak_date, c.trough_close,
+           c.trough_date
+      FROM held h
+           LEFT JOIN calendar_ends e ON e.fund_id = h.fund_id
+           LEFT JOIN {calendar} c
+             ON NOT h.money_market
+                AND c.fund_id = h.fund_id
+                AND c.date = MIN(h.day, e.last_day)
+                AND julianday(h.day) - julianday(e.last_day) <= 5)
+'''
+
+# The first row that the other engines would have failed an assert on.
+Check_sql = '''
+SELECT fund_id, day, shares
+  FROM priced
+ WHERE shares < 0 OR (NOT money_market AND close IS NULL)
+ ORDER BY grp, grp_order, fund_id, day
+ LIMIT 1
+'''
+
+Insert_sql = '''
+INSERT INTO {shares}
+       (account_id, fund_id, date, shares, share_price, balance,
+        peak_pct_of_balance, peak_date, trough_pct_of_balance, trough_date)
+SELECT %s, fund_id, day, shares,
+       CASE WHEN money_market THEN 1.0 ELSE close END,
+       shares * CASE WHEN money_market THEN 1.0 ELSE close END,
+       CASE WHEN money_market THEN 1.0 ELSE peak_close / close END,
+       CASE WHEN money_market THEN day ELSE peak_date END,
+       CASE WHEN money_market THEN NULL ELSE trough_close / close END,
+       CASE WHEN money_market THEN NULL ELSE trough_date END
+  FROM priced
+ ORDER BY grp, grp_order, fund_id, day
+'''
+
+
+def insert_rows(acct, last_date, start_date, ath_query):
+    r'''Inserts the new AccountShares rows for `acct`.
+
+    The arguments are as in AccountShares.legacy_rows, with `ath_query` the
+    new AccountTransactionHistory (see AccountShares.new_transactions).  The
+    starting shares are read from the AccountShares rows on `last_date`.
+
+    Returns the number of rows inserted.
+    '''
+    # Avoid a circular import.
+    from .models import (AccountShares, AccountTransactionHistory, Fund,
+                         FundPriceCalendar)
+
+    assert connection.vendor == 'sqlite', \
+           f"The 'sql' shares engine needs SQLite, not {connection.vendor}"
+
+    fund_sql, fund_params = \
+      AccountTransactionHistory.fund_shares_query(ath_query) \
+                               .order_by() \
+                               .values_list('fund_id', 'trade_date',
+                                            'shares', 'id') \
+                               .query.sql_with_params()
+    vmfxx_sql, vmfxx_params = \
+      AccountTransactionHistory.vmfxx_query(ath_query) \
+                               .order_by() \
+                               .values_list('trade_date', 'net_amount', 'id') \
+                               .query.sql_with_params()
+    end_date = acct.transaction_end_date
+    rows_sql = Rows_sql.format(shares=table(AccountShares),
+                               fund=table(Fund),
+                               calendar=table(FundPriceCalendar),
+                               fund_sql=fund_sql, vmfxx_sql=vmfxx_sql)
+    params = [acct.id, last_date, *fund_params, *vmfxx_params,
+              start_date, start_date, end_date, start_date, start_date]
+
+    with connection.cursor() as cursor:
+        cursor.execute(rows_sql + Check_sql, params)
+        bad = cursor.fetchone()
+        if bad is not None:
+            ticker, day, shares = bad
+            assert shares >= 0, \
+                   f"Got unexpected negative shares for {ticker} on {day}"
+            assert False, f"Missing fund history date for {ticker} on {day}"
+        cursor.execute(rows_sql + Insert_sql.format(shares=table(AccountShares)),
+                       params + [acct.id])
+        # The sqlite3 module leaves the rowcount at -1 for statements that
+        # start with WITH.
+        cursor.execute("SELECT changes()")
+        return cursor.fetchone()[0]
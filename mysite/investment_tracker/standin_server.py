@@ -0,0 +1,186 @@
+# standin_server.py
+
+r'''A local stand-in for Yahoo's csv downloads, serving synthetic data.
+
+This answers the same URLs as Yahoo:
+
+    /v7/finance/download/<ticker>?period1=<secs>&period2=<secs>&events=<events>
+
+where `events` is 'history' (daily closes) or 'div' (dividends), in the same
+csv format.  Any ticker is accepted.  Each ticker's closes are a random walk
+over the weekdays from 1990 on, and it pays a dividend at the end of each
+quarter.  The walk is seeded from the ticker, so the same ticker always gets
+the same data.
+
+Each response is delayed by `latency` seconds, plus up to `jitter` more, and a
+fraction, `error_rate`, of the requests get a 503 instead.
+
+To use it, set MARKET_DATA_PROVIDER = 'standin' in settings.py, and run this
+with:
+
+    python -m investment_tracker.standin_server [--port 8765] [--latency 0.1]
+
+or call `start_server` to run it in a background thread.
+'''
+
+import sys
+import time
+import random
+import zlib
+import argparse
+import threading
+from datetime import date, datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+One_day = timedelta(days=1)
+
+First_date = date(1990, 1, 2)
+
+
+class series:
+    r'''The synthetic closes and dividends for one ticker.
+
+    These are generated once, from First_date through yesterday.
+    '''
+    def __init__(self, ticker):
+        rand = random.Random(zlib.crc32(ticker.encode('utf-8')))
+        close = rand.uniform(10.0, 200.0)
+        drift = rand.uniform(-0.0001, 0.0004)
+        volatility = rand.uniform(0.002, 0.02)
+        dividend_yield = rand.choice((0.0, 0.005, 0.01, 0.02))
+        self.closes = []      # [(date, close)]
+        self.dividends = []   # [(date, dividends)]
+        today = date.today()
+        d = First_date
+        while d < today:
+            if d.weekday() < 5:
+                close = max(0.01, close * (1.0 + rand.gauss(drift, volatility)))
+                self.closes.append((d, round(close, 6)))
+                if dividend_yield and (d + One_day).month != d.month and \
+                   d.month % 3 == 0:
+                    self.dividends.append(
+                      (d, round(close * dividend_yield / 4, 6)))
+            d += One_day
+
+
+Series = {}   # {ticker: series}
+Series_lock = threading.Lock()
+
+def get_series(ticker):
+    with Series_lock:
+        if ticker not in Series:
+            Series[ticker] = series(ticker)
+        return Series[ticker]
+
+
+def period_date(secs):
+    return datetime.fromtimestamp(int(secs), timezone.utc).date()
+
+
+class standin_handler(BaseHTTPRequestHandler):
+    r'''Handles the requests.  The settings are on the server.
+    '''
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        url = urlsplit(self.path)
+        prefix = '/v7/finance/download/'
+        if not url.path.startswith(prefix):
+            self.send_text(404, "Not Found")
+            return
+        if random.random() < server.error_rate:
+            self.send_text(503, "Service Unavailable (simulated)")
+            return
+        ticker = url.path[len(prefix):]
+        query = parse_qs(url.query)
+        try:
+            start = period_date(query.get('period1', ['0'])[0])
+            # period2 is midnight at the end of the last day.
+            end = period_date(query['period2'][0]) - One_day \
+                    if 'period2' in query else date.today()
+        except (ValueError, OverflowError):
+            self.send_text(400, "Bad period")
+            return
+        events = query.get('events', ['history'])[0]
+        data = get_series(ticker)
+        if events == 'history':
+            lines = ["Date,Open,High,Low,Close,Adj Close,Volume"]
+            lines.extend(f"{d.isoformat()},{close},{close},{close},{close},"
+                           f"{close},0"
+                         for d, close in data.closes if start <= d <= end)
+        elif events == 'div':
+            lines = ["Date,Dividends"]
+            lines.extend(f"{d.isoformat()},{dividends}"
+                         for d, dividends in data.dividends
+                          if start <= d <= end)
+        else:
+            self.send_text(400, f"Unknown events, {events}")
+            return
+        self.send_text(200, '\n'.join(lines) + '\n', 'text/csv')
+
+    def send_text(self, status, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(port=8765, latency=0.0, jitter=0.0, error_rate=0.0,
+                host='localhost', verbose=False):
+    server = ThreadingHTTPServer((host, port), standin_handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.verbose = verbose
+    return server
+
+
+def start_server(port=8765, latency=0.0, jitter=0.0, error_rate=0.0,
+                 host='localhost'):
+    r'''Runs the server in a background (daemon) thread.
+
+    Use port=0 to pick a free port; the port is server.server_address[1].
+
+    Returns the server.  Call server.shutdown() to stop it.
+    '''
+    server = make_server(port, latency, jitter, error_rate, host)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run():
+    parser = argparse.ArgumentParser(
+               description="Serves synthetic fund history in Yahoo's format.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds to delay each response")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="up to this many more seconds of delay")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of requests that get a 503")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="log each request")
+    args = parser.parse_args()
+    server = make_server(args.port, args.latency, args.jitter,
+                         args.error_rate, args.host, args.verbose)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}",
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,3 +1,1433 @@
-from django.test import TestCase
+# tests.py
 
-# Create your tests here.
+r'''Tests of the calculations that are supposed to give the same answers
+whichever way they are done.
+
+The funds, users and accounts come from the migrations.  The prices are
+synthetic, served by a `Fake_provider` (see providers.py), and the
+transactions are made up like the Vanguard downloads.
+'''
+
+import io
+import math
+import os
+import random
+import re
+import tempfile
+import time
+from datetime import date, timedelta
+from unittest import mock, skipUnless
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from . import (
+    ingest, parsers, plan_models, price_cache, price_matrix, providers,
+    sql_shares, standin_server, yahoo_cache,
+)
+from .hash import hash
+from .models import (
+    Account, AccountBalance, AccountCheckpoint, AccountShares,
+    AccountTransactionHistory, BrokerBalance, Category, DirtyShares, Fund,
+    FundPriceCalendar, FundPriceHistory, ImportedFile, Plan,
+    Provider_exception, load_all_history,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    from . import holdings_cube, reconcile, vector_prices
+
+Tickers = ('BSV', 'VGK', 'VTV')
+
+
+class Fake_provider(providers.Provider):
+    r'''Serves the closes in `Prices`, {ticker: [(date, close)]}.
+    '''
+    Prices = {}
+
+    def prices(self, ticker, start_date=None):
+        for row_date, close in self.Prices.get(ticker, ()):
+            if start_date is None or row_date >= start_date:
+                yield row_date, close
+
+    def dividends(self, ticker, start_date=None):
+        return iter(())
+
+
+def fake_provider():
+    r'''Selects the Fake_provider, as a context manager or decorator.
+    '''
+    return mock.patch.dict(providers.Providers, fake=Fake_provider)
+
+
+def random_closes(rnd, start_date, end_date, close=100.0):
+    r'''Returns [(date, close)] for the weekdays from `start_date` through
+    `end_date`, as a random walk.
+    '''
+    ans = []
+    for i in range((end_date - start_date).days + 1):
+        d = start_date + timedelta(days=i)
+        if d.weekday() < 5:
+            close = round(close * (1 + rnd.gauss(0, 0.01)), 2)
+            ans.append((d, close))
+    return ans
+
+
+@override_settings(MARKET_DATA_PROVIDER='fake')
+def load_prices(prices):
+    r'''Loads `prices`, {ticker: [(date, close)]}, through the provider.
+    '''
+    with fake_provider(), \
+         mock.patch.dict(Fake_provider.Prices, prices):
+        for ticker in prices:
+            Fund.objects.get(ticker=ticker).load_prices()
+
+
+def transaction(acct, trade_date, transaction_type, ticker, shares,
+                net_amount, share_price=0.0):
+    r'''Returns an unsaved AccountTransactionHistory, like Vanguard sends.
+    '''
+    return AccountTransactionHistory(
+             account=acct, trade_date=trade_date, settlement_date=trade_date,
+             transaction_type=transaction_type,
+             transaction_desc=transaction_type,
+             investment_name=ticker or 'CASH', fund_id=ticker, shares=shares,
+             share_price=share_price, principal_amount=net_amount,
+             commission_fees=0.0, net_amount=net_amount,
+             accrued_interest=0.0, account_type='CASH')
+
+
+def random_transactions(rnd, acct, start_date, end_date):
+    r'''Returns a list of random transactions for `acct` between the dates.
+    '''
+    ans = [transaction(acct, start_date, 'Transfer (incoming)', None, 0.0,
+                       50000.0)]
+    held = dict.fromkeys(Tickers, 0.0)
+    d = start_date
+    while True:
+        d += timedelta(days=rnd.randrange(1, 20))
+        if d > end_date:
+            return ans
+        ticker = rnd.choice(Tickers)
+        kind = rnd.random()
+        if kind < 0.5:
+            shares = round(rnd.uniform(1, 30), 3)
+            ans.append(transaction(acct, d, 'Buy', ticker, shares,
+                                   -round(shares * 100, 2), 100.0))
+            ans.append(transaction(acct, d, 'Sweep out', 'VMFXX', 0.0,
+                                   round(shares * 100, 2)))
+            held[ticker] += shares
+        elif kind < 0.75 and held[ticker] > 0:
+            shares = held[ticker] if rnd.random() < 0.3 \
+                                  else round(held[ticker] / 2, 3)
+            ans.append(transaction(acct, d, 'Sell', ticker, -shares,
+                                   round(shares * 100, 2), 100.0))
+            ans.append(transaction(acct, d, 'Sweep in', 'VMFXX', 0.0,
+                                   -round(shares * 100, 2)))
+            held[ticker] -= shares
+        elif kind < 0.85:
+            ans.append(transaction(acct, d, 'Dividend', 'VMFXX', 0.0,
+                                   round(rnd.uniform(1, 20), 2)))
+            ans.append(transaction(acct, d, 'Reinvestment', 'VMFXX', 0.0,
+                                   -1.0))
+        elif kind < 0.95:
+            ans.append(transaction(acct, d, 'Dividend', ticker, 0.0,
+                                   round(rnd.uniform(1, 50), 2)))
+        else:
+            ans.append(transaction(acct, d, 'Transfer (incoming)', ticker,
+                                   5.0, 500.0))
+            held[ticker] += 5.0
+
+
+class Cache_test_case(TestCase):
+    r'''Clears the per-process caches, which outlive each test's database.
+    '''
+    def setUp(self):
+        price_cache.invalidate()
+        plan_models.clear_tree_cache()
+        if numpy is not None:
+            holdings_cube.invalidate()
+
+
+class Shares_test_case(Cache_test_case):
+    r'''Random prices and transactions in all of the accounts.
+    '''
+    Start_date = date(2020, 1, 1)
+    End_date = date(2020, 12, 31)
+
+    # Dates looked up within the shares loaded.
+    Lookup_dates = (date(2020, 2, 15), date(2020, 7, 4), date(2020, 3, 20),
+                    date(2020, 12, 31))
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(1)
+        load_prices({ticker: random_closes(rnd, date(2019, 12, 1),
+                                           cls.End_date)
+                     for ticker in Tickers})
+        for acct in Account.objects.all():
+            start_date = cls.Start_date + timedelta(days=rnd.randrange(30))
+            AccountTransactionHistory.objects.bulk_create(
+              random_transactions(rnd, acct, start_date, cls.End_date))
+            acct.transaction_start_date = start_date
+            acct.transaction_end_date = cls.End_date
+            acct.save()
+
+    def shares_rows(self):
+        return list(AccountShares.objects
+                                 .order_by('account_id', 'fund_id', 'date')
+                                 .values_list('account_id', 'fund_id', 'date',
+                                              'shares', 'share_price',
+                                              'balance',
+                                              'peak_pct_of_balance',
+                                              'peak_date',
+                                              'trough_pct_of_balance',
+                                              'trough_date'))
+
+    def balance_rows(self):
+        return list(AccountBalance.objects
+                                  .order_by('account_id', 'date')
+                                  .values_list('account_id', 'date',
+                                               'balance', 'cash', 'invested'))
+
+    def lookups(self):
+        r'''Returns the shares and balance of each account on Lookup_dates.
+        '''
+        ans = []
+        for acct in Account.objects.order_by('id'):
+            for d in self.Lookup_dates:
+                shares = sorted(
+                  (ticker, s.shares, s.share_price, s.balance,
+                   s.peak_pct_of_balance, s.peak_date,
+                   s.trough_pct_of_balance, s.trough_date)
+                  for ticker, s in acct.shares_on_date(d).items())
+                ans.append((acct.id, d, shares, acct.balance_on_date(d)))
+        return ans
+
+    def assertRowsAlmostEqual(self, rows, expected):
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            for value, expected_value in zip(row, expected_row):
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, expected_value, places=6)
+                else:
+                    self.assertEqual(value, expected_value)
+
+
+class Shares_engine_tests(Shares_test_case):
+    r'''The AccountShares.update engines all produce the legacy rows.
+    '''
+    def test_engines(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected = self.shares_rows()
+        expected_balances = self.balance_rows()
+        self.assertTrue(expected)
+        engines = ['stream', 'sql']
+        if numpy is not None:
+            engines.append('vectorized')
+        for engine in engines:
+            with self.subTest(engine=engine):
+                AccountShares.update(reload=True, engine=engine)
+                if engine == 'sql' and not sql_shares.Exact_sums:
+                    self.assertRowsAlmostEqual(self.shares_rows(), expected)
+                    self.assertRowsAlmostEqual(self.balance_rows(),
+                                               expected_balances)
+                else:
+                    self.assertEqual(self.shares_rows(), expected)
+                    self.assertEqual(self.balance_rows(), expected_balances)
+
+    def test_intervals(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected = self.lookups()
+        expected_balances = self.balance_rows()
+        with override_settings(SHARES_STORAGE='intervals'):
+            AccountShares.update(reload=True)
+            self.assertEqual(self.lookups(), expected)
+            self.assertEqual(self.balance_rows(), expected_balances)
+
+            # Nothing new to load.
+            AccountShares.update()
+            self.assertEqual(self.balance_rows(), expected_balances)
+
+    @override_settings(SHARES_BATCH_SIZE=100)
+    def test_stream_batches(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected = self.shares_rows()
+        expected_balances = self.balance_rows()
+        AccountShares.update(reload=True, engine='stream')
+        self.assertEqual(self.shares_rows(), expected)
+        self.assertEqual(self.balance_rows(), expected_balances)
+
+    def split_update(self, engine, split_date):
+        r'''Loads the shares through `split_date`, then the rest.
+
+        The prices and transactions after `split_date` are held back for the
+        first update, so the second carries on from the shares loaded.
+
+        Returns the shares rows in the order they were created, and the
+        balance_rows.
+        '''
+        closes = {ticker: list(FundPriceHistory.objects
+                                               .filter(fund_id=ticker)
+                                               .order_by('date')
+                                               .values_list('date', 'close'))
+                  for ticker in Tickers}
+        later = AccountTransactionHistory.objects \
+                                         .filter(trade_date__gt=split_date)
+        held_back = list(later.order_by('id'))
+        later.delete()
+        FundPriceHistory.objects.filter(date__gt=split_date).delete()
+        FundPriceCalendar.objects.filter(date__gt=split_date).delete()
+        price_cache.invalidate()
+        Account.objects.update(transaction_end_date=split_date)
+        AccountShares.update(reload=True, engine=engine)
+
+        load_prices(closes)
+        for row in held_back:
+            row.pk = None
+        AccountTransactionHistory.objects.bulk_create(held_back)
+        Account.objects.update(transaction_end_date=self.End_date)
+        AccountShares.update(engine=engine)
+        return (list(AccountShares.objects
+                                  .order_by('id')
+                                  .values_list('account_id', 'fund_id',
+                                               'date', 'shares', 'balance')),
+                self.balance_rows())
+
+    @skipUnless(sql_shares.Exact_sums, "requires exact sums in SQLite")
+    def test_sql_split_update(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected_balances = self.balance_rows()
+        rows, balances = self.split_update('legacy', date(2020, 6, 30))
+        self.assertEqual(balances, expected_balances)
+
+        # The sql engine inserts the rows in the same order, so the
+        # balances are summed in the same order.
+        sql_rows, sql_balances = self.split_update('sql', date(2020, 6, 30))
+        self.assertEqual([row[1:] for row in sql_rows],
+                         [row[1:] for row in rows])
+        self.assertEqual(sql_balances, expected_balances)
+
+    def test_workers(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected = self.shares_rows()
+        expected_balances = self.balance_rows()
+        # The workers are forked, so they see the test database.
+        AccountShares.update(reload=True, engine='legacy', workers=2)
+        self.assertEqual(self.shares_rows(), expected)
+        self.assertEqual(self.balance_rows(), expected_balances)
+
+
+    def test_dirty(self):
+        AccountShares.update(reload=True)
+        acct = Account.objects.order_by('id').first()
+        AccountTransactionHistory.objects.bulk_create([
+          transaction(acct, date(2020, 7, 1), 'Transfer (incoming)', 'BSV',
+                      5.0, 500.0)])
+        DirtyShares.mark_account(acct, date(2020, 7, 1))
+
+        # VTV's closes are corrected from September on.
+        vtv = Fund.objects.get(ticker='VTV')
+        FundPriceHistory.objects.filter(fund=vtv, date__gte=date(2020, 9, 1)) \
+                                .update(close=50.0)
+        FundPriceCalendar.refresh('VTV', since=date(2020, 9, 1))
+        price_cache.invalidate('VTV')
+        DirtyShares.mark_fund(vtv, date(2020, 9, 1))
+
+        AccountShares.update()
+        self.assertFalse(DirtyShares.objects.exists())
+        rebuilt = self.shares_rows()
+        rebuilt_balances = self.balance_rows()
+        AccountShares.update(reload=True)
+        self.assertEqual(rebuilt, self.shares_rows())
+        self.assertEqual(rebuilt_balances, self.balance_rows())
+
+    @skipUnless(numpy, "requires numpy")
+    def test_holdings_cube(self):
+        AccountShares.update(reload=True, engine='legacy')
+        cube = holdings_cube.get()
+        for acct_id, d, shares, balance in self.lookups():
+            a = cube.account_index[acct_id]
+            day = d.toordinal() - cube.start
+            expected = {ticker: s for ticker, s, *_ in shares}
+            self.assertEqual(
+              {ticker: float(cube.shares[a, f, day])
+               for ticker, f in cube.fund_index.items()
+                if cube.shares[a, f, day] != 0 or ticker in expected},
+              expected)
+            self.assertAlmostEqual(cube.balances[a, :, day].sum(), balance)
+
+
+class Balance_tests(Shares_test_case):
+    r'''The account balances are the sums of the shares' balances.
+    '''
+    def test_balances_on_dates(self):
+        AccountShares.update(reload=True, engine='legacy')
+        accts = list(Account.objects.order_by('id'))
+        # Including dates before and after the shares loaded.
+        dates = [date(2019, 12, 31), *self.Lookup_dates, date(2021, 1, 5)]
+        self.assertEqual(Account.balances_on_dates(accts, dates),
+                         {acct.id: {d: acct.balance_on_date(d)
+                                    for d in dates}
+                          for acct in accts})
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_account_balance(self):
+        AccountShares.update(reload=True, engine='legacy')
+        expected_balances = self.balance_rows()
+        for acct in Account.objects.order_by('id'):
+            for d in self.Lookup_dates:
+                with self.subTest(account=acct.id, date=d):
+                    shares = AccountShares.objects.filter(account=acct,
+                                                          date=d)
+                    self.assertEqual(
+                      AccountBalance.objects.get(account=acct,
+                                                 date=d).balance,
+                      sum(s.balance for s in shares.order_by('id')))
+
+        # The backfill loads the same balances from the shares.
+        AccountBalance.objects.all().delete()
+        AccountBalance.backfill()
+        self.assertEqual(self.balance_rows(), expected_balances)
+
+        # Nothing new to load.
+        AccountShares.update()
+        self.assertEqual(self.balance_rows(), expected_balances)
+
+
+class Checkpoint_tests(Shares_test_case):
+    r'''The shares worked out from the AccountCheckpoints match the loaded
+    ones.
+    '''
+    def test_shares_on_dates(self):
+        AccountShares.update(reload=True, engine='legacy')
+        AccountCheckpoint.update(reload=True)
+        dates = [self.Start_date + timedelta(days=i * 11) for i in range(34)]
+        for acct in Account.objects.order_by('id'):
+            checkpoints = AccountCheckpoint.shares_on_dates(acct, dates)
+            for d in dates:
+                with self.subTest(account=acct.id, date=d):
+                    shares = AccountCheckpoint.shares_on_date(acct, d)
+                    self.assertEqual(
+                      {ticker: (s.shares, s.balance)
+                       for ticker, s in checkpoints[d].items()},
+                      {ticker: (s.shares, s.balance)
+                       for ticker, s in shares.items()})
+                    if acct.shares_start_date <= d:
+                        # The checkpoints keep the funds sold down to 0.
+                        daily = acct.shares_on_date(d)
+                        self.assertEqual(
+                          {ticker: s.shares
+                           for ticker, s in shares.items()
+                            if s.shares or ticker in daily},
+                          {ticker: s.shares for ticker, s in daily.items()})
+
+    def test_unpriced(self):
+        # VGK's prices start after some of the accounts first hold it.
+        FundPriceHistory.objects.filter(fund_id='VGK',
+                                        date__lt=date(2020, 3, 2)).delete()
+        FundPriceCalendar.objects.filter(fund_id='VGK',
+                                         date__lt=date(2020, 3, 2)).delete()
+        price_cache.invalidate()
+        AccountCheckpoint.update(reload=True)
+        acct = Account.objects.order_by('id').first()
+        d = date(2020, 2, 15)
+        shares = acct.shares_on_date(d)
+        self.assertNotIn('VGK', shares)
+        self.assertEqual(Account.balances_on_dates([acct], [d]),
+                         {acct.id: {d: sum(s.balance
+                                           for s in shares.values())}})
+        response = self.client.get(reverse('account', args=(acct.id, d)))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'VGK', response.content)
+
+
+@skipUnless(numpy, "requires numpy")
+class Holdings_cube_tests(Cache_test_case):
+    r'''The holdings_cube with no shares loaded.
+    '''
+    def test_empty(self):
+        cube = holdings_cube.get()
+        self.assertEqual(cube.day_range(), (0, 0))
+        self.assertEqual(len(cube.days()), 0)
+        response = self.client.get(reverse('holdings',
+                                           args=(date(2020, 1, 31),)))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/investment-tracker/fund_history/VTV')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'date,shares,balance')
+
+
+class Price_tests(Cache_test_case):
+    r'''The FundPriceHistory peaks/troughs, however they are calculated.
+    '''
+    def fetch(self, closes, last_date=date(1, 1, 1), peaks=(0, None, None,
+                                                             None)):
+        with fake_provider(), \
+             override_settings(MARKET_DATA_PROVIDER='fake'), \
+             mock.patch.dict(Fake_provider.Prices, VTV=closes):
+            return list(FundPriceHistory.fetch_prices(
+                          Fund.objects.get(ticker='VTV'), None, last_date,
+                          *peaks))
+
+    def peak_rows(self, rows):
+        return [(row.date, row.close, row.peak_close, row.peak_date,
+                 row.trough_close, row.trough_date)
+                for row in rows]
+
+    def loaded_rows(self, ticker='VTV'):
+        return self.peak_rows(FundPriceHistory.objects
+                                              .filter(fund_id=ticker)
+                                              .order_by('date'))
+
+    def running_peaks(self, closes, *start):
+        r'''Returns vector_prices.running_peaks as peak_rows.
+        '''
+        peak_closes, peak_days, trough_closes, trough_days = \
+          vector_prices.running_peaks([d.toordinal() for d, _ in closes],
+                                      [close for _, close in closes], *start)
+        return [(d, close, peak_close, date.fromordinal(peak_day),
+                 None if math.isnan(trough_close) else trough_close,
+                 date.fromordinal(trough_day) if trough_day else None)
+                for (d, close), peak_close, peak_day, trough_close,
+                    trough_day
+                 in zip(closes, peak_closes.tolist(), peak_days.tolist(),
+                        trough_closes.tolist(), trough_days.tolist())]
+
+    @skipUnless(numpy, "requires numpy")
+    def test_running_peaks(self):
+        rnd = random.Random(2)
+        closes = random_closes(rnd, date(2020, 1, 1), date(2020, 12, 31))
+        # Lots of ties.
+        closes = [(d, float(round(close))) for d, close in closes]
+        rows = self.peak_rows(self.fetch(closes))
+        self.assertEqual(self.running_peaks(closes), rows)
+
+        # Carrying on from the middle.
+        for i in (1, 50, 100, 200):
+            with self.subTest(i=i):
+                _, _, peak_close, peak_date, trough_close, trough_date = \
+                  rows[i - 1]
+                self.assertEqual(
+                  self.running_peaks(
+                    closes[i:], peak_close, peak_date.toordinal(),
+                    math.nan if trough_close is None else trough_close,
+                    0 if trough_date is None else trough_date.toordinal()),
+                  rows[i:])
+
+    @skipUnless(numpy, "requires numpy")
+    def test_recompute_peaks(self):
+        closes = random_closes(random.Random(3), date(2020, 1, 1),
+                               date(2020, 12, 31))
+        load_prices({'VTV': closes})
+        fund = Fund.objects.get(ticker='VTV')
+        self.assertIsNone(FundPriceHistory.recompute_peaks(fund))
+        self.assertIsNone(FundPriceHistory.recompute_peaks(fund,
+                                                           date(2020, 6, 1)))
+
+    @skipUnless(numpy, "requires numpy")
+    def test_backfill(self):
+        closes = random_closes(random.Random(7), date(2020, 1, 1),
+                               date(2020, 6, 30))
+        load_prices({'VTV': closes[60:]})
+        fund = Fund.objects.get(ticker='VTV')
+        with fake_provider(), \
+             override_settings(MARKET_DATA_PROVIDER='fake'), \
+             mock.patch.dict(Fake_provider.Prices, VTV=closes):
+            self.assertEqual(fund.backfill_prices(date(2020, 1, 1)), 60)
+        self.assertEqual(self.loaded_rows(),
+                         self.peak_rows(self.fetch(closes)))
+
+        # The calendar and price_cache now start from the first close.
+        self.assertEqual(FundPriceCalendar.objects.filter(fund=fund)
+                                          .earliest().date,
+                         closes[0][0])
+        self.assertEqual(price_cache.get('VTV').as_of(closes[0][0]).close,
+                         closes[0][1])
+
+    @skipUnless(numpy, "requires numpy")
+    def test_reload_prices(self):
+        closes = random_closes(random.Random(8), date(2020, 1, 1),
+                               date(2020, 6, 30))
+        load_prices({'VTV': closes})
+        fund = Fund.objects.get(ticker='VTV')
+        corrected = closes[:60] + [(d, close + 10.0)
+                                   for d, close in closes[60:]]
+        with fake_provider(), \
+             override_settings(MARKET_DATA_PROVIDER='fake'), \
+             mock.patch.dict(Fake_provider.Prices, VTV=corrected):
+            self.assertEqual(fund.reload_prices(corrected[60][0]),
+                             len(closes) - 60)
+        self.assertEqual(self.loaded_rows(),
+                         self.peak_rows(self.fetch(corrected)))
+        self.assertEqual(
+          price_cache.get('VTV').as_of(corrected[-1][0]).close,
+          corrected[-1][1])
+
+    def test_load_prices(self):
+        closes = random_closes(random.Random(4), date(2020, 1, 1),
+                               date(2020, 3, 31))
+        load_prices({'VTV': closes[:40]})
+        self.assertEqual(FundPriceHistory.objects.count(), 40)
+
+        # The repeated rows are skipped, and only the new ones counted.
+        with fake_provider(), \
+             override_settings(MARKET_DATA_PROVIDER='fake'), \
+             mock.patch.dict(Fake_provider.Prices,
+                             VTV=closes[:45] + closes[44:]):
+            self.assertEqual(Fund.objects.get(ticker='VTV').load_prices(),
+                             len(closes) - 40)
+        self.assertEqual(self.loaded_rows(),
+                         self.peak_rows(self.fetch(closes)))
+
+    def test_prices_out_of_order(self):
+        closes = random_closes(random.Random(5), date(2020, 1, 1),
+                               date(2020, 1, 31))
+        closes[5], closes[6] = closes[6], closes[5]
+        with self.assertRaises(Provider_exception):
+            self.fetch(closes)
+
+    @override_settings(MARKET_DATA_PROVIDER='fake', HISTORY_BATCH_SIZE=20)
+    def test_load_all_history(self):
+        rnd = random.Random(9)
+        closes = {ticker: random_closes(rnd, date(2020, 1, 1),
+                                        date(2020, 12, 31))
+                  for ticker in Tickers}
+
+        class Failing_provider(Fake_provider):
+            # VGK fails part way through, after some of its batches have
+            # been written.
+            def prices(self, ticker, start_date=None):
+                for i, row in enumerate(super().prices(ticker, start_date)):
+                    if ticker == 'VGK' and i == 150:
+                        raise ValueError("connection lost")
+                    yield row
+
+        funds = list(Fund.objects.filter(ticker__in=Tickers))
+        with mock.patch.dict(providers.Providers, fake=Failing_provider), \
+             mock.patch.dict(Fake_provider.Prices, closes):
+            self.assertEqual(load_all_history(funds, workers=2),
+                             (0, 2 * len(closes['BSV']), ['VGK']))
+        self.assertFalse(FundPriceHistory.objects.filter(fund_id='VGK')
+                                                 .exists())
+        for ticker in ('BSV', 'VTV'):
+            with self.subTest(ticker=ticker):
+                self.assertEqual(
+                  [row[:2] for row in self.loaded_rows(ticker)],
+                  closes[ticker])
+
+
+class Price_cache_tests(Cache_test_case):
+    r'''The price_cache gives the same prices as FundPriceHistory.
+    '''
+    def setUp(self):
+        super().setUp()
+        closes = random_closes(random.Random(10), date(2020, 1, 1),
+                               date(2020, 3, 31))
+        # No closes for the two weeks from February 3rd.
+        load_prices({'VTV': [(d, close)
+                             for d, close in closes
+                              if not date(2020, 2, 3) <= d
+                                                      <= date(2020, 2, 14)]})
+
+    def dates(self):
+        start = date(2019, 12, 25)
+        return [start + timedelta(days=i) for i in range(120)]
+
+    def price(self, fph):
+        if fph is None:
+            return None
+        return (fph.date, fph.close, fph.peak_close, fph.peak_date,
+                fph.trough_close, fph.trough_date)
+
+    def test_as_of(self):
+        prices = price_cache.get('VTV')
+        for d in self.dates():
+            with self.subTest(date=d):
+                self.assertEqual(
+                  self.price(prices.as_of(d)),
+                  self.price(FundPriceHistory.objects
+                                             .filter(fund_id='VTV',
+                                                     date__lte=d)
+                                             .order_by('-date')
+                                             .first()))
+
+    def test_share_prices(self):
+        # Up to a week after the close on January 31st.
+        self.assertIn('VTV', FundPriceHistory.share_prices(['VTV'],
+                                                           date(2020, 2, 7)))
+        self.assertNotIn('VTV',
+                         FundPriceHistory.share_prices(['VTV'],
+                                                       date(2020, 2, 8)))
+        self.assertNotIn('VTV',
+                         FundPriceHistory.share_prices(['VTV'],
+                                                       date(2020, 4, 8)))
+
+    def test_calendar(self):
+        closes = set(FundPriceHistory.objects.filter(fund_id='VTV')
+                                             .values_list('date', flat=True))
+        calendar = list(FundPriceCalendar.objects.filter(fund_id='VTV')
+                                         .order_by('date')
+                                         .values_list('date',
+                                                      'carried_forward'))
+        self.assertEqual(calendar[0], (date(2020, 1, 1), False))
+        self.assertEqual([d for d, _ in calendar],
+                         [date(2020, 1, 1) + timedelta(days=i)
+                          for i in range(len(calendar))])
+        self.assertEqual([d for d, carried_forward in calendar
+                            if not carried_forward],
+                         sorted(closes))
+
+        # A calendar_stream reads the same prices as the price_cache.
+        prices = price_cache.get('VTV')
+        stream = price_cache.calendar_stream('VTV', self.dates()[0],
+                                             chunk_size=10)
+        for d in self.dates():
+            with self.subTest(date=d):
+                self.assertEqual(self.price(stream.as_of(d)),
+                                 self.price(prices.as_of(d)))
+
+    def test_changed_elsewhere(self):
+        self.assertEqual(price_cache.get('VTV').as_of(date(2020, 1, 10))
+                                               .date,
+                         date(2020, 1, 10))
+
+        # Another process corrects the closes from January 6th on.
+        FundPriceHistory.objects.filter(fund_id='VTV',
+                                        date__gte=date(2020, 1, 6)) \
+                                .update(close=50.0)
+        FundPriceCalendar.refresh('VTV', since=date(2020, 1, 6))
+        with override_settings(PRICE_CACHE_REFRESH=0):
+            self.assertEqual(price_cache.get('VTV').as_of(date(2020, 1, 10))
+                                                   .close,
+                             50.0)
+
+
+class Price_matrix_tests(Cache_test_case):
+    r'''The price_matrix serves the same prices as the price_cache.
+    '''
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        matrix_settings = override_settings(PRICE_MATRIX='on',
+                                            PRICE_MATRIX_DIR=directory.name)
+        matrix_settings.enable()
+        self.addCleanup(matrix_settings.disable)
+        rnd = random.Random(11)
+        load_prices({'VTV': random_closes(rnd, date(2020, 1, 1),
+                                          date(2020, 3, 31)),
+                     'BSV': random_closes(rnd, date(2020, 2, 1),
+                                          date(2020, 3, 31))})
+
+    def assertSamePrices(self, ticker, prices):
+        expected = price_cache.fund_prices(ticker)
+        expected.load()
+        for i in range(-5, 120):
+            d = date(2020, 1, 1) + timedelta(days=i)
+            with self.subTest(ticker=ticker, date=d):
+                expected_fph = expected.as_of(d)
+                fph = prices.as_of(d)
+                if expected_fph is None:
+                    self.assertIsNone(fph)
+                else:
+                    self.assertEqual(
+                      (fph.date, fph.close, fph.peak_close, fph.peak_date,
+                       fph.trough_close, fph.trough_date),
+                      (expected_fph.date, expected_fph.close,
+                       expected_fph.peak_close, expected_fph.peak_date,
+                       expected_fph.trough_close, expected_fph.trough_date))
+
+    def test_matrix(self):
+        self.assertEqual(price_matrix.write(), 1)
+        for ticker in ('BSV', 'VTV'):
+            prices = price_cache.get(ticker)
+            self.assertIsInstance(prices, price_matrix.mapped_prices)
+            self.assertSamePrices(ticker, prices)
+
+        # Funds not in the matrix are loaded into the price_cache.
+        load_prices({'VGK': random_closes(random.Random(12),
+                                          date(2020, 1, 1),
+                                          date(2020, 1, 31))})
+        self.assertNotIsInstance(price_cache.get('VGK'),
+                                 price_matrix.mapped_prices)
+
+    def test_update(self):
+        price_matrix.write()
+        # The matrix is updated once the new prices commit.
+        with self.captureOnCommitCallbacks(execute=True):
+            load_prices({'VTV': random_closes(random.Random(13),
+                                              date(2020, 4, 1),
+                                              date(2020, 4, 30))})
+        self.assertEqual(price_matrix.current().version, 2)
+        self.assertEqual(price_cache.get('VTV').as_of(date(2020, 4, 30))
+                                               .date,
+                         date(2020, 4, 30))
+        self.assertSamePrices('VTV', price_cache.get('VTV'))
+        self.assertSamePrices('BSV', price_cache.get('BSV'))
+
+
+class Yahoo_cache_tests(TestCase):
+    r'''The Yahoo responses are cached by their ticker, events and start.
+    '''
+    Url = 'https://query1.finance.yahoo.com/v7/finance/download/{ticker}' \
+          '?period1=1577836800&period2={period2}&interval=1d&events=history'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache_settings = override_settings(YAHOO_CACHE='on',
+                                           YAHOO_CACHE_DIR=directory.name)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        self.fetched = []
+
+    def url(self, ticker='VTV', period2=1609459200):
+        return self.Url.format(ticker=ticker, period2=period2)
+
+    def fetch(self, content=b'Date,Close\n2020-01-02,100.0\n',
+              status_code=200, content_type='text/csv'):
+        self.fetched.append(content)
+        return yahoo_cache.cached_response(content, status_code,
+                                           content_type)
+
+    def test_cache_key(self):
+        # The end of the period is left out.
+        self.assertEqual(yahoo_cache.entry_path(self.url(period2=1)),
+                         yahoo_cache.entry_path(self.url(period2=2)))
+        self.assertNotEqual(yahoo_cache.entry_path(self.url('VTV')),
+                            yahoo_cache.entry_path(self.url('BSV')))
+        self.assertNotIn('period2', yahoo_cache.cache_key(self.url()))
+
+    def test_on(self):
+        r = yahoo_cache.get(self.url(period2=1), self.fetch)
+        cached = yahoo_cache.get(self.url(period2=2), self.fetch)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(cached.content, r.content)
+        self.assertEqual(list(cached.iter_lines(decode_unicode=True)),
+                         ['Date,Close', '2020-01-02,100.0'])
+
+        # Older than the YAHOO_CACHE_TTL.
+        with override_settings(YAHOO_CACHE_TTL=-1):
+            yahoo_cache.get(self.url(), self.fetch)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            r = yahoo_cache.get(self.url(),
+                                lambda: self.fetch(b'Too Many Requests', 429,
+                                                   'text/plain'))
+            self.assertEqual(r.status_code, 429)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_replay(self):
+        with override_settings(YAHOO_CACHE='replay'):
+            self.assertEqual(yahoo_cache.get(self.url(), self.fetch)
+                                        .status_code,
+                             504)
+        yahoo_cache.get(self.url(), self.fetch)
+        with override_settings(YAHOO_CACHE='replay'):
+            self.assertEqual(yahoo_cache.get(self.url(), self.fetch).content,
+                             self.fetched[0])
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_evict(self):
+        yahoo_cache.get(self.url('VTV'), self.fetch)
+        yahoo_cache.get(self.url('BSV'),
+                        lambda: self.fetch(b'Date,Close\n2020-01-02,80.0\n'))
+        # VTV is the least recently used.
+        os.utime(yahoo_cache.entry_path(self.url('VTV')),
+                 (time.time() - 60, time.time() - 60))
+        self.assertEqual(yahoo_cache.evict(max_bytes=30), 1)
+        self.assertIsNone(yahoo_cache.lookup(self.url('VTV')))
+        self.assertIsNotNone(yahoo_cache.lookup(self.url('BSV')))
+        self.assertEqual(len(os.listdir(os.path.join(yahoo_cache.cache_dir(),
+                                                     'blobs'))),
+                         1)
+
+
+class Provider_tests(Cache_test_case):
+    r'''The prices come from the MARKET_DATA_PROVIDER.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.server = standin_server.start_server(port=0)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        standin_settings = override_settings(
+                             MARKET_DATA_PROVIDER='standin',
+                             MARKET_DATA_STANDIN_URL=
+                               f"http://localhost:"
+                                 f"{self.server.server_address[1]}")
+        standin_settings.enable()
+        self.addCleanup(standin_settings.disable)
+
+    def test_get_provider(self):
+        with fake_provider(), override_settings(MARKET_DATA_PROVIDER='fake'):
+            self.assertIsInstance(providers.get_provider(), Fake_provider)
+        self.assertIsInstance(providers.get_provider(),
+                              providers.Yahoo_provider)
+
+    def test_standin(self):
+        start_date = date(2020, 1, 1)
+        series = standin_server.get_series('VTV')
+        provider = providers.get_provider()
+        self.assertEqual(list(provider.prices('VTV', start_date)),
+                         [(d, close) for d, close in series.closes
+                                      if d >= start_date])
+        self.assertEqual(list(provider.dividends('VTV', start_date)),
+                         [(d, dividends) for d, dividends in series.dividends
+                                          if d >= start_date])
+
+    def test_errors(self):
+        self.server.error_rate = 1.0
+        with self.assertRaises(Provider_exception):
+            list(providers.get_provider().prices('VTV', date(2020, 1, 1)))
+
+
+class Tree_tests(Cache_test_case):
+    r'''Category.get_tree gives the same tree as walking it node by node.
+    '''
+    def walk(self, cat, account, tags=(), depth=0):
+        r'''Returns the tree under `cat` using Category.get_plan, get_fund
+        and get_children for each node.
+        '''
+        plan = cat.get_plan(account, tags)
+        fund = cat.get_fund(account)
+        children = cat.get_children(account, tags)
+        ans = [(cat.id, depth, plan and plan.id, fund and fund.ticker,
+                [child.id for child in children])]
+        for child in children:
+            ans.extend(self.walk(child, account, tags, depth + 1))
+        return ans
+
+    def nodes(self, tree):
+        return [(cat.id, cat.depth, cat.plan and cat.plan.id,
+                 cat.fund and cat.fund.ticker,
+                 [child.id for child in cat.children])
+                for cat in tree]
+
+    def test_get_tree(self):
+        for acct in Account.objects.filter(category__isnull=False):
+            with self.subTest(account=acct.id):
+                tree = acct.get_tree()
+                self.assertEqual(self.nodes(tree),
+                                 self.walk(acct.category, acct))
+                self.assertEqual([cat.order for cat in tree],
+                                 list(range(1, len(tree) + 1)))
+
+    def test_queries(self):
+        acct = Account.objects.filter(category__isnull=False).first()
+        category = acct.category
+        # The links, plans and funds.
+        with self.assertNumQueries(3):
+            category.resolve_tree(acct)
+
+    def test_cached(self):
+        acct = Account.objects.filter(category__isnull=False).first()
+        tree = acct.get_tree()
+        tree[0].balance = 100.0
+        tree[0].children.clear()
+        with self.assertNumQueries(0):
+            cached = acct.get_tree()
+        # Each call gets its own copy.
+        self.assertFalse(hasattr(cached[0], 'balance'))
+        self.assertTrue(cached[0].children)
+        self.assertIs(cached[0].children[0], cached[1])
+        self.assertIs(cached[0].account, acct)
+
+    def test_invalidation(self):
+        acct = Account.objects.filter(category__isnull=False).first()
+        acct.get_tree()
+
+        # Saving the account's shares dates doesn't change its trees.
+        acct.shares_end_date = date(2020, 1, 31)
+        acct.save()
+        self.assertTrue(plan_models.Tree_cache)
+
+        # But changing the funds does.
+        Fund.objects.get(ticker='VTV').save()
+        self.assertFalse(plan_models.Tree_cache)
+
+        tree = acct.get_tree()
+        plan = Plan.objects.get(pk=next(cat.plan.id for cat in tree
+                                         if cat.plan is not None))
+        plan.save()
+        self.assertFalse(plan_models.Tree_cache)
+
+        acct.get_tree()
+        acct.category = Category.objects.exclude(pk=acct.category_id).first()
+        acct.save()
+        self.assertFalse(plan_models.Tree_cache)
+
+
+# A Vanguard download, with the balances as of the end_date and the
+# transactions for account 11111111.
+Vanguard_download = '''\
+Account Number,Investment Name,Symbol,Shares,Share Price,Total Value,
+11111111,VANGUARD FEDERAL MONEY MARKET FUND,VMFXX,{vmfxx},1.0,{vmfxx},
+11111111,Vanguard Value ETF,VTV,{vtv},100.0,{vtv_balance},
+
+
+Account Number,Trade Date,Settlement Date,Transaction Type,\
+Transaction Description,Investment Name,Symbol,Shares,Share Price,\
+Principal Amount,Commission Fees,Net Amount,Accrued Interest,Account Type,
+{transactions}
+'''
+
+Vanguard_transactions = {
+    date(2020, 1, 2): [
+        '11111111,01/02/2020,01/02/2020,Transfer (incoming),'
+          'Transfer,CASH,,0.0,1.0,5000.0,0.0,5000.0,0.0,CASH,',
+    ],
+    date(2020, 1, 10): [
+        '11111111,01/10/2020,01/13/2020,Buy,Buy,Vanguard Value ETF,VTV,'
+          '10.0,100.0,-1000.0,0.0,-1000.0,0.0,CASH,',
+        '11111111,01/10/2020,01/13/2020,Sweep out,Sweep out,'
+          'VANGUARD FEDERAL MONEY MARKET FUND,,0.0,1.0,1000.0,0.0,1000.0,'
+          '0.0,CASH,',
+    ],
+    # Two identical transactions on the same day.
+    date(2020, 1, 21): [
+        '11111111,01/21/2020,01/22/2020,Buy,Buy,Vanguard Value ETF,VTV,'
+          '1.0,100.0,-100.0,0.0,-100.0,0.0,CASH,',
+        '11111111,01/21/2020,01/22/2020,Buy,Buy,Vanguard Value ETF,VTV,'
+          '1.0,100.0,-100.0,0.0,-100.0,0.0,CASH,',
+    ],
+    date(2020, 2, 3): [
+        '11111111,02/03/2020,02/04/2020,Sell,Sell,Vanguard Value ETF,VTV,'
+          '-2.0,100.0,200.0,0.0,200.0,0.0,CASH,',
+    ],
+}
+
+
+def vanguard_download(start_date, end_date):
+    r'''Returns the Vanguard download of the transactions between the dates.
+    '''
+    transactions = [line
+                    for trade_date, lines
+                     in sorted(Vanguard_transactions.items())
+                     if start_date <= trade_date <= end_date
+                    for line in lines]
+    return Vanguard_download.format(vmfxx=4000.0, vtv=10.0,
+                                    vtv_balance=1000.0,
+                                    transactions='\n'.join(transactions))
+
+
+class Import_tests(Cache_test_case):
+    r'''Overlapping downloads load each transaction once (see row_key).
+    '''
+    def setUp(self):
+        super().setUp()
+        self.acct = Account.objects.order_by('id').first()
+        self.acct.account_number = hash('11111111')
+        self.acct.save()
+
+    def load(self, start_date, end_date, fingerprint):
+        return Account.load_csv(
+                 io.StringIO(vanguard_download(start_date, end_date)),
+                 end_date, fingerprint, f"{fingerprint}.csv")
+
+    def transactions(self):
+        return sorted(AccountTransactionHistory.objects
+                                               .filter(account=self.acct)
+                                               .values_list('trade_date',
+                                                            'transaction_type',
+                                                            'fund_id',
+                                                            'shares',
+                                                            'net_amount'))
+
+    @override_settings(IMPORT_BATCH_SIZE=2)
+    def test_batches(self):
+        self.load(date(2020, 1, 1), date(2020, 2, 29), 'both')
+        self.assertEqual(self.transactions(), [
+          (date(2020, 1, 2), 'Transfer (incoming)', None, 0.0, 5000.0),
+          (date(2020, 1, 10), 'Buy', 'VTV', 10.0, -1000.0),
+          (date(2020, 1, 10), 'Sweep out', 'VMFXX', 0.0, 1000.0),
+          (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0),
+          (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0),
+          (date(2020, 2, 3), 'Sell', 'VTV', -2.0, 200.0)])
+        self.acct.refresh_from_db()
+        self.assertEqual(self.acct.transaction_start_date, date(2020, 1, 2))
+        self.assertEqual(self.acct.transaction_end_date, date(2020, 2, 29))
+
+    def test_overlapping_downloads(self):
+        self.load(date(2020, 1, 1), date(2020, 1, 31), 'january')
+        self.load(date(2020, 1, 15), date(2020, 2, 29), 'february')
+        self.load(date(2020, 1, 1), date(2020, 2, 29), 'both')
+        self.assertEqual(self.transactions(), [
+          (date(2020, 1, 2), 'Transfer (incoming)', None, 0.0, 5000.0),
+          (date(2020, 1, 10), 'Buy', 'VTV', 10.0, -1000.0),
+          (date(2020, 1, 10), 'Sweep out', 'VMFXX', 0.0, 1000.0),
+          (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0),
+          (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0),
+          (date(2020, 2, 3), 'Sell', 'VTV', -2.0, 200.0)])
+        self.acct.refresh_from_db()
+        self.assertEqual(self.acct.transaction_start_date, date(2020, 1, 2))
+        self.assertEqual(self.acct.transaction_end_date, date(2020, 2, 29))
+        # The balances from 'both' replace those from 'february'.
+        self.assertEqual(sorted(BrokerBalance.objects
+                                             .filter(account=self.acct)
+                                             .values_list('date', 'fund_id')),
+                         [(date(2020, 1, 31), 'VMFXX'),
+                          (date(2020, 1, 31), 'VTV'),
+                          (date(2020, 2, 29), 'VMFXX'),
+                          (date(2020, 2, 29), 'VTV')])
+
+    def test_same_download(self):
+        self.assertIsNotNone(self.load(date(2020, 1, 1), date(2020, 1, 31),
+                                       'january'))
+        expected = self.transactions()
+        self.assertIsNone(self.load(date(2020, 1, 1), date(2020, 1, 31),
+                                    'january'))
+        self.assertEqual(self.transactions(), expected)
+        self.assertEqual(ImportedFile.objects.count(), 1)
+
+    def test_clear_history(self):
+        self.load(date(2020, 1, 1), date(2020, 1, 31), 'january')
+        self.load(date(2020, 1, 15), date(2020, 2, 29), 'february')
+        expected = self.transactions()
+        response = self.client.get(reverse('clear_history',
+                                           args=(date(2020, 2, 1),
+                                                 date(2020, 2, 29))))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.transactions()), len(expected) - 1)
+
+        # Only the february download can be loaded again.
+        self.assertEqual(list(ImportedFile.objects.values_list('filename',
+                                                               flat=True)),
+                         ['january.csv'])
+        self.assertIsNone(self.load(date(2020, 1, 1), date(2020, 1, 31),
+                                    'january'))
+        self.assertIsNotNone(self.load(date(2020, 1, 15), date(2020, 2, 29),
+                                       'february'))
+        self.assertEqual(self.transactions(), expected)
+
+    def write_downloads(self, directory, downloads):
+        r'''Writes `downloads`, {filename: contents}, into `directory`.
+
+        They are dated far enough back to be picked up by ingest.
+        '''
+        settled = time.time() - 60
+        for filename, contents in downloads.items():
+            path = os.path.join(directory, filename)
+            with open(path, 'w', newline='') as f:
+                f.write(contents)
+            os.utime(path, (settled, settled))
+
+    def ingest_dir(self):
+        r'''Returns a temporary INGEST_DIR, with its archive and rejects.
+        '''
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        ingest_settings = override_settings(
+                            INGEST_DIR=directory.name,
+                            INGEST_ARCHIVE_DIR=os.path.join(directory.name,
+                                                            'archive'),
+                            INGEST_REJECTS_DIR=os.path.join(directory.name,
+                                                            'rejects'))
+        ingest_settings.enable()
+        self.addCleanup(ingest_settings.disable)
+        return directory.name
+
+    def test_ingest_rejects(self):
+        directory = self.ingest_dir()
+        self.write_downloads(directory, {
+          'january-2020-01-31.csv':
+            vanguard_download(date(2020, 1, 1), date(2020, 1, 31)),
+          'junk-2020-02-01.csv': "not a download\n",
+          'stranger-2020-02-29.csv':
+            vanguard_download(date(2020, 2, 1), date(2020, 2, 29))
+              .replace('11111111', '22222222'),
+        })
+        ans = ingest.ingest(update_shares=False)
+        self.assertEqual((ans.files, ans.skipped, ans.rejected), (1, 0, 2))
+        self.assertEqual(sorted(os.path.basename(path)
+                                for path in ans.reasons),
+                         ['junk-2020-02-01.csv', 'stranger-2020-02-29.csv'])
+        self.assertEqual(ans.accounts, {self.acct.id})
+        self.assertEqual(len(os.listdir(ingest.archive_dir())), 1)
+        self.assertEqual(len(os.listdir(ingest.rejects_dir())), 2)
+        self.assertEqual(len(self.transactions()), 5)
+
+    def test_ingest_fails(self):
+        directory = self.ingest_dir()
+        self.write_downloads(directory, {
+          'january-2020-01-31.csv':
+            vanguard_download(date(2020, 1, 1), date(2020, 1, 31)),
+          'february-2020-02-29.csv':
+            vanguard_download(date(2020, 1, 15), date(2020, 2, 29)),
+        })
+        import_csv = Account.import_csv
+
+        def failing_import_csv(file, end_date, fingerprint=None,
+                               filename=''):
+            if filename.startswith('february'):
+                raise ValueError("not a reject")
+            return import_csv(file, end_date, fingerprint, filename)
+
+        with mock.patch.object(Account, 'import_csv', failing_import_csv):
+            with self.assertRaises(ValueError):
+                ingest.ingest(update_shares=False)
+        # The january download is rolled back too, and left in place.
+        self.assertEqual(self.transactions(), [])
+        self.assertFalse(ImportedFile.objects.exists())
+        self.assertEqual(sorted(name for name in os.listdir(directory)
+                                      if name.endswith('.csv')),
+                         ['february-2020-02-29.csv',
+                          'january-2020-01-31.csv'])
+
+
+# An OFX download in the SGML form, with an empty MEMO.
+Ofx_sgml = '''\
+OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+<OFX>
+<INVSTMTMSGSRSV1>
+<INVSTMTTRNRS>
+<TRNUID>1
+<INVSTMTRS>
+<DTASOF>20200131
+<CURDEF>USD
+<INVACCTFROM>
+<BROKERID>vanguard.com
+<ACCTID>11111111
+</INVACCTFROM>
+<INVTRANLIST>
+<DTSTART>20200101
+<DTEND>20200131
+<INVBANKTRAN>
+<STMTTRN>
+<TRNTYPE>DEP
+<DTPOSTED>20200102
+<TRNAMT>5000.00
+<FITID>1
+<NAME>Transfer &amp; deposit
+</STMTTRN>
+<SUBACCTFUND>CASH
+</INVBANKTRAN>
+<BUYMF>
+<INVBUY>
+<INVTRAN>
+<FITID>2
+<MEMO>
+<DTTRADE>20200110
+<DTSETTLE>20200113
+</INVTRAN>
+<SECID>
+<UNIQUEID>922908744
+<UNIQUEIDTYPE>CUSIP
+</SECID>
+<UNITS>10
+<UNITPRICE>100.00
+<TOTAL>-1000.00
+<SUBACCTSEC>CASH
+<SUBACCTFUND>CASH
+</INVBUY>
+<BUYTYPE>BUY
+</BUYMF>
+<REINVEST>
+<INVTRAN>
+<FITID>3
+<DTTRADE>20200120
+<MEMO>Dividend reinvestment
+</INVTRAN>
+<SECID>
+<UNIQUEID>922908744
+<UNIQUEIDTYPE>CUSIP
+</SECID>
+<INCOMETYPE>DIV
+<TOTAL>-25.00
+<SUBACCTSEC>CASH
+<UNITS>0.25
+<UNITPRICE>100.00
+</REINVEST>
+</INVTRANLIST>
+<INVPOSLIST>
+<POSMF>
+<INVPOS>
+<SECID>
+<UNIQUEID>922908744
+<UNIQUEIDTYPE>CUSIP
+</SECID>
+<HELDINACCT>CASH
+<POSTYPE>LONG
+<UNITS>10.25
+<UNITPRICE>101.00
+<MKTVAL>1035.25
+<DTPRICEASOF>20200131
+</INVPOS>
+</POSMF>
+</INVPOSLIST>
+</INVSTMTRS>
+</INVSTMTTRNRS>
+</INVSTMTMSGSRSV1>
+<SECLISTMSGSRSV1>
+<SECLIST>
+<MFINFO>
+<SECINFO>
+<SECID>
+<UNIQUEID>922908744
+<UNIQUEIDTYPE>CUSIP
+</SECID>
+<SECNAME>Vanguard Value ETF
+<TICKER>VTV
+</SECINFO>
+</MFINFO>
+</SECLIST>
+</SECLISTMSGSRSV1>
+</OFX>
+'''
+
+
+def ofx_xml(sgml):
+    r'''Returns the SGML OFX download `sgml` in the XML form.
+    '''
+    body = sgml[sgml.index('<OFX>'):]
+    body = re.sub(r'<([A-Z0-9.]+)>([^<\n]+)', r'<\1>\2</\1>', body)
+    body = body.replace('<MEMO>\n', '<MEMO></MEMO>\n')
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<?OFX OFXHEADER="200" VERSION="202" SECURITY="NONE" ' \
+           'OLDFILEUID="NONE" NEWFILEUID="NONE"?>\n' + body
+
+
+class Parser_tests(TestCase):
+    r'''The downloads read the same, whichever broker or form they come in.
+    '''
+    def parse(self, text):
+        download = parsers.parse(io.StringIO(text))
+        return download.balances, list(download.transactions)
+
+    def test_vanguard(self):
+        balances, transactions = \
+          self.parse(vanguard_download(date(2020, 1, 1), date(2020, 1, 31)))
+        self.assertEqual(balances, [
+          parsers.Balance('11111111', 'VMFXX',
+                          'VANGUARD FEDERAL MONEY MARKET FUND', 4000.0, 1.0,
+                          4000.0),
+          parsers.Balance('11111111', 'VTV', 'Vanguard Value ETF', 10.0,
+                          100.0, 1000.0),
+        ])
+        self.assertEqual(
+          [(t.trade_date, t.transaction_type, t.ticker, t.shares,
+            t.net_amount)
+           for t in transactions],
+          [(date(2020, 1, 2), 'Transfer (incoming)', None, 0.0, 5000.0),
+           (date(2020, 1, 10), 'Buy', 'VTV', 10.0, -1000.0),
+           (date(2020, 1, 10), 'Sweep out', 'VMFXX', 0.0, 1000.0),
+           (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0),
+           (date(2020, 1, 21), 'Buy', 'VTV', 1.0, -100.0)])
+
+    def test_unknown_format(self):
+        with self.assertRaises(parsers.Parser_exception):
+            self.parse("Date,Open,High,Low,Close\n")
+
+    def test_ofx(self):
+        balances, transactions = self.parse(Ofx_sgml)
+        self.assertEqual(balances, [
+          parsers.Balance('11111111', 'VTV', 'Vanguard Value ETF', 10.25,
+                          101.0, 1035.25),
+        ])
+        T = parsers.Transaction
+        self.assertEqual(transactions, [
+          T('11111111', date(2020, 1, 2), date(2020, 1, 2), 'Dep',
+            'Transfer & deposit', 'CASH', None, 0.0, 0.0, 5000.0, 0.0,
+            5000.0, 0.0, 'CASH'),
+          # The empty MEMO.
+          T('11111111', date(2020, 1, 10), date(2020, 1, 13), 'Buy', 'Buy',
+            'Vanguard Value ETF', 'VTV', 10.0, 100.0, -1000.0, 0.0, -1000.0,
+            0.0, 'CASH'),
+          # The REINVEST is the income and its reinvestment.
+          T('11111111', date(2020, 1, 20), date(2020, 1, 20), 'Dividend',
+            'Dividend', 'Vanguard Value ETF', 'VTV', 0.0, 0.0, 25.0, 0.0,
+            25.0, 0.0, 'CASH'),
+          T('11111111', date(2020, 1, 20), date(2020, 1, 20), 'Reinvestment',
+            'Dividend reinvestment', 'Vanguard Value ETF', 'VTV', 0.25,
+            100.0, -25.0, 0.0, -25.0, 0.0, 'CASH'),
+        ])
+
+    def test_ofx_xml(self):
+        self.assertEqual(self.parse(ofx_xml(Ofx_sgml)), self.parse(Ofx_sgml))
+
+
+@skipUnless(numpy, "requires numpy")
+class Reconcile_tests(Cache_test_case):
+    r'''reconcile finds the funds that have drifted from the broker's.
+    '''
+    def setUp(self):
+        super().setUp()
+        load_prices({'VTV': random_closes(random.Random(6),
+                                          date(2019, 12, 1),
+                                          date(2020, 6, 30))})
+        self.acct = Account.objects.order_by('id').first()
+        AccountTransactionHistory.objects.bulk_create([
+          transaction(self.acct, date(2020, 1, 2), 'Transfer (incoming)',
+                      None, 0.0, 10000.0),
+          transaction(self.acct, date(2020, 1, 10), 'Buy', 'VTV', 10.0,
+                      -1000.0, 100.0),
+          transaction(self.acct, date(2020, 2, 10), 'Buy', 'VTV', 5.0,
+                      -500.0, 100.0),
+          transaction(self.acct, date(2020, 3, 16), 'Dividend', 'VTV', 0.0,
+                      10.0),
+        ])
+        self.acct.transaction_start_date = date(2020, 1, 2)
+        self.acct.transaction_end_date = date(2020, 3, 31)
+        self.acct.save()
+        AccountShares.update(accounts=[self.acct])
+
+    def broker(self, d, **shares):
+        for ticker, fund_shares in shares.items():
+            BrokerBalance.objects.create(account=self.acct, fund_id=ticker,
+                                         date=d, shares=fund_shares,
+                                         share_price=1.0,
+                                         balance=fund_shares)
+
+    def test_matches(self):
+        # VMFXX is off by the accrued dividends, within the cash tolerance,
+        # even though it isn't marked as a money market fund.
+        self.assertFalse(Fund.objects.get(ticker='VMFXX').money_market)
+        self.broker(date(2020, 1, 31), VTV=10.0, VMFXX=9000.5)
+        self.broker(date(2020, 2, 29), VTV=15.0, VMFXX=8500.5)
+        self.broker(date(2020, 6, 30), VTV=14.0, VMFXX=8510.5)
+        report = reconcile.reconcile()
+        self.assertEqual(report.drifts, [])
+        self.assertEqual(report.checked, 4)
+        self.assertEqual(report.skipped, 2)
+
+    def test_drift(self):
+        self.broker(date(2020, 1, 31), VTV=10.0, VMFXX=9000.0)
+        self.broker(date(2020, 2, 29), VTV=15.0, VMFXX=8500.0)
+        self.broker(date(2020, 3, 31), VTV=14.0, VMFXX=8510.0)
+        report = reconcile.reconcile()
+        self.assertEqual(len(report.drifts), 1)
+        drift = report.drifts[0]
+        self.assertEqual((drift.account_id, drift.ticker, drift.first_drift,
+                          drift.last_match, drift.suspect_date, drift.date,
+                          drift.broker_shares, drift.shares),
+                         (self.acct.id, 'VTV', date(2020, 3, 31),
+                          date(2020, 2, 29), date(2020, 3, 16),
+                          date(2020, 3, 31), 14.0, 15.0))
+
+    def test_not_reported(self):
+        # The broker doesn't have the VTV at all.
+        self.broker(date(2020, 1, 31), VMFXX=9000.0)
+        report = reconcile.reconcile()
+        self.assertEqual([(drift.ticker, drift.first_drift, drift.last_match,
+                           drift.suspect_date, drift.broker_shares,
+                           drift.shares)
+                          for drift in report.drifts],
+                         [('VTV', date(2020, 1, 31), None, date(2020, 1, 10),
+                           0.0, 10.0)])
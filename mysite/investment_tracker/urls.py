@@ -40,6 +40,8 @@ urlpatterns = [
          name='load_all_fund_history'),
     path('load_fund_history/<ticker>', views.load_fund_history,
          name='load_fund_history'),
+    path('reload_fund_prices/<ticker>/<date:from_date>',
+         views.reload_fund_prices, name='reload_fund_prices'),
     path('load_transactions/<date:end_date>', views.load_transactions),
     path('load_transactions/<date:end_date>/<filename>',
          views.load_transactions, name='load_transactions'),
@@ -68,7 +70,20 @@ urlpatterns = [
     path('update_shares', views.update_shares, name='update_shares'),
     path('update_shares/<int:reload>', views.update_shares,
          name='reload_shares'),
+    path('rebuild_shares/<int:account_id>/<date:from_date>',
+         views.rebuild_shares, name='rebuild_shares'),
+    path('rebuild_shares/<int:account_id>/<date:from_date>/<date:to_date>',
+         views.rebuild_shares, name='rebuild_shares'),
     path('shares/<int:account_id>/<date:date>', views.shares),
+    path('holdings/<date:date>', views.holdings, name='holdings'),
+    path('fund_history/<ticker>', views.fund_history),
+    path('fund_history/<ticker>/<date:start_date>/<date:end_date>',
+         views.fund_history),
+    path('fund_history/<ticker>/<date:start_date>/<date:end_date>/'
+           '<int:account_id>',
+         views.fund_history, name='fund_history'),
+    path('reconcile', views.reconcile, name='reconcile'),
+    path('reconcile/<int:account_id>', views.reconcile, name='reconcile'),
     path('help', views.help, name='help'),
     path('rebalance/<int:owner_id>', views.rebalance, name='default_rebalance'),
     path('rebalance/<int:owner_id>/tags/<tags>', views.rebalance, name='default_rebalance'),
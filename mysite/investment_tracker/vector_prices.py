@@ -0,0 +1,78 @@
+# vector_prices.py
+
+r'''NumPy version of the FundPriceHistory peak/trough calculations.
+
+FundPriceHistory.fetch_prices carries the running peak and trough forward
+one close at a time as the closes arrive.  `running_peaks` calculates them
+for a whole run of closes at once, so that they can be redone from any date
+(see FundPriceHistory.recompute_peaks).
+
+The peak is the running maximum of the closes.  The trough is the running
+minimum of the closes since the last new peak, so it is calculated
+separately for each run of closes between new peaks.  Only maximums and
+minimums are taken, so these are exactly the same as fetch_prices
+calculates.
+
+Dates are carried in the arrays as ordinals (see date.toordinal), with 0 for
+the missing dates.  The missing trough_closes are NaN.
+'''
+
+import numpy as np
+
+
+def running_minimum(closes, days, trough_close, trough_day):
+    r'''Returns trough_closes, trough_days for one run of closes.
+
+    The trough carries on from `trough_close` on `trough_day` (NaN and 0 to
+    start from the first close).  Ties keep the earlier day.
+    '''
+    if np.isnan(trough_close):
+        troughs = np.minimum.accumulate(closes)
+        prev_troughs = np.concatenate(([np.inf], troughs[:-1]))
+    else:
+        troughs = np.minimum.accumulate(np.concatenate(([trough_close],
+                                                        closes)))
+        prev_troughs = troughs[:-1]
+        troughs = troughs[1:]
+    new_troughs = closes < prev_troughs
+    last_trough = np.maximum.accumulate(
+                    np.where(new_troughs, np.arange(len(closes)), -1))
+    trough_days = np.where(last_trough >= 0,
+                           days[np.maximum(last_trough, 0)],
+                           trough_day)
+    return troughs, trough_days
+
+
+def running_peaks(days, closes, peak_close=0.0, peak_day=0,
+                  trough_close=np.nan, trough_day=0):
+    r'''Returns peak_closes, peak_days, trough_closes, trough_days arrays.
+
+    `days` and `closes` are the closes in date order.  The peak and trough
+    carry on from the ones given (those of the close before the first day).
+    '''
+    days = np.asarray(days, dtype=np.int64)
+    closes = np.asarray(closes, dtype=np.float64)
+    n = len(closes)
+
+    # A new peak is a close above all of the closes before it.
+    peaks = np.maximum.accumulate(np.concatenate(([peak_close], closes)))
+    new_peaks = closes > peaks[:-1]
+    peak_closes = peaks[1:]
+    last_peak = np.maximum.accumulate(np.where(new_peaks, np.arange(n), -1))
+    peak_days = np.where(last_peak >= 0, days[np.maximum(last_peak, 0)],
+                         peak_day)
+
+    # There's no trough on the day of a new peak.  The closes after it start
+    # a new run.
+    trough_closes = np.full(n, np.nan)
+    trough_days = np.zeros(n, dtype=np.int64)
+    starts = np.flatnonzero(new_peaks)
+    runs = [(0, starts[0] if len(starts) else n, trough_close, trough_day)]
+    runs.extend((start + 1, end, np.nan, 0)
+                for start, end in zip(starts.tolist(),
+                                      starts[1:].tolist() + [n]))
+    for lo, hi, run_close, run_day in runs:
+        if lo < hi:
+            trough_closes[lo:hi], trough_days[lo:hi] = \
+              running_minimum(closes[lo:hi], days[lo:hi], run_close, run_day)
+    return peak_closes, peak_days, trough_closes, trough_days
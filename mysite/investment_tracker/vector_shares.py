@@ -0,0 +1,221 @@
+# vector_shares.py
+
+r'''NumPy version of the AccountShares.update calculations.
+
+This is the 'vectorized' shares engine (see models.shares_engine).  Rather
+than stepping through each account's dates one day at a time, each fund's
+shares are calculated for all of its dates at once as running sums of its
+transactions, and the share prices are looked up for all of those dates at
+once.
+
+These functions only deal with plain Python data and NumPy arrays; the
+database access is done by AccountShares.vectorized_rows.
+
+Dates are carried in the arrays as ordinals (see date.toordinal).
+'''
+
+from datetime import date
+
+import numpy as np
+
+
+# The fields in each row returned by `account_rows`, in order.
+Row_fields = (
+    'fund_id',
+    'date',
+    'shares',
+    'share_price',
+    'balance',
+    'peak_pct_of_balance',
+    'peak_date',
+    'trough_pct_of_balance',
+    'trough_date',
+)
+
+
+def running_shares(trade_dates, amounts, starting_shares, start_date,
+                   end_date):
+    r'''Returns days, shares as arrays for each day from `start_date` on.
+
+    `trade_dates` (ordinals, in order) and `amounts` are the transactions.
+    The shares on each day include all of the transactions on or before that
+    day, added in order to `starting_shares`.
+
+    The days run through `end_date`, or through the day before the last
+    trade_date if that is later (as the legacy engine does).
+    '''
+    last_day = end_date
+    if len(trade_dates):
+        last_day = max(end_date, int(trade_dates[-1]) - 1)
+    days = np.arange(start_date, last_day + 1)
+
+    # np.cumsum adds in order, so these match the legacy running sums
+    # exactly.
+    totals = np.cumsum(np.concatenate(([starting_shares], amounts)))
+    return days, totals[np.searchsorted(trade_dates, days, side='right')]
+
+
+class price_series:
+    r'''One fund's prices as arrays, with a row for every day.
+
+    These are copied from `prices`, a price_cache.fund_prices (or None if the
+    fund has no prices).  The peak_dates and trough_dates are ordinals, with
+    0 for the missing trough_dates.
+    '''
+    def __init__(self, ticker, prices):
+        self.ticker = ticker
+        def column(name, dtype):
+            if prices is None:
+                return np.array((), dtype=dtype)
+            return np.array(getattr(prices, name), dtype=dtype)
+        self.dates = column('dates', np.int64)
+        self.closes = column('closes', np.float64)
+        self.peak_closes = column('peak_closes', np.float64)
+        self.peak_dates = column('peak_dates', np.int64)
+
+        # The missing trough_closes are NaN.
+        self.trough_closes = column('trough_closes', np.float64)
+        self.trough_dates = column('trough_dates', np.int64)
+
+    def as_of(self, days, max_days=5):
+        r'''Returns the index of the price as of each of `days`.
+
+        Like price_cache.fund_prices.index_on, days past the end of the
+        calendar use the last day, if it's within `max_days`.
+        '''
+        if len(self.dates):
+            index = np.minimum(days - self.dates[0], len(self.dates) - 1)
+            missing = (index < 0) | (days - self.dates[-1] > max_days)
+        else:
+            index = np.zeros(len(days), dtype=np.int64)
+            missing = np.ones(len(days), dtype=bool)
+        assert not missing.any(), \
+               f"Missing fund history date for {self.ticker} on " \
+                 f"{date.fromordinal(int(days[missing][0]))}"
+        return index
+
+
+def fund_rows(ticker, days, shares, dates, prices, money_market):
+    r'''Generates the rows for `ticker` held `shares` on `days`.
+
+    `dates` is {ordinal: date}.
+    '''
+    day_dates = [dates[d] for d in days.tolist()]
+    if money_market:
+        for day, num_shares in zip(day_dates, shares.tolist()):
+            yield (ticker, day, num_shares, 1.0, num_shares * 1.0, 1.0, day,
+                   None, None)
+        return
+
+    index = prices.as_of(days)
+    closes = prices.closes[index]
+    balances = shares * closes
+    peak_pcts = prices.peak_closes[index] / closes
+    trough_pcts = prices.trough_closes[index] / closes
+    yield from zip([ticker] * len(day_dates),
+                   day_dates,
+                   shares.tolist(),
+                   closes.tolist(),
+                   balances.tolist(),
+                   peak_pcts.tolist(),
+                   [date.fromordinal(d)
+                    for d in prices.peak_dates[index].tolist()],
+                   [None if np.isnan(tp) else tp
+                    for tp in trough_pcts.tolist()],
+                   [date.fromordinal(d) if d else None
+                    for d in prices.trough_dates[index].tolist()])
+
+
+def account_rows(fund_trans, vmfxx_trans, prices, money_markets,
+                 starting_shares, last_date, start_date, end_date):
+    r'''Returns the new AccountShares rows for one account.
+
+    `fund_trans` is [(ticker, trade_date, shares)] for the non-VMFXX funds,
+    ordered by ticker, trade_date (see
+    AccountTransactionHistory.fund_shares_query).
+
+    `vmfxx_trans` is [(trade_date, net_amount)] for VMFXX, ordered by
+    trade_date (see AccountTransactionHistory.vmfxx_query).
+
+    `prices` is {ticker: price_cache.fund_prices}.
+
+    The other arguments are as in AccountShares.legacy_rows.
+
+    Returns a list of tuples with the `Row_fields`, in the same order that
+    the legacy engine creates them.
+    '''
+    first_day = start_date.toordinal()
+    last_day = end_date.toordinal()
+    trade_days = [t[1].toordinal() for t in fund_trans] + \
+                 [t[0].toordinal() for t in vmfxx_trans]
+    if trade_days:
+        last_day = max(last_day, max(trade_days) - 1)
+    dates = {d: date.fromordinal(d) for d in range(first_day, last_day + 1)}
+
+    def series(ticker):
+        return price_series(ticker, prices.get(ticker))
+
+    def check_negative(ticker, days, shares):
+        negative = shares < 0
+        assert not negative.any(), \
+               f"Got unexpected negative shares for {ticker} on " \
+                 f"{dates[int(days[negative][0])]}"
+
+    rows = []
+
+    # Gather all but VMFXX funds:
+    tickers_seen = set()
+    for ticker, (start, stop) in group_bounds(fund_trans):
+        tickers_seen.add(ticker)
+        if last_date is None:
+            shares = 0.0
+        else:
+            shares = starting_shares.get(ticker, 0.0)
+        trade_dates = np.array(trade_days[start:stop], dtype=np.int64)
+        amounts = np.array([t[2] for t in fund_trans[start:stop]],
+                           dtype=np.float64)
+        days, shares = running_shares(trade_dates, amounts, shares,
+                                      first_day, end_date.toordinal())
+        held = np.abs(shares) > 0.01
+        days, shares = days[held], shares[held]
+        check_negative(ticker, days, shares)
+        rows.extend(fund_rows(ticker, days, shares, dates, series(ticker),
+                              ticker in money_markets))
+
+    # Bring forward any shares that didn't have any transactions.
+    days = np.arange(first_day, end_date.toordinal() + 1)
+    for ticker, shares in starting_shares.items():
+        if ticker != 'VMFXX' and ticker not in tickers_seen and \
+           abs(shares) > 0.01:
+            assert shares >= 0, \
+                   f"Got unexpected negative shares for {ticker} on " \
+                     f"{start_date}"
+            rows.extend(fund_rows(ticker, days, np.full(len(days), shares),
+                                  dates, series(ticker),
+                                  ticker in money_markets))
+
+    # Gather VMFXX fund:
+    if last_date is None:
+        shares = 0.0
+    else:
+        shares = starting_shares['VMFXX']
+    trade_dates = np.array(trade_days[len(fund_trans):], dtype=np.int64)
+    amounts = np.array([t[1] for t in vmfxx_trans], dtype=np.float64)
+    days, shares = running_shares(trade_dates, amounts, shares, first_day,
+                                  end_date.toordinal())
+    check_negative('VMFXX', days, shares)
+    for day, num_shares in zip(days.tolist(), shares.tolist()):
+        rows.append(('VMFXX', dates[day], num_shares, 1.0, num_shares, 1.0,
+                     dates[day], None, None))
+
+    return rows
+
+
+def group_bounds(fund_trans):
+    r'''Generates ticker, (start, stop) for each ticker's run in `fund_trans`.
+    '''
+    start = 0
+    for i in range(1, len(fund_trans) + 1):
+        if i == len(fund_trans) or fund_trans[i][0] != fund_trans[start][0]:
+            yield fund_trans[start][0], (start, i)
+            start = i
@@ -7,6 +7,7 @@ from collections import OrderedDict
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.db import transaction
+from django.db.models import Min, Max
 
 from . import models
 
@@ -30,21 +31,27 @@ def prev_month(date, target_day):
 def index(request):
     print("index called")
     accts = models.Account.objects.all()
-    start_date = models.AccountShares.objects.latest().date
-    end_date = models.AccountShares.objects.earliest().date
+
+    # These cover both the 'daily' and 'intervals' shares_storage.
+    dates = accts.aggregate(Max('shares_end_date'), Min('shares_start_date'))
+    start_date = dates['shares_end_date__max']
+    end_date = dates['shares_start_date__min']
 
     print("index from", start_date, "back to", end_date)
 
-    # list of (date, [acct_bal, ...])
-    balances = []
+    month_dates = []
     date = start_date
     while date >= end_date:
-        print("doing date", date)
-        row = (date, [acct.balance_on_date(date) for acct in accts])
-        print(row)
-        balances.append(row)
+        month_dates.append(date)
         date = prev_month(date, start_date.day)
 
+    # {account_id: {date: balance}}
+    acct_balances = models.Account.balances_on_dates(accts, month_dates)
+
+    # list of (date, [acct_bal, ...])
+    balances = [(date, [acct_balances[acct.id][date] for acct in accts])
+                for date in month_dates]
+
     context = dict(accts=accts,
                    balances=balances,
     )
@@ -58,24 +65,43 @@ def index(request):
 
 @transaction.atomic
 def clear_history(request, start_date, end_date):
+    r'''Deletes the transactions between `start_date` and `end_date`.
+
+    The accounts that had transactions there have their shares marked as out
+    of date from `start_date` on (see DirtyShares), so the next update_shares
+    only redoes those.
+    '''
     #models.AccountFundHistory.objects.filter(
     #                            date__range=(start_date, end_date)) \
     #                         .delete()
-    models.AccountTransactionHistory.objects.filter(
+    cleared = models.AccountTransactionHistory.objects.filter(
                                       trade_date__range=(start_date,
-                                                         end_date)) \
-                                    .delete()
-    models.AccountShares.objects.filter(
-                                      date__range=(start_date, end_date)) \
-                                    .delete()
+                                                         end_date))
+    account_ids = frozenset(cleared.values_list('account_id', flat=True))
+    cleared.delete()
+
+    # So that the downloads ending within these dates can be loaded again.
+    models.ImportedFile.objects.filter(end_date__range=(start_date, end_date)) \
+                               .delete()
     #models.AccountSnapshot.objects.filter(
     #                                  date__range=(start_date, end_date)) \
     #                                .delete()
-    Account.objects.all().update(transaction_start_date=None,
-                                 transaction_end_date=None,
-                                 shares_start_date=None,
-                                 shares_end_date=None)
-    return HttpResponse(f"Cleared history between {start_date} and {end_date}.")
+    for acct in models.Account.objects.filter(pk__in=account_ids):
+        remaining = models.AccountTransactionHistory.objects \
+                                                    .filter(account=acct)
+        if not remaining.exists():
+            acct.transaction_start_date = None
+            acct.transaction_end_date = None
+        else:
+            acct.transaction_start_date = remaining.earliest().trade_date
+            if end_date >= acct.transaction_end_date:
+                acct.transaction_end_date = start_date - models.One_day
+        acct.save()
+        models.DirtyShares.mark_account(acct, start_date)
+    models.AccountCheckpoint.update(
+      models.Account.objects.filter(pk__in=account_ids))
+    return HttpResponse(f"Cleared history between {start_date} and {end_date} "
+                          f"for {len(account_ids)} accounts.")
 
 
 def load_fund_history(request, ticker='ALL'):
@@ -96,23 +122,12 @@ def load_fund_history(request, ticker='ALL'):
                             f"{price_rows} prices loaded."
                 print("DONE:", message)
                 response = HttpResponse(message)
-            except models.Yahoo_exception as e:
+            except models.Provider_exception as e:
                 print(e)
                 response = e.response()
         else:
-            error_funds = []
-            total_dividend_rows = 0
-            total_price_rows = 0
-            for fund in models.Fund.objects.all():
-                try:
-                    dividend_rows, price_rows = fund.load_history()
-                    print(f"{fund}: {dividend_rows} dividends loaded, "
-                            f"{price_rows} prices loaded.")
-                    total_dividend_rows += dividend_rows
-                    total_price_rows += price_rows
-                except models.Yahoo_exception as e:
-                    print(e)
-                    error_funds.append(fund.ticker)
+            total_dividend_rows, total_price_rows, error_funds = \
+              models.load_all_history(models.Fund.objects.all())
             if error_funds:
                 response = HttpResponse(f"{error_funds} failed")
             else:
@@ -127,7 +142,10 @@ def load_transactions(request, end_date, filename='ofxdownload.csv'):
     r'''Loads/updates the AccountTransactionHistory table.
     
     The transactions are taken from the ofxdownload.csv file downloaded
-    from Vanguard.
+    from Vanguard, or another download that parsers.py reads, like an OFX
+    file from another broker.  The download may overlap the transactions
+    already loaded; only the new ones are added.  Loading the same file
+    again does nothing.
     '''
     if request.method not in ('POST', 'GET'):
         return HttpResponse(status=405)   # Method not allowed
@@ -136,9 +154,14 @@ def load_transactions(request, end_date, filename='ofxdownload.csv'):
                             content_type='text/plain',
                             status=400)
     path = os.path.join(Downloads_dir, filename)
+    fingerprint = models.ImportedFile.fingerprint_file(path)
     with open(path, newline='') as file:
-        trans_accounts, new_trans_funds = models.Account.load_csv(file,
-                                                                  end_date)
+        loaded = models.Account.load_csv(file, end_date,
+                                         fingerprint=fingerprint,
+                                         filename=filename)
+    if loaded is None:
+        return HttpResponse(f"{filename} has already been loaded.")
+    trans_accounts, new_trans_funds = loaded
     response = HttpResponse(
        f"Transactions loaded for {trans_accounts} accounts, "
        f"{new_trans_funds} new funds created."
@@ -160,7 +183,7 @@ def get_populated_tree_by_date(acct, date, tags=()):
     shares_by_ticker = acct.shares_on_date(date)
     #print("shares_by_ticker", shares_by_ticker)
 
-    tickers = [cat.fund  # FIX
+    tickers = [cat.fund.ticker
                for cat in tree
                 if cat.fund is not None and not cat.fund.money_market]
     #print("tickers", tickers)
@@ -292,13 +315,28 @@ def adjust_plan(us_cat, bond_cat, adj_pct):
 def account(request, account_id, date, tags=''):
     acct = models.Account.objects.get(pk=account_id)
 
-    if not (acct.shares_start_date <= date <= acct.shares_end_date):
-        return HttpResponse(f"date must be between {acct.shares_start_date} "
-                              f"and {acct.shares_end_date}",
+    if acct.transaction_start_date is None or \
+       not (acct.transaction_start_date <= date <= acct.transaction_end_date):
+        return HttpResponse(f"date must be between "
+                              f"{acct.transaction_start_date} "
+                              f"and {acct.transaction_end_date}",
                             content_type='text/plain',
                             status=400)
 
     tags = tags.split(',') if tags else ()
+
+    # The tree shows every fund in it, held or not.
+    tickers = frozenset(cat.fund.ticker
+                        for cat in acct.get_tree(tags=tags)
+                         if cat.fund is not None and not cat.fund.money_market)
+    unpriced = sorted(tickers -
+                      models.FundPriceHistory.share_prices(tickers, date)
+                                             .keys())
+    if unpriced:
+        return HttpResponse(f"no prices on {date} for {', '.join(unpriced)}",
+                            content_type='text/plain',
+                            status=400)
+
     print("account", acct, "date", date, "Category root", acct.category, "tags", tags)
 
     tree = get_populated_tree_by_date(acct, date, tags=tags)
@@ -384,6 +422,43 @@ def update_shares(request, reload=False):
     return response
 
 
+def rebuild_shares(request, account_id, from_date, to_date=None):
+    r'''Recalculates the account's shares from `from_date` on.
+
+    With `to_date`, only through `to_date` (see DirtyShares.mark_account).
+    '''
+    if request.method not in ('POST', 'GET'):
+        response = HttpResponse()
+        response.status_code = 405  # Method not allowed
+    else:
+        acct = models.Account.objects.get(pk=account_id)
+        models.DirtyShares.mark_account(acct, from_date, to_date)
+        models.AccountShares.update()
+        response = HttpResponse(f"Done.", content_type="text/plain")
+    return response
+
+
+def reload_fund_prices(request, ticker, from_date):
+    r'''Reloads the fund's prices from `from_date` on.
+
+    This is for when the prices have been corrected.  The shares are
+    repriced by the next update_shares.
+    '''
+    if request.method not in ('POST', 'GET'):
+        response = HttpResponse()
+        response.status_code = 405  # Method not allowed
+    else:
+        fund = models.Fund.objects.get(pk=ticker.upper())
+        try:
+            price_rows = fund.reload_prices(from_date)
+            response = HttpResponse(f"{fund}: {price_rows} prices loaded.",
+                                    content_type="text/plain")
+        except models.Provider_exception as e:
+            print(e)
+            response = e.response()
+    return response
+
+
 def shares(request, account_id, date):
     acct = models.Account.objects.get(pk=account_id)
     shares_by_ticker = acct.shares_on_date(date)
@@ -397,6 +472,77 @@ def shares(request, account_id, date):
     return render(request, 'shares.html', context)
  
 
+def holdings(request, date):
+    r'''Shows the balance of each fund in each account on `date`.
+
+    These come from the holdings_cube.
+    '''
+    # NumPy is only needed for the holdings_cube.
+    from . import holdings_cube
+
+    cube = holdings_cube.get()
+    accts = models.Account.objects.in_bulk(cube.account_ids)
+    on_date = cube.on_date(date)
+    allocation = cube.allocation(date)
+
+    # list of (ticker, pct_of_total, [acct_bal, ...])
+    fund_rows = [(ticker,
+                  allocation[ticker],
+                  [on_date[account_id].get(ticker, (0.0, 0.0))[1]
+                   for account_id in cube.account_ids])
+                 for ticker in cube.tickers
+                  if ticker in allocation]
+    balances = cube.balances_on_date(date)
+
+    context = dict(
+        date=date,
+        accts=[accts[account_id] for account_id in cube.account_ids],
+        fund_rows=fund_rows,
+        balances=[balances[account_id] for account_id in cube.account_ids],
+    )
+    return render(request, 'holdings.html', context)
+
+
+def fund_history(request, ticker, start_date=None, end_date=None,
+                 account_id=None):
+    r'''Returns the fund's daily shares and balance as CSV.
+
+    These are summed over all accounts, unless `account_id` is given.  They
+    come from the holdings_cube.
+    '''
+    # NumPy is only needed for the holdings_cube.
+    from . import holdings_cube
+
+    dates, shares, balances = \
+      holdings_cube.get().fund_history(ticker.upper(), account_id,
+                                       start_date, end_date)
+    lines = ['date,shares,balance']
+    lines.extend(f"{date},{num_shares:.4f},{balance:.2f}"
+                 for date, num_shares, balance
+                  in zip(dates, shares.tolist(), balances.tolist()))
+    return HttpResponse('\n'.join(lines), content_type="text/csv")
+
+
+def reconcile(request, account_id=None):
+    r'''Returns the funds whose shares have drifted from the broker's as CSV.
+
+    See reconcile.py.
+    '''
+    # NumPy is only needed for the reconciliation.
+    from . import reconcile
+
+    report = reconcile.reconcile(None if account_id is None else [account_id])
+    lines = ['account_id,ticker,date,shares,broker_shares,drift,balance,'
+             'broker_balance,first_drift,last_match,suspect_date']
+    lines.extend(f"{drift.account_id},{drift.ticker},{drift.date},"
+                 f"{drift.shares:.4f},{drift.broker_shares:.4f},"
+                 f"{drift.drift:.4f},{drift.balance:.2f},"
+                 f"{drift.broker_balance:.2f},{drift.first_drift},"
+                 f"{drift.last_match or ''},{drift.suspect_date or ''}"
+                 for drift in report.drifts)
+    return HttpResponse('\n'.join(lines), content_type="text/csv")
+
+
 def help(request):
     return render(request, 'help.html')
 
@@ -0,0 +1,233 @@
+# yahoo_cache.py
+
+r'''On-disk cache of the raw responses from Yahoo.
+
+This is controlled by YAHOO_CACHE in settings.py:
+
+  * 'off' always goes to Yahoo (the default).
+
+  * 'on' serves responses from the cache if they are less than
+    YAHOO_CACHE_TTL seconds old (None for no limit).  Otherwise they are
+    fetched from Yahoo and saved in the cache.
+
+  * 'replay' only serves responses from the cache, regardless of their age,
+    and never goes to Yahoo.  Requests that aren't in the cache get a 504
+    response (as HTTP does for "only-if-cached").
+
+The cache is content-addressed.  Each response body is stored once, in
+`blobs/` under the sha256 of its content.  Each request has a small json
+entry in `keys/` (under the sha256 of its `cache_key`, which identifies the
+ticker, events and start of the period) that points to its blob.  When the blobs add up to more
+than YAHOO_CACHE_MAX_BYTES, the least recently used entries are evicted.
+
+Only good (200 text/csv) responses are cached.
+'''
+
+import os
+import os.path
+import time
+import json
+import hashlib
+import tempfile
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from django.conf import settings
+
+
+def cache_mode():
+    r'''Returns 'off', 'on' or 'replay'.  See above.
+    '''
+    return getattr(settings, 'YAHOO_CACHE', 'off')
+
+
+def cache_dir():
+    return getattr(settings, 'YAHOO_CACHE_DIR',
+                   os.path.join(settings.BASE_DIR, 'yahoo_cache'))
+
+
+def cache_ttl():
+    return getattr(settings, 'YAHOO_CACHE_TTL', 24 * 60 * 60)
+
+
+def cache_max_bytes():
+    return getattr(settings, 'YAHOO_CACHE_MAX_BYTES', 500 * 1024 * 1024)
+
+
+class cached_response:
+    r'''Stands in for the parts of a requests response that we use.
+    '''
+    def __init__(self, content, status_code=200, content_type='text/csv'):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'content-type': content_type}
+        self.encoding = 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding)
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self.content.splitlines():
+            yield line.decode(self.encoding) if decode_unicode else line
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(url):
+    r'''Returns `url` without its `period2`, to look it up in the cache by.
+
+    The period2 (the end of the period) defaults to yesterday, so a key
+    including it would change every day, and 'replay' would miss everything
+    cached on an earlier day.  So the cached response runs through the day
+    before it was fetched, whenever it is served (see YAHOO_CACHE_TTL).
+    '''
+    parts = urlsplit(url)
+    query = [(name, value)
+             for name, value in parse_qsl(parts.query)
+              if name != 'period2']
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def entry_path(url):
+    return os.path.join(cache_dir(), 'keys',
+                        sha256(cache_key(url).encode('utf-8')) + '.json')
+
+
+def blob_path(digest):
+    return os.path.join(cache_dir(), 'blobs', digest)
+
+
+def write_file(path, data):
+    r'''Writes `data` (bytes) to `path` atomically.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def lookup(url, max_age=None):
+    r'''Returns the cached_response for `url`, or None if not cached.
+
+    Entries older than `max_age` seconds (if not None) are not returned.
+    '''
+    path = entry_path(url)
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        if max_age is not None and time.time() - entry['time'] > max_age:
+            return None
+        with open(blob_path(entry['blob']), 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    os.utime(path)   # mark as recently used
+    return cached_response(content, content_type=entry['content_type'])
+
+
+def store(url, r):
+    r'''Saves the requests response `r` for `url` in the cache.
+
+    Returns a cached_response for it.
+    '''
+    content_type = r.headers['content-type']
+    response = cached_response(r.content, r.status_code, content_type)
+    if r.status_code == 200 and content_type.split(';')[0] == 'text/csv':
+        digest = sha256(r.content)
+        if not os.path.exists(blob_path(digest)):
+            write_file(blob_path(digest), r.content)
+        write_file(entry_path(url),
+                   json.dumps(dict(url=url, blob=digest,
+                                   content_type=content_type,
+                                   time=time.time())).encode('utf-8'))
+        evict()
+    return response
+
+
+def get(url, fetch):
+    r'''Returns the response for `url` according to the `cache_mode`.
+
+    `fetch` is called (with no arguments) to get `url` from Yahoo.
+    '''
+    mode = cache_mode()
+    if mode == 'replay':
+        r = lookup(url)
+        if r is None:
+            print("Not in the Yahoo cache:", url)
+            return cached_response(b"Not in the Yahoo cache", 504,
+                                   'text/plain')
+        return r
+    assert mode == 'on', f"Unknown YAHOO_CACHE mode, {mode!r}"
+    r = lookup(url, cache_ttl())
+    if r is None:
+        r = store(url, fetch())
+    return r
+
+
+def evict(max_bytes=None):
+    r'''Evicts the least recently used entries until the blobs fit `max_bytes`.
+
+    Blobs are deleted once no entries refer to them.
+
+    Returns the number of entries evicted.
+    '''
+    if max_bytes is None:
+        max_bytes = cache_max_bytes()
+    keys_dir = os.path.join(cache_dir(), 'keys')
+    blobs_dir = os.path.join(cache_dir(), 'blobs')
+    try:
+        blob_sizes = {name: os.path.getsize(os.path.join(blobs_dir, name))
+                      for name in os.listdir(blobs_dir)
+                       if not name.startswith('tmp')}
+    except FileNotFoundError:
+        return 0
+    total = sum(blob_sizes.values())
+    if total <= max_bytes:
+        return 0
+
+    entries = []   # [(last_used, path, blob)]
+    for name in os.listdir(keys_dir):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(keys_dir, name)
+        try:
+            with open(path) as f:
+                entries.append((os.path.getmtime(path), path,
+                                json.load(f)['blob']))
+        except (FileNotFoundError, ValueError):
+            pass   # being replaced by another thread
+    entries.sort()
+    refs = {}
+    for _, _, blob in entries:
+        refs[blob] = refs.get(blob, 0) + 1
+
+    evicted = 0
+    for _, path, blob in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        evicted += 1
+        refs[blob] -= 1
+        if not refs[blob] and blob in blob_sizes:
+            try:
+                os.remove(os.path.join(blobs_dir, blob))
+            except FileNotFoundError:
+                pass
+            total -= blob_sizes[blob]
+    print("Yahoo cache evicted", evicted, "entries")
+    return evicted
@@ -131,3 +131,89 @@ USE_TZ = False
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Investment tracker
+
+# How AccountShares.update stores the daily shares: 'daily' (one AccountShares
+# row per account/fund/day) or 'intervals' (one AccountHoldings row per run of
+# unchanged shares).  Changing this requires reloading the shares
+# (update_shares/1).
+SHARES_STORAGE = 'daily'
+
+# How AccountShares.update calculates the daily shares: 'legacy' (one day at a
+# time), 'vectorized' (NumPy arrays, requires numpy), 'sql' (window functions
+# in the database, requires SQLite) or 'stream' (like 'legacy', but written in
+# batches as they are generated, in bounded memory).  All produce the same
+# rows, except that 'sql' rounds the sums differently from SQLite 3.43 on.
+SHARES_ENGINE = 'legacy'
+
+# How many rows the 'stream' shares engine writes at a time.
+SHARES_BATCH_SIZE = 5000
+
+# How many processes AccountShares.update uses to calculate the accounts.
+# With more than 1, each account is calculated in its own worker process and
+# the results are written by the calling process.
+SHARES_WORKERS = 1
+
+# How often AccountCheckpoint takes a checkpoint of each account's shares:
+# 'month', 'quarter' or 'year'.  The shares on any date are worked out from
+# the last checkpoint before it.  Changing this requires retaking the
+# checkpoints (manage.py update_checkpoints --reload).
+CHECKPOINT_CADENCE = 'month'
+
+# How many rows the fund price/dividend loaders insert at a time.
+HISTORY_BATCH_SIZE = 1000
+
+# How many transactions load_transactions inserts at a time.
+IMPORT_BATCH_SIZE = 1000
+
+# How many funds load_fund_history fetches from Yahoo at the same time.
+YAHOO_WORKERS = 4
+
+# Caching of the raw Yahoo responses (see investment_tracker/yahoo_cache.py):
+# 'off', 'on' (serve fresh cached responses, fetch and save the rest) or
+# 'replay' (serve only from the cache, never go to Yahoo).
+YAHOO_CACHE = 'off'
+YAHOO_CACHE_DIR = os.path.join(BASE_DIR, 'yahoo_cache')
+YAHOO_CACHE_TTL = 24 * 60 * 60          # seconds, None for no limit
+YAHOO_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Where the fund prices and dividends come from (see
+# investment_tracker/providers.py): 'yahoo' or 'standin' (the synthetic data
+# served by investment_tracker/standin_server.py at MARKET_DATA_STANDIN_URL).
+MARKET_DATA_PROVIDER = 'yahoo'
+MARKET_DATA_STANDIN_URL = 'http://localhost:8765'
+
+# How many resolved Category trees (per account/category/tags) are cached.
+TREE_CACHE_SIZE = 100
+
+# The per-process cache of fund prices (see investment_tracker/price_cache.py):
+# how much memory it may use, and how often (in seconds) each fund is checked
+# for prices loaded by other processes.
+PRICE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PRICE_CACHE_REFRESH = 60
+
+# The fund price matrix file shared by all processes (see
+# investment_tracker/price_matrix.py): 'off' or 'on'.  With 'on', write the
+# first version with manage.py update_price_matrix.
+PRICE_MATRIX = 'off'
+PRICE_MATRIX_DIR = os.path.join(BASE_DIR, 'price_matrix')
+
+# The directory that manage.py ingest_downloads loads the broker downloads
+# from (see investment_tracker/ingest.py), where the loaded files are moved
+# to, where the files that can't be loaded are moved to, which files to load,
+# and how often --watch checks for new ones (seconds).
+INGEST_DIR = os.path.expanduser(os.path.join('~', 'Downloads',
+                                             'investment_tracker'))
+INGEST_ARCHIVE_DIR = os.path.join(INGEST_DIR, 'archive')
+INGEST_REJECTS_DIR = os.path.join(INGEST_DIR, 'rejects')
+INGEST_PATTERNS = ('*.csv', '*.ofx', '*.qfx')
+INGEST_INTERVAL = 10
+
+# How far the shares calculated from the transactions may be from the
+# broker's balances before manage.py reconcile reports them (see
+# investment_tracker/reconcile.py): in shares, and in dollars for the money
+# market funds.
+RECONCILE_TOLERANCE = 0.01
+RECONCILE_CASH_TOLERANCE = 1.0